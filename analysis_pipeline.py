@@ -11,91 +11,148 @@ import numpy as np
 import utils.model_handling as model_funcs
 import utils.dataset_generation as iso_data
 import utils.histogram_analysis as hist_funcs
+import utils.result_storage as result_funcs
 
 current_path = os.path.dirname(os.path.abspath(__file__))
 parent_path = os.path.dirname(current_path)
 if parent_path not in sys.path: sys.path.append(parent_path)
 santi_path = parent_path+'/santi_iso_response'
 santi_etc_path = os.path.join(santi_path, 'etc')
-from santi_iso_response.iso_response import utils as santi_utils
-
-# NOTE:This script uses about 19GB of memory with batch_size=100; num_images=900; num_targets=166; num_comparisons=166
-
-with open(os.path.join(santi_etc_path, 'meis.pkl'), 'rb') as g:
-    mei = pickle.load(g)
-num_mei = len(mei['images'])
-neuron_mei = [mei['images'][idx] for idx in range(num_mei)]
-target_neuron_ids = [idx for idx in range(num_mei) if mei['performance'][idx] > 0.01]
-total_num_neurons = len(neuron_mei)
-
-experiment_params = dict()
-experiment_params['batch_size'] = 100
-experiment_params['target_neuron_ids'] = target_neuron_ids
-experiment_params['num_comparisons'] = len(target_neuron_ids)
-experiment_params['min_angle'] = 15
-experiment_params['x_range'] = (-2.0, 2.0)
-experiment_params['y_range'] = (-2.0, 2.0)
-experiment_params['num_images'] = int(30**2)
-experiment_params['image_scale'] = 12
-experiment_params['target_activity'] = 0.5
-experiment_params['iso_window_bounds'] = ((-1, 1), (-1, 1))
-experiment_params['comp_method'] = 'closest'
-experiment_params['output_directory'] = parent_path+'/iso_analysis/'
-experiment_params['save_prefix'] = 'santi_windowed_'
 
 def get_curvatures_from_target_comparison_vectors(model, target_vectors, comparison_vectors, act_func, kwargs):
-    contour_dataset, _ = iso_data.get_contour_dataset(
+    contour_dataset = iso_data.get_batched_contour_dataset(
         target_vectors,
         comparison_vectors,
-        kwargs['x_range'],
-        kwargs['y_range'],
+        (kwargs['y_range'], kwargs['x_range']),
         kwargs['num_images'],
-        kwargs['image_scale'],
-        return_datapoints=False
+        shared_comparisons=False
     )
+    num_neurons = len(contour_dataset['proj_matrix'])
+    num_planes = len(contour_dataset['proj_matrix'][0])
+    # datapoints from many planes are packed into each forward pass of size batch_size
+    response_images = model_funcs.get_batched_response_images(
+        model,
+        contour_dataset['proj_matrix'],
+        contour_dataset['proj_datapoints'],
+        kwargs['target_neuron_ids'],
+        act_func,
+        image_scale=kwargs['image_scale'],
+        batch_size=kwargs['batch_size'],
+        activation_function_kwargs={'compute_grad':False}
+    )
+    all_iso_curvatures, all_attn_curvatures = hist_funcs.compute_curvature_poly_fits(
+        response_images,
+        contour_dataset,
+        kwargs['target_activity'],
+        bounds=kwargs['iso_window_bounds']
+        #measure_loc='right'
+        #measure_upper_right=False
+    )
+    ## Add code to measure mei length
+    #mei = kwargs['mei']
+    # mei_lengths = get_mei_lengths(mei, proj_matrix)
+    #     -- normalize mei
+    #     -- project mei using proj_matrix
+    all_mei_lengths = [[None for plane_index in range(num_planes)] for target_index in range(num_neurons)]
+    out_dict = {
+        'mei_lengths':all_mei_lengths,
+        'contour_dataset':contour_dataset,
+        'iso_curvatures':all_iso_curvatures,
+        'response_images': response_images,
+        'attn_curvatures':all_attn_curvatures
+    }
+    return out_dict
+
+def get_checkpoint_metadata(target_vectors, comparison_vectors, kwargs):
+    """
+    JSON serializable record of the inputs that determine the streaming results, a checkpoint is only resumed if it matches
+    """
+    checkpoint_keys = ['target_neuron_ids', 'x_range', 'y_range', 'num_images', 'image_scale', 'target_activity',
+        'iso_window_bounds']
+    checkpoint_metadata = {key: np.asarray(kwargs[key]).tolist() for key in checkpoint_keys}
+    checkpoint_metadata['target_vectors_hash'] = result_funcs.get_array_hash(target_vectors)
+    checkpoint_metadata['comparison_vectors_hash'] = result_funcs.get_array_hash(comparison_vectors)
+    return checkpoint_metadata
+
+def get_streaming_curvatures_from_target_comparison_vectors(model, target_vectors, comparison_vectors, act_func, kwargs):
+    """
+    Same as get_curvatures_from_target_comparison_vectors, except projection matrices & response images are
+    computed one plane at a time and each finished response image is written to a preallocated array on disk.
+    Peak memory is bounded by one model batch instead of the full experiment.
+    Curvature fits are computed by kwargs['num_fit_workers'] processes concurrently with the model forward passes.
+    The response images & curvatures are written to kwargs['result_directory'] using utils/result_storage
+    and flushed to disk after each target is complete. If kwargs['resume'] is True, then (target, plane)
+    cells that were marked complete by a previous run are skipped, as long as that run used the same
+    experiment parameters & vectors (see get_checkpoint_metadata()). Otherwise a new run is started.
+    """
+    proj_datapoints, x_pts, y_pts = iso_data.get_datamesh((kwargs['y_range'], kwargs['x_range']), kwargs['num_images'])
+    contour_dataset = {'proj_datapoints': proj_datapoints, 'x_pts': x_pts, 'y_pts': y_pts}
     num_neurons = len(target_vectors)
-    num_planes = len(comparison_vectors)
+    num_planes = len(comparison_vectors[0])
     num_edge_images = int(np.sqrt(kwargs['num_images']))
-    response_images = np.zeros((num_neurons, num_planes, num_edge_images, num_edge_images))
-    all_iso_curvatures = []
-    all_attn_curvatures = []
-    all_mei_lengths = []
-    for target_index, target_proj_matrix in enumerate(contour_dataset['proj_matrix']):
-        sub_mei_lengths = []
-        sub_iso_curvatures = []
-        sub_attn_curvatures = []
-        for plane_index, proj_matrix in enumerate(target_proj_matrix): # 1 plane at a time
-            datapoints = iso_data.inject_data(proj_matrix, contour_dataset['proj_datapoints'],
-                kwargs['image_scale'])
-            activations = model_funcs.get_normalized_activations(
+    result_directory = kwargs['result_directory']
+    curvature_shape = np.shape(kwargs['target_activity']) + (num_neurons, num_planes) # [(levels,) neurons, planes]
+    checkpoint_fields = [ # (field, shape, dtype, fill_value), completed goes last
+        ('response_images', (num_neurons, num_planes, num_edge_images, num_edge_images), np.float64, None),
+        ('iso_curvatures', curvature_shape, np.float64, np.nan),
+        ('attn_curvatures', curvature_shape, np.float64, np.nan),
+        ('completed', (num_neurons, num_planes), bool, False)
+    ]
+    checkpoint_metadata = get_checkpoint_metadata(target_vectors, comparison_vectors, kwargs)
+    resume = kwargs.get('resume', False)
+    if resume:
+        stored_checkpoint = result_funcs.load_index(result_directory)['metadata'].get('checkpoint')
+        if stored_checkpoint != checkpoint_metadata:
+            print('WARNING: analysis_pipeline: the experiment parameters or vectors do not match the checkpoint in '
+                +f'{result_directory}, starting a new run.')
+            resume = False
+        elif not all(result_funcs.has_result_array(result_directory, field, shape, dtype)
+                for field, shape, dtype, fill_value in checkpoint_fields):
+            print(f'WARNING: analysis_pipeline: the checkpoint in {result_directory} is incomplete, starting a new run.')
+            resume = False
+    # every field is either resumed or recreated, so completed never refers to arrays that were reset
+    checkpoint_arrays = [
+        result_funcs.open_result_array(result_directory, field, shape, dtype, fill_value=fill_value, resume=resume)
+        for field, shape, dtype, fill_value in checkpoint_fields
+    ]
+    result_funcs.update_metadata(result_directory, {'checkpoint': checkpoint_metadata})
+    response_images, all_iso_curvatures, all_attn_curvatures, completed = checkpoint_arrays
+    if np.any(completed):
+        print(f'Resuming from checkpoint with {np.count_nonzero(completed)} of {completed.size} planes complete.')
+    planes = (
+        (plane_key, kwargs['target_neuron_ids'][plane_key[0]], proj_matrix)
+        for plane_key, proj_matrix in iso_data.iterate_proj_matrices(target_vectors, comparison_vectors,
+            plane_mask=~np.asarray(completed))
+    )
+    def store_response_images(): # model stage, runs while the curvature fits from previous planes are computed
+        for plane_key, response_image in model_funcs.iterate_response_images(
                 model,
-                [kwargs['target_neuron_ids'][target_index]],
-                [[datapoints]],
-                act_func
-            )
-            response_images[target_index, plane_index, ...] = np.squeeze(activations).copy()
-            
-            
-            iso_curvatures, attn_curvatures = hist_funcs.compute_curvature_poly_fits(
-                activations,
-                contour_dataset,
-                kwargs['target_activity'],
-                bounds=kwargs['iso_window_bounds']
-                #measure_loc='right'
-                #measure_upper_right=False
-            )
-            ## Add code to measure mei length
-            #mei = kwargs['mei']
-            # mei_lengths = get_mei_lengths(mei, proj_matrix)
-            #     -- normalize mei
-            #     -- project mei using proj_matrix
-            mei_lengths = None
-            sub_mei_lengths.append(mei_lengths)
-            sub_iso_curvatures.append(iso_curvatures[0][0])
-            sub_attn_curvatures.append(attn_curvatures[0][0])
-        all_mei_lengths.append(sub_mei_lengths)
-        all_iso_curvatures.append(sub_iso_curvatures)
-        all_attn_curvatures.append(sub_attn_curvatures)
+                planes,
+                proj_datapoints,
+                act_func,
+                image_scale=kwargs['image_scale'],
+                batch_size=kwargs['batch_size'],
+                activation_function_kwargs={'compute_grad':False}):
+            response_images[plane_key] = response_image
+            yield plane_key, response_image
+    current_target_index = None
+    for (target_index, plane_index), iso_curvature, attn_curvature in hist_funcs.iterate_curvature_poly_fits(
+            store_response_images(),
+            contour_dataset,
+            kwargs['target_activity'],
+            bounds=kwargs['iso_window_bounds'],
+            num_workers=kwargs['num_fit_workers'],
+            chunk_size=kwargs['fit_chunk_size']):
+        if target_index != current_target_index: # planes arrive in order, so the previous target is finished
+            for checkpoint_array in checkpoint_arrays:
+                checkpoint_array.flush()
+            current_target_index = target_index
+        all_iso_curvatures[..., target_index, plane_index] = iso_curvature
+        all_attn_curvatures[..., target_index, plane_index] = attn_curvature
+        completed[target_index, plane_index] = True
+    for checkpoint_array in checkpoint_arrays:
+        checkpoint_array.flush()
+    all_mei_lengths = [[None for plane_index in range(num_planes)] for target_index in range(num_neurons)]
     out_dict = {
         'mei_lengths':all_mei_lengths,
         'contour_dataset':contour_dataset,
@@ -117,7 +174,11 @@ def get_curvatures_from_exciting_vectors(model, exciting_vectors, act_func, kwar
     target_vectors = iso_vectors[1]
     comparison_vectors = iso_vectors[2]
     kwargs['mei'] = exciting_vectors
-    out_dict = get_curvatures_from_target_comparison_vectors(
+    if kwargs.get('streaming', False):
+        curvature_function = get_streaming_curvatures_from_target_comparison_vectors
+    else:
+        curvature_function = get_curvatures_from_target_comparison_vectors
+    out_dict = curvature_function(
         model,
         target_vectors,
         comparison_vectors,
@@ -129,73 +190,124 @@ def get_curvatures_from_exciting_vectors(model, exciting_vectors, act_func, kwar
     out_dict['comparison_vectors'] = comparison_vectors
     return out_dict
 
-if not os.path.exists(experiment_params['output_directory']):
-    os.makedirs(experiment_params['output_directory'])
-np.savez(experiment_params['output_directory']+experiment_params['save_prefix']+'meis_params.npz',
-    data=experiment_params)
-
-model = santi_utils.load_model()
-
-"""
-Maximum Exciting Images
-"""
-comp_results = get_curvatures_from_exciting_vectors(
-    model,
-    neuron_mei,
-    santi_utils.get_activations_cell,
-    experiment_params
-)
-np.savez(experiment_params['output_directory']+experiment_params['save_prefix']+'meis.npz',
-    data=comp_results)
-print('Maximum exciting images experiment complete.')
-
-#"""
-#Random planes from MEIs
-#"""
-#iso_vectors = iso_data.compute_rand_vectors(
-#    [neuron_mei[idx] for idx in experiment_params['target_neuron_ids']],
-#    experiment_params['num_comparisons']
-#)
-#target_vectors = iso_vectors[0]
-#orth_vectors = iso_vectors[1]
-#comp_results = get_curvatures_from_target_comparison_vectors(
-#    model,
-#    target_vectors,
-#    orth_vectors,
-#    santi_utils.get_activations_cell,
-#    experiment_params
-#)
-#comp_results['target_vectors'] = target_vectors
-#comp_results['comparison_vectors'] = orth_vectors
-#np.savez(experiment_params['output_directory']+experiment_params['save_prefix']+'rand.npz',
-#    data=comp_results)
-#print('Random plane experiment complete.')
-
-#"""
-#Maximum Exciting Stimuli
-#"""
-#iid_stim_images = np.squeeze(model.data.train()[0])
-#num_stim = iid_stim_images.shape[0]
-#stim_activity = santi_utils.get_activations(model, iid_stim_images)
-#stim_argsort = np.argsort(stim_activity, axis=0)
-#neuron_mes = [] # most exciting stimulus
-#for neuron_idx in range(total_num_neurons):
-#    most_exciting_stim = iid_stim_images[stim_argsort[0, neuron_idx], ...]
-#    most_exciting_stim = iso_data.normalize_vector(most_exciting_stim)
-#    neuron_mes.append(most_exciting_stim)
-#del iid_stim_images
-#"""
-#### PROBLEM - Some neurons have the same exciting stim.
-#If this is the case we should assign the second most exciting stim.
-#But then we have an assignment problem...
-#Not sure what to do here.
-#"""
-#comp_results = get_curvatures_from_exciting_vectors(
-#    model,
-#    neuron_mes,
-#    santi_utils.get_activations_cell,
-#    experiment_params
-#)
-#np.savez(experiment_params['output_directory']+experiment_params['save_prefix']+'stim.npz',
-#    data=comp_results)
-#print('Maximum exciting stimuli experiment complete.')
+def save_curvature_results(result_directory, results, experiment_params):
+    """
+    Save results with one memory-mapped array file per field, see utils/result_storage.load_results()
+    """
+    contour_dataset = results['contour_dataset']
+    result_fields = {
+        'response_images': results['response_images'],
+        'iso_curvatures': results['iso_curvatures'],
+        'attn_curvatures': results['attn_curvatures'],
+        'proj_matrix': contour_dataset.get('proj_matrix'),
+        'proj_datapoints': contour_dataset['proj_datapoints'],
+        'x_pts': contour_dataset['x_pts'],
+        'y_pts': contour_dataset['y_pts'],
+        'comparison_vector_ids': results.get('comparison_vector_ids'),
+        'target_vectors': results.get('target_vectors'),
+        'comparison_vectors': results.get('comparison_vectors'),
+    }
+    result_funcs.save_results(result_directory, result_fields, metadata=result_funcs.get_json_metadata(experiment_params))
+
+if __name__ == '__main__':
+    from santi_iso_response.iso_response import utils as santi_utils
+
+    # NOTE:This script uses about 19GB of memory with batch_size=100; num_images=900; num_targets=166; num_comparisons=166
+
+    with open(os.path.join(santi_etc_path, 'meis.pkl'), 'rb') as g:
+        mei = pickle.load(g)
+    num_mei = len(mei['images'])
+    neuron_mei = [mei['images'][idx] for idx in range(num_mei)]
+    target_neuron_ids = [idx for idx in range(num_mei) if mei['performance'][idx] > 0.01]
+    total_num_neurons = len(neuron_mei)
+
+    experiment_params = dict()
+    experiment_params['batch_size'] = 100
+    experiment_params['target_neuron_ids'] = target_neuron_ids
+    experiment_params['num_comparisons'] = len(target_neuron_ids)
+    experiment_params['min_angle'] = 15
+    experiment_params['x_range'] = (-2.0, 2.0)
+    experiment_params['y_range'] = (-2.0, 2.0)
+    experiment_params['num_images'] = int(30**2)
+    experiment_params['image_scale'] = 12
+    experiment_params['target_activity'] = 0.5 # a list of levels gives curvatures with shape [levels, neurons, planes]
+    experiment_params['iso_window_bounds'] = ((-1, 1), (-1, 1))
+    experiment_params['comp_method'] = 'closest'
+    experiment_params['output_directory'] = parent_path+'/iso_analysis/'
+    experiment_params['save_prefix'] = 'santi_windowed_'
+    experiment_params['result_directory'] = (experiment_params['output_directory']
+        +experiment_params['save_prefix']+'meis/') # one memory-mapped .npy file per result field
+    experiment_params['streaming'] = True # if True, response images are written to disk one plane at a time
+    experiment_params['resume'] = False # if True, continue a streaming run from its last checkpoint
+    experiment_params['num_fit_workers'] = 4 # processes that compute curvature fits while the model produces response images
+    experiment_params['fit_chunk_size'] = 64 # number of response images sent to a fit worker at a time
+
+    if not os.path.exists(experiment_params['output_directory']):
+        os.makedirs(experiment_params['output_directory'])
+    np.savez(experiment_params['output_directory']+experiment_params['save_prefix']+'meis_params.npz',
+        data=experiment_params)
+
+    model = santi_utils.load_model()
+
+    """
+    Maximum Exciting Images
+    """
+    comp_results = get_curvatures_from_exciting_vectors(
+        model,
+        neuron_mei,
+        santi_utils.get_activations_cell,
+        experiment_params
+    )
+    save_curvature_results(experiment_params['result_directory'], comp_results, experiment_params)
+    print('Maximum exciting images experiment complete.')
+
+    #"""
+    #Random planes from MEIs
+    #"""
+    #iso_vectors = iso_data.compute_rand_vectors(
+    #    [neuron_mei[idx] for idx in experiment_params['target_neuron_ids']],
+    #    experiment_params['num_comparisons']
+    #)
+    #target_vectors = iso_vectors[0]
+    #orth_vectors = iso_vectors[1]
+    #comp_results = get_curvatures_from_target_comparison_vectors(
+    #    model,
+    #    target_vectors,
+    #    orth_vectors,
+    #    santi_utils.get_activations_cell,
+    #    experiment_params
+    #)
+    #comp_results['target_vectors'] = target_vectors
+    #comp_results['comparison_vectors'] = orth_vectors
+    #np.savez(experiment_params['output_directory']+experiment_params['save_prefix']+'rand.npz',
+    #    data=comp_results)
+    #print('Random plane experiment complete.')
+
+    #"""
+    #Maximum Exciting Stimuli
+    #"""
+    #iid_stim_images = np.squeeze(model.data.train()[0])
+    #num_stim = iid_stim_images.shape[0]
+    #stim_activity = santi_utils.get_activations(model, iid_stim_images)
+    #stim_argsort = np.argsort(stim_activity, axis=0)
+    #neuron_mes = [] # most exciting stimulus
+    #for neuron_idx in range(total_num_neurons):
+    #    most_exciting_stim = iid_stim_images[stim_argsort[0, neuron_idx], ...]
+    #    most_exciting_stim = iso_data.normalize_vector(most_exciting_stim)
+    #    neuron_mes.append(most_exciting_stim)
+    #del iid_stim_images
+    #"""
+    #### PROBLEM - Some neurons have the same exciting stim.
+    #If this is the case we should assign the second most exciting stim.
+    #But then we have an assignment problem...
+    #Not sure what to do here.
+    #"""
+    #comp_results = get_curvatures_from_exciting_vectors(
+    #    model,
+    #    neuron_mes,
+    #    santi_utils.get_activations_cell,
+    #    experiment_params
+    #)
+    #np.savez(experiment_params['output_directory']+experiment_params['save_prefix']+'stim.npz',
+    #    data=comp_results)
+    #print('Maximum exciting stimuli experiment complete.')
@@ -0,0 +1,133 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+PIPELINE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+if PIPELINE_DIR not in sys.path: sys.path.append(PIPELINE_DIR)
+
+import analysis_pipeline
+import response_contour_analysis.utils.model_handling as model_utils
+
+import pytest
+
+
+class ToyModel(torch.nn.Module):
+    """Neurons with curved iso-response surfaces, out = w.x + (v.x)^2"""
+    def __init__(self, num_neurons=3, image_edge=6, seed=0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        data_length = image_edge**2
+        self.linear_weights = torch.nn.Parameter(torch.randn(num_neurons, data_length, generator=generator))
+        self.quadratic_weights = torch.nn.Parameter(torch.randn(num_neurons, data_length, generator=generator) / 4)
+
+    def forward(self, x):
+        x = x.reshape(x.shape[0], -1)
+        return torch.matmul(x, self.linear_weights.T) + torch.matmul(x, self.quadratic_weights.T)**2
+
+
+def get_experiment(result_directory, num_targets=2, num_comparisons=3, image_edge=6, seed=0):
+    rng = np.random.default_rng(seed)
+    data_length = image_edge**2
+    target_vectors = [rng.normal(size=data_length) for _ in range(num_targets)]
+    target_vectors = [vector / np.linalg.norm(vector) for vector in target_vectors]
+    comparison_vectors = [rng.normal(size=(num_comparisons, data_length)) for _ in range(num_targets)]
+    experiment_params = {
+        'batch_size': 7, # does not divide num_images, so batches span planes
+        'target_neuron_ids': [0, 2],
+        'x_range': (-2.0, 2.0),
+        'y_range': (-2.0, 2.0),
+        'num_images': int(12**2),
+        'image_scale': 1.0,
+        'target_activity': 0.5,
+        'iso_window_bounds': ((-1, 1), (-1, 1)),
+        'result_directory': str(result_directory),
+        'resume': False,
+        'num_fit_workers': 0,
+        'fit_chunk_size': 2
+    }
+    model = ToyModel(num_neurons=3, image_edge=image_edge).double()
+    return model, target_vectors, comparison_vectors, experiment_params
+
+
+def act_func(model, datapoints, neuron_indices, compute_grad=False):
+    return model_utils.unit_activation(model, datapoints.astype(np.float64), neuron_indices, compute_grad=compute_grad)
+
+
+def test_streaming_matches_batched(tmp_path):
+    model, target_vectors, comparison_vectors, experiment_params = get_experiment(tmp_path / 'results')
+    results = analysis_pipeline.get_curvatures_from_target_comparison_vectors(
+        model, target_vectors, comparison_vectors, act_func, experiment_params)
+    streaming_results = analysis_pipeline.get_streaming_curvatures_from_target_comparison_vectors(
+        model, target_vectors, comparison_vectors, act_func, experiment_params)
+    assert np.any(np.isfinite(results['iso_curvatures']))
+    assert np.any(np.isfinite(results['attn_curvatures']))
+    for key in ['response_images', 'iso_curvatures', 'attn_curvatures']:
+        assert streaming_results[key].shape == results[key].shape
+        np.testing.assert_allclose(np.asarray(streaming_results[key]), results[key], rtol=1e-10, atol=1e-12)
+    for key in ['proj_datapoints', 'x_pts', 'y_pts']:
+        np.testing.assert_allclose(streaming_results['contour_dataset'][key], results['contour_dataset'][key])
+
+
+class InterruptingActivation(object):
+    """Activation function that raises after a fixed number of calls, to simulate an interrupted run"""
+    def __init__(self, max_calls=None):
+        self.max_calls = max_calls
+        self.num_calls = 0
+
+    def __call__(self, model, datapoints, neuron_indices, compute_grad=False):
+        if self.max_calls is not None and self.num_calls >= self.max_calls:
+            raise KeyboardInterrupt
+        self.num_calls += 1
+        return act_func(model, datapoints, neuron_indices, compute_grad)
+
+
+def test_streaming_resume(tmp_path, capsys):
+    model, target_vectors, comparison_vectors, experiment_params = get_experiment(tmp_path / 'results')
+    full_act_func = InterruptingActivation()
+    reference_params = dict(experiment_params, result_directory=str(tmp_path / 'reference'))
+    reference_results = analysis_pipeline.get_streaming_curvatures_from_target_comparison_vectors(
+        model, target_vectors, comparison_vectors, full_act_func, reference_params)
+    # interrupt the run after the first target is complete
+    with pytest.raises(KeyboardInterrupt):
+        analysis_pipeline.get_streaming_curvatures_from_target_comparison_vectors(
+            model, target_vectors, comparison_vectors, InterruptingActivation(full_act_func.num_calls * 3 // 4),
+            experiment_params)
+    resume_params = dict(experiment_params, resume=True)
+    resume_act_func = InterruptingActivation()
+    resumed_results = analysis_pipeline.get_streaming_curvatures_from_target_comparison_vectors(
+        model, target_vectors, comparison_vectors, resume_act_func, resume_params)
+    assert 'Resuming from checkpoint' in capsys.readouterr().out
+    assert 0 < resume_act_func.num_calls < full_act_func.num_calls
+    for key in ['response_images', 'iso_curvatures', 'attn_curvatures']:
+        np.testing.assert_allclose(np.asarray(resumed_results[key]), np.asarray(reference_results[key]))
+    # changing the parameters must start a new run instead of reusing the completed planes
+    changed_params = dict(resume_params, target_activity=[0.5, 0.6])
+    changed_act_func = InterruptingActivation()
+    changed_results = analysis_pipeline.get_streaming_curvatures_from_target_comparison_vectors(
+        model, target_vectors, comparison_vectors, changed_act_func, changed_params)
+    output = capsys.readouterr().out
+    assert 'do not match the checkpoint' in output
+    assert 'Resuming from checkpoint' not in output
+    assert changed_act_func.num_calls == full_act_func.num_calls
+    assert changed_results['iso_curvatures'].shape == (2,) + reference_results['iso_curvatures'].shape
+    np.testing.assert_allclose(np.asarray(changed_results['iso_curvatures'][0]), np.asarray(reference_results['iso_curvatures']))
+    # changing the vectors must also start a new run
+    changed_vectors = [vector[::-1] for vector in target_vectors]
+    analysis_pipeline.get_streaming_curvatures_from_target_comparison_vectors(
+        model, changed_vectors, comparison_vectors, InterruptingActivation(), changed_params)
+    assert 'do not match the checkpoint' in capsys.readouterr().out
+
+
+def test_exciting_vectors_without_streaming_key(tmp_path):
+    model, target_vectors, comparison_vectors, experiment_params = get_experiment(tmp_path / 'results')
+    rng = np.random.default_rng(1)
+    exciting_vectors = [rng.normal(size=(6, 6)) for _ in range(4)]
+    experiment_params.update({'min_angle': 5, 'num_comparisons': 1, 'comp_method': 'closest'})
+    assert 'streaming' not in experiment_params # parameter sets from before streaming was added
+    results = analysis_pipeline.get_curvatures_from_exciting_vectors(model, exciting_vectors, act_func, experiment_params)
+    assert results['response_images'].shape == (2, 1, 12, 12)
+    assert not os.path.exists(experiment_params['result_directory']) # the in-memory path was used
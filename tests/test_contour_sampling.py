@@ -0,0 +1,211 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+
+import response_contour_analysis.utils.dataset_generation as data_utils
+import response_contour_analysis.utils.histogram_analysis as hist_utils
+import response_contour_analysis.utils.model_handling as model_utils
+import response_contour_analysis.utils.contour_sampling as sampling_utils
+
+import pytest
+
+
+def get_parabolic_response_function(curvatures, offsets):
+    """ the level sets of each plane's response are the parabolas x = curvature * y^2 + constant """
+    def plane_response_function(plane_ids, proj_points):
+        x_pts, y_pts = proj_points[:, 0], proj_points[:, 1]
+        return 1 / (1 + np.exp(-3 * (x_pts - curvatures[plane_ids] * y_pts**2 - offsets[plane_ids])))
+    return plane_response_function
+
+
+def linear_activations(model, images, neuron_ids, compute_grad=False):
+    with torch.no_grad():
+        return model(torch.from_numpy(images)).numpy()[:, neuron_ids]
+
+
+def test_plane_point_activations():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(16, 3), torch.nn.Tanh())
+    rng = np.random.default_rng(0)
+    proj_matrices = np.stack([data_utils.get_proj_matrix(rng.normal(size=16), rng.normal(size=16))
+        for plane_index in range(4)], axis=0)
+    neuron_indices = [0, 2, 1, 2]
+    proj_datapoints, x_pts, y_pts = data_utils.get_datamesh(((-2, 2), (-2, 2)), 25)
+    planes = [(plane_index, neuron_indices[plane_index], proj_matrices[plane_index]) for plane_index in range(4)]
+    response_images = dict(model_utils.iterate_response_images(model, planes, proj_datapoints, linear_activations,
+        image_scale=2.0, batch_size=7, normalize=False))
+    plane_ids = np.repeat(np.arange(4), len(proj_datapoints))
+    activations = model_utils.get_plane_point_activations(model, proj_matrices, neuron_indices, plane_ids,
+        np.tile(proj_datapoints, (4, 1)), linear_activations, image_scale=2.0, batch_size=7)
+    for plane_index in range(4):
+        np.testing.assert_allclose(activations[plane_ids == plane_index],
+            response_images[plane_index].reshape(-1), rtol=1e-5, atol=1e-6)
+
+
+def test_adaptive_iso_response_curvatures():
+    curvatures = np.array([0.3, -0.2, 0.0, 0.1])
+    offsets = np.array([0.5, 0.8, 0.6, 0.7])
+    plane_response_function = get_parabolic_response_function(curvatures, offsets)
+    estimated_curvatures, contour_pts, point_offsets, num_evaluations = sampling_utils.adaptive_iso_response_curvatures(
+        plane_response_function, len(curvatures), ((-1, 1), (-1, 1)), 0.5, num_coarse=9, tolerance=0.01)
+    np.testing.assert_allclose(estimated_curvatures, curvatures, atol=5e-3)
+    assert num_evaluations < len(curvatures) * 100**2 / 4
+    plane_ids = np.repeat(np.arange(len(curvatures)), np.diff(point_offsets))
+    levels = plane_response_function(plane_ids, contour_pts[:, ::-1])
+    assert np.all(np.abs(np.diff(np.unique(np.round(levels, 2)))) < 0.05) # all points lie near one level per plane
+
+
+def test_ray_iso_response_curvatures():
+    curvatures = np.array([0.3, -0.2, 0.0, 0.1])
+    offsets = np.array([0.5, 0.8, 0.6, 0.7])
+    plane_response_function = get_parabolic_response_function(curvatures, offsets)
+    estimated_curvatures, contour_pts, point_offsets, num_evaluations = sampling_utils.ray_iso_response_curvatures(
+        plane_response_function, len(curvatures), ((-1, 1), (-1, 1)), 0.5, num_rays=15, tolerance=1e-6)
+    np.testing.assert_allclose(estimated_curvatures, curvatures, atol=1e-4)
+    assert np.all(np.diff(point_offsets) == 15) # one crossing per ray
+    for plane_id in range(len(curvatures)):
+        plane_pts = contour_pts[point_offsets[plane_id]:point_offsets[plane_id+1]]
+        plane_values = plane_response_function(np.full(len(plane_pts), plane_id), plane_pts[:, ::-1])
+        assert np.ptp(plane_values) < 1e-5 # every ray converged to the same level
+
+
+def get_parabolic_response_and_gradient_function(curvatures, offsets):
+    def plane_response_and_gradient_function(plane_ids, proj_points, compute_grad=True):
+        x_pts, y_pts = proj_points[:, 0], proj_points[:, 1]
+        values = 1 / (1 + np.exp(-3 * (x_pts - curvatures[plane_ids] * y_pts**2 - offsets[plane_ids])))
+        if not compute_grad:
+            return values
+        scale = 3 * values * (1 - values)
+        gradients = np.stack((scale, -2 * scale * curvatures[plane_ids] * y_pts), axis=1)
+        return values, gradients
+    return plane_response_and_gradient_function
+
+
+def test_walker_iso_response_curvatures():
+    curvatures = np.array([0.3, -0.2, 0.0, 0.1])
+    offsets = np.array([0.5, 0.8, 0.6, 0.7])
+    plane_function = get_parabolic_response_and_gradient_function(curvatures, offsets)
+    estimated_curvatures, contour_pts, point_offsets, num_evaluations = sampling_utils.walker_iso_response_curvatures(
+        plane_function, len(curvatures), ((-1, 1), (-1, 1)), 0.5, step_size=0.05)
+    np.testing.assert_allclose(estimated_curvatures, curvatures, atol=1e-4)
+    for plane_id in range(len(curvatures)):
+        plane_pts = contour_pts[point_offsets[plane_id]:point_offsets[plane_id+1]]
+        plane_values, plane_gradients = plane_function(np.full(len(plane_pts), plane_id), plane_pts[:, ::-1])
+        assert np.ptp(plane_values) < 1e-5
+        step_lengths = np.linalg.norm(np.diff(plane_pts, axis=0), axis=1)
+        np.testing.assert_allclose(step_lengths, 0.05, rtol=0.05) # points are spaced evenly along the contour
+
+
+def test_walker_closed_contour():
+    def plane_response_and_gradient_function(plane_ids, proj_points, compute_grad=True): # circular level sets
+        values = np.exp(-np.sum(proj_points**2, axis=1))
+        if not compute_grad:
+            return values
+        return values, -2 * values[:, None] * proj_points
+    contour_pts, point_offsets, num_evaluations = sampling_utils.get_walker_contour_points(
+        plane_response_and_gradient_function, 1, ((-2, 2), (-2, 2)), 0.5, step_size=0.05)
+    radii = np.linalg.norm(contour_pts, axis=1)
+    np.testing.assert_allclose(radii, radii[0], rtol=1e-4)
+    assert len(contour_pts) == pytest.approx(2 * np.pi * radii[0] / 0.05, abs=2) # the loop is walked once
+
+
+def test_plane_point_activations_and_gradients():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(16, 8), torch.nn.Tanh(), torch.nn.Linear(8, 3))
+    rng = np.random.default_rng(0)
+    proj_matrices = np.stack([data_utils.get_proj_matrix(rng.normal(size=16), rng.normal(size=16))
+        for plane_index in range(3)], axis=0)
+    neuron_indices = [0, 2, 1]
+    plane_ids = rng.integers(0, 3, size=10)
+    proj_points = rng.uniform(-1, 1, size=(10, 2))
+    activation_calls = []
+    def recorded_unit_activation(model, images, neuron_index, compute_grad=True):
+        activation_calls.append((neuron_index, compute_grad))
+        return model_utils.unit_activation(model, images, neuron_index, compute_grad)
+    activations, plane_gradients = model_utils.get_plane_point_activations_and_gradients(model, proj_matrices,
+        neuron_indices, plane_ids, proj_points, recorded_unit_activation, image_scale=2.0, batch_size=4)
+    assert all(isinstance(neuron_index, int) and compute_grad for neuron_index, compute_grad in activation_calls)
+    expected_activations = model_utils.get_plane_point_activations(model, proj_matrices, neuron_indices, plane_ids,
+        proj_points, linear_activations, image_scale=2.0)
+    np.testing.assert_allclose(activations, expected_activations, rtol=1e-5, atol=1e-6)
+    epsilon = 1e-2
+    for axis in range(2):
+        step = np.zeros(2); step[axis] = epsilon
+        finite_difference = (model_utils.get_plane_point_activations(model, proj_matrices, neuron_indices, plane_ids,
+            proj_points + step, linear_activations, image_scale=2.0) - model_utils.get_plane_point_activations(model,
+            proj_matrices, neuron_indices, plane_ids, proj_points - step, linear_activations, image_scale=2.0)) / (2 * epsilon)
+        np.testing.assert_allclose(plane_gradients[:, axis], finite_difference, rtol=1e-2, atol=1e-3)
+
+
+def test_walker_coarse_grid_is_forward_only():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(16, 8), torch.nn.Tanh(), torch.nn.Linear(8, 3))
+    rng = np.random.default_rng(1)
+    proj_matrices = np.stack([data_utils.get_proj_matrix(rng.normal(size=16), rng.normal(size=16))
+        for plane_index in range(2)], axis=0)
+    activation_calls = []
+    def recorded_unit_activation(model, images, neuron_index, compute_grad=True):
+        activation_calls.append((type(images), len(images), compute_grad))
+        return model_utils.unit_activation(model, images, neuron_index, compute_grad)
+    plane_function = sampling_utils.get_plane_response_and_gradient_function(model, proj_matrices, [0, 2],
+        recorded_unit_activation, image_scale=2.0, batch_size=1000)
+    contour_pts, point_offsets, num_evaluations = sampling_utils.get_walker_contour_points(plane_function, 2,
+        ((-1, 1), (-1, 1)), 0.5, step_size=0.1, num_coarse=9, max_steps=3)
+    # the coarse grid is the first batch, and it is evaluated without gradients
+    assert activation_calls[0] == (np.ndarray, 9**2, False)
+    assert activation_calls[1] == (np.ndarray, 9**2, False)
+    assert all(compute_grad for images_type, num_images, compute_grad in activation_calls[2:])
+    values = plane_function(np.repeat(np.arange(2), 4), rng.uniform(-1, 1, size=(8, 2)), compute_grad=False)
+    assert values.shape == (8,)
+
+
+class QuadraticModel(torch.nn.Module):
+    """Neurons with curved iso-response surfaces, out = tanh((w.x + (v.x)^2) / 4)"""
+    def __init__(self, data_length=16, num_neurons=2, seed=0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.linear_weights = torch.nn.Parameter(torch.randn(num_neurons, data_length, generator=generator))
+        self.quadratic_weights = torch.nn.Parameter(torch.randn(num_neurons, data_length, generator=generator) / 3)
+
+    def forward(self, x):
+        x = x.reshape(x.shape[0], -1)
+        return torch.tanh((torch.matmul(x, self.linear_weights.T) + torch.matmul(x, self.quadratic_weights.T)**2) / 4)
+
+
+def double_activations(model, images, neuron_index, compute_grad=False):
+    images = images.astype(np.float64) if isinstance(images, np.ndarray) else images.double()
+    return model_utils.unit_activation(model, images, neuron_index, compute_grad)
+
+
+def test_sampled_curvatures_match_dense_fits():
+    model = QuadraticModel().double()
+    rng = np.random.default_rng(3)
+    num_targets, num_comparisons = 2, 3
+    target_vectors = [rng.normal(size=16) for _ in range(num_targets)]
+    comparison_vectors = [[rng.normal(size=16) for _ in range(num_comparisons)] for _ in range(num_targets)]
+    yx_range = ((-2, 2), (-2, 2))
+    bounds = ((-1, 1), (-1, 1))
+    contour_dataset = data_utils.get_contour_dataset(target_vectors, comparison_vectors, yx_range, 80**2)
+    target_model_ids = [0, 1]
+    activations = model_utils.get_contour_dataset_activations(model, contour_dataset['all_datapoints'], target_model_ids,
+        double_activations)
+    dense_curvatures = hist_utils.compute_curvature_poly_fits(activations[0], contour_dataset, 0.5, bounds=bounds)[0]
+    proj_matrices = np.stack([proj_matrix for target_proj_matrices in contour_dataset['proj_matrix']
+        for proj_matrix in target_proj_matrices], axis=0)
+    neuron_indices = np.repeat(target_model_ids, num_comparisons)
+    num_planes = len(proj_matrices)
+    plane_function = sampling_utils.get_plane_response_function(model, proj_matrices, neuron_indices, double_activations)
+    plane_gradient_function = sampling_utils.get_plane_response_and_gradient_function(model, proj_matrices,
+        neuron_indices, double_activations)
+    for curvatures, contour_pts, point_offsets, num_evaluations in [
+            sampling_utils.adaptive_iso_response_curvatures(plane_function, num_planes, yx_range, 0.5, bounds=bounds),
+            sampling_utils.ray_iso_response_curvatures(plane_function, num_planes, yx_range, 0.5, bounds=bounds),
+            sampling_utils.walker_iso_response_curvatures(plane_gradient_function, num_planes, yx_range, 0.5, bounds=bounds)]:
+        assert np.all(np.abs(contour_pts) <= 1 + 1e-6) # points are only sampled within the bounds window
+        assert num_evaluations < num_planes * 80**2
+        np.testing.assert_allclose(curvatures.reshape(num_targets, num_comparisons), dense_curvatures, rtol=0.1, atol=2e-3)
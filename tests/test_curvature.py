@@ -215,3 +215,203 @@ def test_bad_condition(dimensions, radius):
         expected_curvatures,
         rtol=1e-6,
     )
+
+
+def test_autodiff_grad_hess_field():
+    a = 1
+    c = 3
+    x_vals, y_vals = curve_utils.hyperboloid_mesh(a, c, step_size=0.5, num_points=6)
+    grad, hess = curve_utils.autodiff_grad_hess(x_vals, y_vals, a, c, torch.double, DEVICE)
+    assert grad.shape == x_vals.shape + (2,)
+    assert hess.shape == x_vals.shape + (4,)
+    for x_idx in range(x_vals.shape[0]):
+        for y_idx in range(x_vals.shape[1]):
+            pt_grad, pt_hess = curve_utils.autodiff_pt_grad_hess(x_vals[x_idx, y_idx], y_vals[x_idx, y_idx], a, c,
+                torch.double, DEVICE)
+            np.testing.assert_allclose(grad[x_idx, y_idx].cpu().numpy(), pt_grad.detach().cpu().numpy(), rtol=1e-10)
+            np.testing.assert_allclose(hess[x_idx, y_idx].cpu().numpy(), pt_hess.detach().cpu().numpy(), rtol=1e-10)
+
+
+def test_batched_graph_curvature():
+    rng = np.random.default_rng(0)
+    batch_size, dimensions = 8, 5
+    grad = torch.tensor(rng.normal(size=(batch_size, dimensions)), dtype=torch.double, device=DEVICE)
+    hess = rng.normal(size=(batch_size, dimensions, dimensions))
+    hess = torch.tensor(hess + hess.transpose(0, 2, 1), dtype=torch.double, device=DEVICE)
+    shape_operators = curve_utils.get_shape_operator_graph(grad, hess)
+    principal_curvatures, principal_directions = curve_utils.get_principal_curvatures(shape_operators)
+    gauss_curvature, mean_curvature = curve_utils.local_response_gauss_mean_curvature_graph(grad, hess)
+    for index in range(batch_size):
+        pt_shape_operator, pt_curvatures, pt_directions = curve_utils.local_response_curvature_graph(grad[index], hess[index])
+        np.testing.assert_allclose(shape_operators[index].cpu().numpy(), pt_shape_operator.cpu().numpy(), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(principal_curvatures[index].cpu().numpy(), pt_curvatures.cpu().numpy(), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(np.abs(principal_directions[index].cpu().numpy()), np.abs(pt_directions.cpu().numpy()),
+            rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(gauss_curvature[index].item(), np.prod(pt_curvatures.cpu().numpy()), rtol=1e-10)
+        np.testing.assert_allclose(mean_curvature[index].item(), np.mean(pt_curvatures.cpu().numpy()), rtol=1e-10)
+
+
+@pytest.mark.parametrize("so_type", ['moosavi', 'golden', 'poole', 'lee_level', 'lee_graph'])
+def test_batched_curvature_alternates(so_type):
+    rng = np.random.default_rng(1)
+    batch_size, dimensions = 8, 5
+    grad = torch.tensor(rng.normal(size=(batch_size, dimensions)), dtype=torch.double, device=DEVICE)
+    hess = rng.normal(size=(batch_size, dimensions, dimensions))
+    hess = torch.tensor(hess + hess.transpose(0, 2, 1), dtype=torch.double, device=DEVICE)
+    shape_operators, principal_curvatures, principal_directions = curve_utils.local_response_curvature_alternates(
+        grad, hess, so_type)
+    for index in range(batch_size):
+        pt_grad = grad[index][:, None] if so_type == 'moosavi' else grad[index] # moosavi expects a column vector
+        pt_shape_operator, pt_curvatures, pt_directions = curve_utils.local_response_curvature_alternates(
+            pt_grad, hess[index], so_type)
+        np.testing.assert_allclose(principal_curvatures[index].cpu().numpy(), pt_curvatures.cpu().numpy(), rtol=1e-8, atol=1e-10)
+        if so_type == 'lee_level': # the surface basis is chosen differently, so only the spectrum is comparable
+            np.testing.assert_allclose(torch.linalg.matrix_norm(shape_operators[index]).item(),
+                torch.linalg.matrix_norm(pt_shape_operator).item(), rtol=1e-8)
+        else:
+            np.testing.assert_allclose(shape_operators[index].cpu().numpy(), pt_shape_operator.cpu().numpy(),
+                rtol=1e-8, atol=1e-10)
+            np.testing.assert_allclose(np.abs(principal_directions[index].cpu().numpy()),
+                np.abs(pt_directions.cpu().numpy()), rtol=1e-6, atol=1e-8)
+
+
+def test_batched_level_set_embedding():
+    rng = np.random.default_rng(2)
+    batch_size, dimensions = 6, 4
+    grad = torch.tensor(rng.normal(size=(batch_size, dimensions)), dtype=torch.double, device=DEVICE)
+    grad[0, :-1] = 0 # gradient already along the last axis
+    hess = rng.normal(size=(batch_size, dimensions, dimensions))
+    hess = torch.tensor(hess + hess.transpose(0, 2, 1), dtype=torch.double, device=DEVICE)
+    shape_operators, embedding_differentials, metric_tensors = curve_utils.get_shape_operator_level_set(grad, hess)
+    assert shape_operators.shape == (batch_size, dimensions - 1, dimensions - 1)
+    assert embedding_differentials.shape == (batch_size, dimensions, dimensions - 1)
+    # tangent vectors of the iso response surface are orthogonal to the gradient
+    tangent_dots = torch.matmul(grad[:, None, :], embedding_differentials)
+    np.testing.assert_allclose(tangent_dots.cpu().numpy(), 0, atol=1e-12)
+    np.testing.assert_allclose(torch.matmul(embedding_differentials.transpose(1, 2), embedding_differentials).cpu().numpy(),
+        metric_tensors.cpu().numpy(), atol=1e-12)
+
+
+def test_symmetric_principal_curvatures(monkeypatch):
+    rng = np.random.default_rng(3)
+    batch_size, dimensions, top_k = 4, 6, 2
+    grad = torch.tensor(rng.normal(size=(batch_size, dimensions)), dtype=torch.double, device=DEVICE)
+    hess = rng.normal(size=(batch_size, dimensions, dimensions))
+    hess = torch.tensor(hess + hess.transpose(0, 2, 1), dtype=torch.double, device=DEVICE)
+    for shape_operator, metric_tensor in [
+            curve_utils.get_shape_operator_level_set(grad, hess)[::2],
+            (curve_utils.get_shape_operator_graph(grad, hess), curve_utils._get_graph_metric_tensor(grad, batched=True))]:
+        eig_curvatures, eig_directions = curve_utils.get_principal_curvatures(shape_operator)
+        curvatures, directions = curve_utils.get_principal_curvatures(shape_operator, metric_tensor=metric_tensor)
+        np.testing.assert_allclose(curvatures.cpu().numpy(), eig_curvatures.cpu().numpy(), rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(np.abs(directions.cpu().numpy()), np.abs(eig_directions.cpu().numpy()), rtol=1e-6, atol=1e-8)
+        # directions are eigenvectors of the shape operator
+        np.testing.assert_allclose(torch.matmul(shape_operator, directions).cpu().numpy(),
+            (directions * curvatures[:, None, :]).cpu().numpy(), atol=1e-10)
+        top_curvatures, top_directions = curve_utils.get_principal_curvatures(
+            shape_operator, metric_tensor=metric_tensor, top_k=top_k)
+        assert top_directions.shape == (batch_size, shape_operator.shape[-1], top_k)
+        np.testing.assert_allclose(top_curvatures.cpu().numpy(), curvatures[:, :top_k].cpu().numpy(), rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(np.abs(top_directions.cpu().numpy()), np.abs(directions[:, :, :top_k].cpu().numpy()),
+            rtol=1e-6, atol=1e-8)
+        with pytest.raises(AssertionError):
+            curve_utils.get_principal_curvatures(shape_operator, top_k=top_k) # no partial solver for eig
+    # the symmetric solvers are opt-in, and give the same curvatures as the default eig
+    for so_type in ['moosavi', 'golden', 'poole', 'lee_level', 'lee_graph']:
+        pt_grad = grad[0][:, None] if so_type == 'moosavi' else grad[0]
+        eig_curvatures = curve_utils.local_response_curvature_alternates(pt_grad, hess[0], so_type)[1]
+        metric_curvatures = curve_utils.local_response_curvature_alternates(pt_grad, hess[0], so_type, use_metric=True)[1]
+        top_curvatures = curve_utils.local_response_curvature_alternates(
+            pt_grad, hess[0], so_type, use_metric=True, top_k=top_k)[1]
+        np.testing.assert_allclose(metric_curvatures.cpu().numpy(), eig_curvatures.cpu().numpy(), rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(top_curvatures.cpu().numpy(), eig_curvatures[:top_k].cpu().numpy(), rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(curve_utils.local_response_curvature_level_set(grad[0], hess[0], use_metric=True)[1].cpu().numpy(),
+        curve_utils.local_response_curvature_level_set(grad[0], hess[0])[1].cpu().numpy(), rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(curve_utils.local_response_curvature_graph(grad[0], hess[0], use_metric=True)[1].cpu().numpy(),
+        curve_utils.local_response_curvature_graph(grad[0], hess[0])[1].cpu().numpy(), rtol=1e-8, atol=1e-10)
+    # symmetric='auto' picks eigh for symmetric operators and eig otherwise
+    solver_calls = []
+    eigh, eig = torch.linalg.eigh, torch.linalg.eig
+    monkeypatch.setattr(torch.linalg, 'eigh', lambda *args, **kwargs: solver_calls.append('eigh') or eigh(*args, **kwargs))
+    monkeypatch.setattr(torch.linalg, 'eig', lambda *args, **kwargs: solver_calls.append('eig') or eig(*args, **kwargs))
+    symmetric_operator = curve_utils.get_shape_operator_poole(grad, hess)
+    symmetric_curvatures = curve_utils.get_principal_curvatures(symmetric_operator, symmetric='auto')[0]
+    assert solver_calls == ['eigh']
+    nonsymmetric_operator = curve_utils.get_shape_operator_graph(grad, hess)
+    curve_utils.get_principal_curvatures(nonsymmetric_operator, symmetric='auto')
+    assert solver_calls == ['eigh', 'eig']
+    np.testing.assert_allclose(symmetric_curvatures.cpu().numpy(),
+        curve_utils.get_principal_curvatures(symmetric_operator)[0].cpu().numpy(), rtol=1e-8, atol=1e-10)
+
+
+def cubic_function(hess, cubic_weights):
+    return lambda x: 0.5 * torch.dot(x, torch.matmul(hess, x)) + torch.sum(cubic_weights * x**3) + x.sum()
+
+
+def test_lanczos_level_set_small():
+    rng = np.random.default_rng(4)
+    dimensions = 12
+    hess = rng.normal(size=(dimensions, dimensions))
+    hess = torch.tensor(hess + hess.T, dtype=torch.double, device=DEVICE)
+    cubic_weights = torch.tensor(rng.normal(size=dimensions), dtype=torch.double, device=DEVICE)
+    f = cubic_function(hess, cubic_weights)
+    point = torch.tensor(rng.normal(size=dimensions), dtype=torch.double, device=DEVICE)
+    value, pt_grad, pt_hess = value_grad_hess(f, point, torch.double)
+    dense_shape_operator, dense_curvatures, dense_directions = curve_utils.local_response_curvature_level_set(pt_grad, pt_hess)
+    curvatures, directions = curve_utils.local_response_curvature_level_set_lanczos(
+        f, point, top_k=3, bottom_k=3, num_iterations=dimensions, seed=0)
+    expected_curvatures = torch.cat((dense_curvatures[:3], dense_curvatures[-3:]))
+    expected_directions = torch.cat((dense_directions[:, :3], dense_directions[:, -3:]), dim=1)
+    np.testing.assert_allclose(curvatures.cpu().numpy(), expected_curvatures.cpu().numpy(), rtol=1e-8, atol=1e-10)
+    direction_overlaps = torch.abs(torch.sum(directions * expected_directions / torch.linalg.norm(expected_directions, dim=0), dim=0))
+    np.testing.assert_allclose(direction_overlaps.cpu().numpy(), 1, rtol=1e-6)
+    np.testing.assert_allclose(torch.matmul(pt_grad, directions).cpu().numpy(), 0, atol=1e-10)
+
+
+def test_lanczos_level_set_large():
+    rng = np.random.default_rng(5)
+    dimensions, top_k, bottom_k = 400, 2, 2
+    spectrum = np.concatenate(([12.0, 9.0, -10.0, -7.0], rng.uniform(-1, 1, size=dimensions - 4)))
+    rotation = ortho_group.rvs(dimensions, random_state=5)
+    hess = torch.tensor(rotation @ np.diag(spectrum) @ rotation.T, dtype=torch.double, device=DEVICE)
+    f = lambda x: 0.5 * torch.dot(x, torch.matmul(hess, x)) + x[0] # gradient is dominated by e_0 near the origin
+    point = torch.zeros(dimensions, dtype=torch.double, device=DEVICE)
+    value, pt_grad, pt_hess = value_grad_hess(f, point, torch.double)
+    dense_curvatures = curve_utils.local_response_curvature_level_set(pt_grad, pt_hess)[1]
+    curvatures, directions = curve_utils.local_response_curvature_level_set_lanczos(
+        f, point, top_k=top_k, bottom_k=bottom_k, seed=0)
+    assert directions.shape == (dimensions, top_k + bottom_k)
+    expected_curvatures = torch.cat((dense_curvatures[:top_k], dense_curvatures[-bottom_k:]))
+    np.testing.assert_allclose(curvatures.cpu().numpy(), expected_curvatures.cpu().numpy(), rtol=1e-6)
+
+
+def test_lanczos_residuals(capsys):
+    rng = np.random.default_rng(6)
+    dimensions = 60
+    spectrum = np.concatenate(([8.0, 6.0, -9.0, -5.0], rng.uniform(-1, 1, size=dimensions - 4)))
+    rotation = ortho_group.rvs(dimensions, random_state=6)
+    operator = torch.tensor(rotation @ np.diag(spectrum) @ rotation.T, dtype=torch.double, device=DEVICE)
+    matvec = lambda vector: torch.matmul(operator, vector)
+    initial_vector = torch.tensor(rng.normal(size=dimensions), dtype=torch.double, device=DEVICE)
+    ritz_values, ritz_vectors, residual_norms = curve_utils.lanczos_eigh(matvec, initial_vector, dimensions,
+        num_top=2, num_bottom=2, residual_tolerance=1e-8)
+    assert len(ritz_values) < dimensions # stopped once the extreme pairs converged
+    explicit_norms = torch.linalg.norm(torch.matmul(operator, ritz_vectors) - ritz_vectors * ritz_values, dim=0)
+    np.testing.assert_allclose(residual_norms.cpu().numpy(), explicit_norms.cpu().numpy(), atol=1e-10)
+    assert torch.all(residual_norms[[0, 1, -2, -1]] <= 1e-8 * 9.0)
+    np.testing.assert_allclose(ritz_values[[0, 1, -2, -1]].cpu().numpy(), [8.0, 6.0, -5.0, -9.0], rtol=1e-10)
+    # too few iterations to converge gives a warning
+    f = lambda x: 0.5 * torch.dot(x, torch.matmul(operator, x)) + x[0]
+    point = torch.zeros(dimensions, dtype=torch.double, device=DEVICE)
+    curve_utils.local_response_curvature_level_set_lanczos(f, point, top_k=2, bottom_k=2, num_iterations=5, seed=0)
+    assert 'did not converge' in capsys.readouterr().out
+    curve_utils.local_response_curvature_level_set_lanczos(f, point, top_k=2, bottom_k=2, seed=0)
+    assert 'did not converge' not in capsys.readouterr().out
+    # without a seed, the initial vector is drawn from the global random number generator
+    torch.manual_seed(0)
+    rng_state = torch.get_rng_state() if DEVICE == 'cpu' else torch.cuda.get_rng_state()
+    curvatures = curve_utils.local_response_curvature_level_set_lanczos(f, point, top_k=2, bottom_k=2)[0]
+    assert not torch.equal(torch.get_rng_state() if DEVICE == 'cpu' else torch.cuda.get_rng_state(), rng_state)
+    torch.manual_seed(0)
+    np.testing.assert_array_equal(curve_utils.local_response_curvature_level_set_lanczos(
+        f, point, top_k=2, bottom_k=2)[0].cpu().numpy(), curvatures.cpu().numpy())
@@ -0,0 +1,163 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+
+import response_contour_analysis.utils.dataset_generation as data_utils
+
+import pytest
+
+
+@pytest.mark.parametrize('shared_comparisons', [False, True])
+@pytest.mark.parametrize('num_comparisons', [1, 4])
+@pytest.mark.parametrize('explicit', [False, True])
+def test_batched_contour_dataset(shared_comparisons, num_comparisons, explicit):
+    rng = np.random.default_rng(0)
+    num_targets, vector_length = 3, 16
+    target_vectors = [rng.normal(size=vector_length) for _ in range(num_targets)]
+    if shared_comparisons:
+        comparison_vectors = [rng.normal(size=vector_length) for _ in range(num_comparisons)]
+        batched_comparison_vectors = comparison_vectors
+    else:
+        comparison_vectors = [[rng.normal(size=vector_length) for _ in range(num_comparisons)]
+            for _ in range(num_targets)]
+        # same layout as compute_comp_vectors(), a list of [num_comparisons, vector_length] arrays
+        batched_comparison_vectors = [np.stack(target_comp_vects, axis=0) for target_comp_vects in comparison_vectors]
+    yx_range = ((-2, 2), (-2, 2))
+    loop_dataset = data_utils.get_contour_dataset(target_vectors, comparison_vectors, yx_range, 25,
+        return_datapoints=False)
+    batched_dataset = data_utils.get_batched_contour_dataset(target_vectors, batched_comparison_vectors, yx_range, 25,
+        shared_comparisons=shared_comparisons if explicit else None)
+    for key in ['orth_vect', 'proj_target_vect', 'proj_comparison_vect', 'proj_orth_vect', 'proj_matrix']:
+        assert batched_dataset[key].shape[:2] == (num_targets, num_comparisons)
+        np.testing.assert_allclose(batched_dataset[key], np.array(loop_dataset[key]), atol=1e-12)
+    np.testing.assert_allclose(batched_dataset['proj_datapoints'], loop_dataset['proj_datapoints'])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1024])
+def test_all_to_all_angles(chunk_size):
+    rng = np.random.default_rng(0)
+    num_vectors, vector_length = 7, 12
+    vectors = [rng.normal(size=(3, 4)) for _ in range(num_vectors)]
+    vect_angles, angle_matrix = data_utils.all_to_all_angles(vectors, chunk_size=chunk_size)
+    indices = np.tril_indices(num_vectors, 1)
+    expected_matrix = np.zeros((num_vectors, num_vectors))
+    expected_angles = []
+    for nid0, nid1 in zip(*indices):
+        vec0 = vectors[nid0].reshape((vector_length, 1))
+        vec1 = vectors[nid1].reshape((vector_length, 1))
+        angle = data_utils.angle_between_vectors(vec0, vec1).item() * (180 / np.pi)
+        expected_angles.append(angle)
+        expected_matrix[nid0, nid1] = angle
+    expected_matrix[np.abs(expected_matrix) < 1e-5] = -1
+    np.testing.assert_allclose(vect_angles, expected_angles, atol=1e-5)
+    np.testing.assert_allclose(angle_matrix, expected_matrix, atol=1e-5)
+    normed_vectors = np.stack([vector.reshape(-1) / np.linalg.norm(vector) for vector in vectors], axis=0)
+    normed_angles, normed_matrix = data_utils.all_to_all_angles(normed_vectors, chunk_size=chunk_size, normalize=False)
+    np.testing.assert_allclose(normed_matrix, angle_matrix, atol=1e-10)
+
+
+def test_rand_orth_vectors():
+    rng = np.random.default_rng(0)
+    target_vector = rng.normal(size=30)
+    num_orth_directions = 10
+    np.random.seed(0)
+    expected_vectors = target_vector[None, :]
+    for orth_idx in range(num_orth_directions):
+        expected_vectors = np.append(expected_vectors, data_utils.find_orth_vect(expected_vectors)[None, :], axis=0)
+    np.random.seed(0)
+    rand_vectors = data_utils.get_rand_orth_vectors(target_vector, num_orth_directions)
+    np.testing.assert_allclose(rand_vectors, expected_vectors[1:, :], atol=1e-10)
+    np.testing.assert_allclose(rand_vectors @ rand_vectors.T, np.eye(num_orth_directions), atol=1e-10)
+    np.testing.assert_allclose(rand_vectors @ target_vector, 0, atol=1e-10)
+
+
+@pytest.mark.parametrize('data_shape', [None, [1, 4, 4]])
+def test_lazy_contour_datapoints(data_shape):
+    rng = np.random.default_rng(0)
+    num_targets, num_comparisons, vector_length = 2, 3, 16
+    target_vectors = [rng.normal(size=vector_length) for _ in range(num_targets)]
+    comparison_vectors = [[rng.normal(size=vector_length) for _ in range(num_comparisons)]
+        for _ in range(num_targets)]
+    yx_range = ((-2, 2), (-2, 2))
+    eager_dataset = data_utils.get_contour_dataset(target_vectors, comparison_vectors, yx_range, 25,
+        image_scale=3.0, data_shape=data_shape)
+    lazy_dataset = data_utils.get_contour_dataset(target_vectors, comparison_vectors, yx_range, 25,
+        image_scale=3.0, data_shape=data_shape, lazy_datapoints=True)
+    lazy_datapoints = lazy_dataset['all_datapoints']
+    assert isinstance(lazy_datapoints, data_utils.ContourDatapoints)
+    reused_datapoints = data_utils.ContourDatapoints(lazy_dataset['proj_matrix'], lazy_dataset['proj_datapoints'],
+        image_scale=3.0, data_shape=data_shape, reuse_buffer=True)
+    assert len(lazy_datapoints) == len(reused_datapoints) == num_targets
+    for target_index, (eager_row, lazy_row, reused_row) in enumerate(zip(eager_dataset['all_datapoints'],
+            lazy_datapoints, reused_datapoints)):
+        assert len(lazy_row) == len(reused_row) == num_comparisons
+        for comparison_index, (eager_plane, lazy_plane, reused_plane) in enumerate(zip(eager_row, lazy_row, reused_row)):
+            assert lazy_plane.shape == reused_plane.shape == eager_plane.shape
+            assert lazy_plane.dtype == reused_plane.dtype == eager_plane.dtype
+            np.testing.assert_array_equal(lazy_plane, eager_plane)
+            np.testing.assert_array_equal(reused_plane, eager_plane)
+            np.testing.assert_array_equal(lazy_datapoints[target_index, comparison_index], eager_plane)
+    # with reuse_buffer every plane is written into the same memory
+    first_plane = reused_datapoints[0, 0]
+    second_plane = reused_datapoints[1, 2]
+    assert np.shares_memory(first_plane, second_plane)
+    np.testing.assert_array_equal(first_plane, eager_dataset['all_datapoints'][1][2])
+
+
+def baseline_comp_vector_ids(all_vectors, target_vector_ids, min_angle, num_comparisons, comp_method):
+    """Comparison vector selection from before the mask & argpartition rewrite, with a full sort of the angle matrix"""
+    total_num_vectors = len(all_vectors)
+    angle_matrix = data_utils.all_to_all_angles(all_vectors)[1]
+    num_below_min = np.count_nonzero(angle_matrix < min_angle)
+    sorted_angle_indices = np.stack(np.unravel_index(np.argsort(angle_matrix.ravel()),
+        angle_matrix.shape), axis=1)[num_below_min:, :]
+    comparison_vector_ids = []
+    for target_neuron_id in target_vector_ids:
+        high_angle_neuron_ids = sorted_angle_indices[sorted_angle_indices[:, 0] == target_neuron_id, 1]
+        extra_indices = [index for index in range(total_num_vectors)
+            if index not in high_angle_neuron_ids and index != target_neuron_id]
+        sub_comparison_vector_ids = np.concatenate((high_angle_neuron_ids, np.array(extra_indices, dtype=int)))
+        if comp_method == 'closest':
+            sub_comparison_vector_ids = sub_comparison_vector_ids[:num_comparisons]
+        else:
+            shuffled_indices = np.random.choice(range(len(sub_comparison_vector_ids)), num_comparisons, replace=False)
+            sub_comparison_vector_ids = sub_comparison_vector_ids[shuffled_indices]
+        comparison_vector_ids.append(sub_comparison_vector_ids)
+    return comparison_vector_ids
+
+
+@pytest.mark.parametrize('comp_method', ['closest', 'rand'])
+@pytest.mark.parametrize('min_angle, num_comparisons', [(5, 1), (5, 4), (55, 6), (80, 6)])
+def test_compute_comp_vectors(comp_method, min_angle, num_comparisons):
+    rng = np.random.default_rng(0)
+    num_vectors = 9
+    all_vectors = [rng.normal(size=(4, 4)) + 1 for _ in range(num_vectors)] # shared offset gives a range of angles
+    target_vector_ids = [8, 3, 5]
+    np.random.seed(1)
+    expected_ids = baseline_comp_vector_ids(all_vectors, target_vector_ids, min_angle, num_comparisons, comp_method)
+    np.random.seed(1)
+    comparison_vector_ids, normed_target_vectors, comparison_vectors = data_utils.compute_comp_vectors(
+        all_vectors, target_vector_ids, min_angle, num_comparisons, comp_method)
+    for target_index, target_neuron_id in enumerate(target_vector_ids):
+        np.testing.assert_array_equal(comparison_vector_ids[target_index], expected_ids[target_index])
+        assert len(comparison_vector_ids[target_index]) == num_comparisons
+        assert target_neuron_id not in comparison_vector_ids[target_index]
+        np.testing.assert_allclose(normed_target_vectors[target_index],
+            data_utils.l2_normalize(all_vectors[target_neuron_id]))
+        expected_vectors = np.stack([all_vectors[comparison_id].reshape(-1) / np.linalg.norm(all_vectors[comparison_id])
+            for comparison_id in expected_ids[target_index]], axis=0)
+        assert comparison_vectors[target_index].shape == (num_comparisons, 16)
+        np.testing.assert_allclose(comparison_vectors[target_index], expected_vectors)
+
+
+def test_compute_comp_vectors_ties():
+    base_vector = np.zeros(6); base_vector[0] = 1
+    tied_vectors = [np.cos(np.pi/4) * base_vector + np.sin(np.pi/4) * np.eye(6)[axis] for axis in range(1, 6)]
+    all_vectors = tied_vectors + [base_vector] # every comparison vector has a 45 degree angle with the target
+    for num_comparisons in range(1, 6):
+        comparison_vector_ids = data_utils.compute_comp_vectors(all_vectors, [5], 5, num_comparisons)[0]
+        np.testing.assert_array_equal(comparison_vector_ids[0], np.arange(num_comparisons))
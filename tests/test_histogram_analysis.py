@@ -0,0 +1,218 @@
+import os
+import sys
+
+import numpy as np
+import numpy.polynomial.polynomial as poly
+from skimage import measure
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+
+import response_contour_analysis.utils.histogram_analysis as hist_funcs
+
+import pytest
+
+
+def get_curved_activations(num_neurons=3, num_planes=4, num_y=30, num_x=30, seed=0):
+    rng = np.random.default_rng(seed)
+    y_pts, x_pts = np.meshgrid(np.linspace(-2, 2, num_y), np.linspace(-2, 2, num_x), indexing='ij')
+    activations = np.zeros((num_neurons, num_planes, num_y, num_x))
+    for neuron_id in range(num_neurons):
+        for plane_id in range(num_planes):
+            curvature, offset = rng.uniform(-1, 1, 2)
+            activations[neuron_id, plane_id, ...] = 1 / (1 + np.exp(-3 * (x_pts - 0.3 * curvature * y_pts**2 - offset)))
+    return activations
+
+
+def test_iso_response_curvature_poly_fits():
+    activations = get_curved_activations()
+    yx_scale = [4 / 30, 4 / 30]
+    curvatures, fits, contours = hist_funcs.iso_response_curvature_poly_fits(activations, target=0.5, yx_scale=yx_scale)
+    assert curvatures.shape == activations.shape[:2]
+    assert fits.shape[:3] == contours.shape[:3] == activations.shape[:2] + (2,)
+    for neuron_id in range(activations.shape[0]):
+        for plane_id in range(activations.shape[1]):
+            activity = activations[neuron_id, plane_id, ...]
+            activity = (activity - activity.min()) / (activity.max() - activity.min())
+            contour = np.concatenate(measure.find_contours(activity, 0.5), axis=0)
+            y_contour_pts = contour[:, 0] * yx_scale[0] - (activity.shape[0] * yx_scale[0] / 2)
+            x_contour_pts = contour[:, 1] * yx_scale[1] - (activity.shape[1] * yx_scale[1] / 2)
+            if np.sum(x_contour_pts > 0) > 3:
+                y_contour_pts = y_contour_pts[x_contour_pts > 0]
+                x_contour_pts = x_contour_pts[x_contour_pts > 0]
+            coeffs = poly.polyfit(y_contour_pts, x_contour_pts, deg=2)
+            np.testing.assert_allclose(curvatures[neuron_id, plane_id], coeffs[-1], atol=1e-8)
+            valid_pts = ~np.isnan(contours[neuron_id, plane_id, 0, :])
+            assert np.sum(valid_pts) == len(x_contour_pts)
+
+
+def test_iso_response_curvature_poly_fits_constant_map():
+    activations = get_curved_activations(num_neurons=1, num_planes=2)
+    activations[0, 0, ...] = 0
+    curvatures, fits, contours = hist_funcs.iso_response_curvature_poly_fits(activations, target=0.5)
+    assert np.isnan(curvatures[0, 0])
+    assert np.all(np.isnan(contours[0, 0, ...]))
+    assert not np.isnan(curvatures[0, 1])
+
+
+def test_quadratic_poly_fits():
+    rng = np.random.default_rng(1)
+    num_groups = 6
+    num_points = rng.integers(3, 20, size=num_groups)
+    group_ids = np.repeat(np.arange(num_groups), num_points)
+    x_vals = rng.normal(size=len(group_ids))
+    y_vals = rng.normal(size=len(group_ids))
+    coeffs, fit_vals = hist_funcs.quadratic_poly_fits(x_vals, y_vals, group_ids=group_ids, num_groups=num_groups)
+    for group_id in range(num_groups):
+        group_pts = group_ids == group_id
+        expected_coeffs = poly.polyfit(x_vals[group_pts], y_vals[group_pts], deg=2)
+        np.testing.assert_allclose(coeffs[group_id], expected_coeffs, atol=1e-8)
+        np.testing.assert_allclose(fit_vals[group_pts], poly.polyval(x_vals[group_pts], expected_coeffs), atol=1e-8)
+    # the same point sets padded with nan into rows
+    padded_x = np.full((num_groups, num_points.max()), np.nan)
+    padded_y = np.full((num_groups, num_points.max()), np.nan)
+    for group_id in range(num_groups):
+        padded_x[group_id, :num_points[group_id]] = x_vals[group_ids == group_id]
+        padded_y[group_id, :num_points[group_id]] = y_vals[group_ids == group_id]
+    padded_coeffs, padded_fit_vals = hist_funcs.quadratic_poly_fits(padded_x, padded_y)
+    np.testing.assert_allclose(padded_coeffs, coeffs, atol=1e-8)
+    np.testing.assert_allclose(padded_fit_vals[~np.isnan(padded_x)], fit_vals, atol=1e-8)
+    assert np.all(np.isnan(padded_fit_vals[np.isnan(padded_x)]))
+
+
+@pytest.mark.parametrize('x_center, x_spread', [(0.0, 1e-4), (1e3, 1e-2), (-5.0, 1e3)])
+def test_quadratic_poly_fits_scale(x_center, x_spread):
+    rng = np.random.default_rng(2)
+    x_vals = x_center + x_spread * rng.uniform(-1, 1, size=(4, 15))
+    y_vals = 0.5 + 2.0 * (x_vals - x_center) / x_spread - 3.0 * ((x_vals - x_center) / x_spread)**2
+    y_vals = y_vals + 0.01 * rng.normal(size=y_vals.shape)
+    coeffs, fit_vals = hist_funcs.quadratic_poly_fits(x_vals, y_vals)
+    assert np.all(np.isfinite(coeffs))
+    for group_id in range(x_vals.shape[0]):
+        centered_x = x_vals[group_id] - x_center
+        expected_fit = np.polyval(np.polyfit(centered_x, y_vals[group_id], deg=2), centered_x)
+        np.testing.assert_allclose(fit_vals[group_id], expected_fit, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(coeffs[group_id, 2] * x_spread**2, -3.0, rtol=0.05)
+
+
+def test_quadratic_poly_fits_underdetermined():
+    coeffs, fit_vals = hist_funcs.quadratic_poly_fits(np.array([[0., 1.], [1., 1.]]), np.array([[1., 2.], [3., 4.]]))
+    assert np.all(np.isnan(coeffs))
+    assert np.all(np.isnan(fit_vals))
+
+
+@pytest.mark.parametrize('target, target_is_act', [(0.5, True), (0.3, False)])
+def test_response_attenuation_curvature_poly_fits(target, target_is_act):
+    activations = get_curved_activations()
+    num_y, num_x = activations.shape[-2:]
+    x_pts = np.linspace(-2, 2, num_x)
+    y_pts = np.linspace(-2, 2, num_y)
+    curvatures, fits, sliced_activity = hist_funcs.response_attenuation_curvature_poly_fits(
+        activations, target, target_is_act, x_pts, y_pts)
+    assert fits.shape == activations.shape[:2] + (2, num_y)
+    for neuron_id in range(activations.shape[0]):
+        for plane_id in range(activations.shape[1]):
+            activity = activations[neuron_id, plane_id, ...]
+            x_act = activity[num_y//2, :]
+            if target_is_act:
+                x_target_index = np.abs(x_act - target).argmin()
+            else:
+                x_target_index = int(num_x * ((target + 1) / 2))
+            np.testing.assert_array_equal(sliced_activity[neuron_id, plane_id], activity[:, x_target_index])
+            coeffs = poly.polyfit(y_pts, -activity[:, x_target_index], deg=2)
+            np.testing.assert_allclose(curvatures[neuron_id, plane_id], coeffs[-1], atol=1e-8)
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_iterate_curvature_poly_fits(num_workers):
+    activations = get_curved_activations(num_neurons=2, num_planes=5)
+    num_y, num_x = activations.shape[-2:]
+    contour_dataset = {'x_pts': np.linspace(-2, 2, num_x), 'y_pts': np.linspace(-2, 2, num_y)}
+    bounds = ((-1, 1), (-1, 1))
+    iso_curvatures, attn_curvatures = hist_funcs.compute_curvature_poly_fits(activations, contour_dataset, 0.5, bounds=bounds)
+    response_images = (
+        ((neuron_id, plane_id), activations[neuron_id, plane_id, ...])
+        for neuron_id in range(activations.shape[0])
+        for plane_id in range(activations.shape[1])
+    )
+    fit_results = list(hist_funcs.iterate_curvature_poly_fits(response_images, contour_dataset, 0.5, bounds=bounds,
+        num_workers=num_workers, chunk_size=3, max_pending_chunks=2))
+    assert [key for key, iso_curvature, attn_curvature in fit_results] == [
+        (neuron_id, plane_id) for neuron_id in range(activations.shape[0]) for plane_id in range(activations.shape[1])]
+    for (neuron_id, plane_id), iso_curvature, attn_curvature in fit_results:
+        np.testing.assert_allclose(iso_curvature, iso_curvatures[neuron_id, plane_id])
+        np.testing.assert_allclose(attn_curvature, attn_curvatures[neuron_id, plane_id])
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_compute_curvature_fits(num_workers):
+    rng = np.random.default_rng(2)
+    curvatures = [[[list(rng.normal(loc, 1.0, size=50)) for loc in range(3)] for dataset_id in range(2)]
+        for type_id in range(2)]
+    curvatures[1][1][2] = curvatures[0][0][0] # repeated curvatures share a fit
+    hist_funcs.clear_curvature_fit_cache()
+    all_fits, dist = hist_funcs.compute_curvature_fits(curvatures, dist_name='norm', num_workers=num_workers)
+    assert len(hist_funcs._curvature_fit_cache) == 2 * 2 * 3 - 1
+    for type_id in range(2):
+        for dataset_id in range(2):
+            for neuron_id in range(3):
+                expected_params = dist.fit(curvatures[type_id][dataset_id][neuron_id])
+                np.testing.assert_allclose(all_fits[type_id][dataset_id][neuron_id], expected_params)
+    cached_fits, dist = hist_funcs.compute_curvature_fits(curvatures, dist_name='norm', num_workers=num_workers)
+    assert cached_fits == all_fits
+    assert len(hist_funcs._curvature_fit_cache) == 2 * 2 * 3 - 1
+
+
+def test_curvature_fit_cache_size(monkeypatch):
+    monkeypatch.setattr(hist_funcs, 'CURVATURE_FIT_CACHE_SIZE', 4)
+    rng = np.random.default_rng(3)
+    curvatures = [[[list(rng.normal(loc, 1.0, size=20)) for loc in range(6)]]]
+    hist_funcs.clear_curvature_fit_cache()
+    all_fits, dist = hist_funcs.compute_curvature_fits(curvatures, dist_name='norm')
+    assert len(all_fits[0][0]) == 6 # every fit is returned, even though only the last 4 are cached
+    assert list(hist_funcs._curvature_fit_cache.keys()) == [
+        hist_funcs.get_curvature_fit_key(neuron_curvatures, 'norm') for neuron_curvatures in curvatures[0][0][2:]]
+    # a cache hit marks the fit as recently used
+    hist_funcs.compute_curvature_fits([[curvatures[0][0][2:3]]], dist_name='norm')
+    new_curvatures = [[[list(rng.normal(size=20))]]]
+    hist_funcs.compute_curvature_fits(new_curvatures, dist_name='norm')
+    assert list(hist_funcs._curvature_fit_cache.keys()) == [
+        hist_funcs.get_curvature_fit_key(neuron_curvatures, 'norm')
+        for neuron_curvatures in curvatures[0][0][4:] + curvatures[0][0][2:3] + new_curvatures[0][0]]
+    hist_funcs.clear_curvature_fit_cache()
+    assert len(hist_funcs._curvature_fit_cache) == 0
+
+
+def test_get_level_crossings():
+    activations = get_curved_activations(num_neurons=1, num_planes=5)[0]
+    activations[2, ...] = 0 # no crossings
+    levels = np.array([0.5, 0.2, 0.5, 0.7, 0.9])
+    points, offsets = hist_funcs.get_level_crossings(activations, levels)
+    assert offsets.shape == (len(levels)+1,)
+    assert offsets[2] == offsets[3]
+    for map_id, level in enumerate(levels):
+        map_points = points[offsets[map_id]:offsets[map_id+1]]
+        contours = measure.find_contours(activations[map_id], level)
+        if len(contours) == 0:
+            assert len(map_points) == 0
+            continue
+        expected_points = np.unique(np.concatenate(contours, axis=0), axis=0)
+        np.testing.assert_allclose(np.unique(map_points, axis=0), expected_points, atol=1e-12)
+
+
+@pytest.mark.parametrize('target_is_act, levels', [(True, [0.3, 0.5, 0.7]), (False, [-0.2, 0.1])])
+def test_multi_level_curvature_poly_fits(target_is_act, levels):
+    activations = get_curved_activations()
+    num_y, num_x = activations.shape[-2:]
+    contour_dataset = {'x_pts': np.linspace(-2, 2, num_x), 'y_pts': np.linspace(-2, 2, num_y)}
+    bounds = ((-1, 1), (-1, 1))
+    iso_curvatures, attn_curvatures = hist_funcs.compute_curvature_poly_fits(
+        activations, contour_dataset, levels, target_is_act, bounds)
+    assert iso_curvatures.shape == attn_curvatures.shape == (len(levels),) + activations.shape[:2]
+    for level_index, level in enumerate(levels):
+        level_iso_curvatures, level_attn_curvatures = hist_funcs.compute_curvature_poly_fits(
+            activations, contour_dataset, level, target_is_act, bounds)
+        np.testing.assert_allclose(iso_curvatures[level_index], level_iso_curvatures, atol=1e-10)
+        np.testing.assert_allclose(attn_curvatures[level_index], level_attn_curvatures, atol=1e-10)
+    curvatures, fits, contours = hist_funcs.iso_response_curvature_poly_fits(activations, levels, target_is_act)
+    assert fits.shape[:4] == contours.shape[:4] == (len(levels),) + activations.shape[:2] + (2,)
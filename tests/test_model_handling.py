@@ -0,0 +1,112 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+
+import response_contour_analysis.utils.dataset_generation as data_utils
+import response_contour_analysis.utils.model_handling as model_utils
+
+import pytest
+
+
+class CountingActivation(object):
+    """Records the number of forward passes, and checks that a single int neuron index is requested"""
+    def __init__(self):
+        self.num_calls = 0
+
+    def __call__(self, model, images, neuron_index, compute_grad=False):
+        assert isinstance(neuron_index, (int, np.integer))
+        self.num_calls += 1
+        with torch.no_grad():
+            return model(torch.from_numpy(images.astype(np.float32))).numpy()[:, neuron_index]
+
+
+class CountingContourDatapoints(data_utils.ContourDatapoints):
+    """Records the number of injected planes"""
+    num_injections = 0
+
+    def get(self, target_index, comparison_index, out=None):
+        self.num_injections += 1
+        return super().get(target_index, comparison_index, out)
+
+
+def get_model(data_length=16, num_neurons=3):
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(data_length, num_neurons), torch.nn.Tanh())
+
+
+def test_shared_plane_activations():
+    model = get_model()
+    rng = np.random.default_rng(0)
+    proj_datapoints, x_pts, y_pts = data_utils.get_datamesh(((-2, 2), (-2, 2)), 25)
+    planes = [data_utils.inject_data(data_utils.get_proj_matrix(rng.normal(size=16), rng.normal(size=16)),
+        proj_datapoints, 1.0, [1, 4, 4]) for plane_index in range(3)]
+    contour_dataset = [[planes[0], planes[1]], [planes[0], planes[1]], [planes[2], planes[0]]]
+    target_model_ids = [0, 2, 0]
+    default_activation = CountingActivation()
+    default_activations = model_utils.get_contour_dataset_activations(model, contour_dataset, target_model_ids,
+        default_activation)
+    shared_activation = CountingActivation()
+    shared_activations = model_utils.get_contour_dataset_activations(model, contour_dataset, target_model_ids,
+        shared_activation, shared_planes=True)
+    assert shared_activations.shape == default_activations.shape == (1, 3, 2, 5, 5)
+    np.testing.assert_allclose(shared_activations, default_activations, rtol=1e-6, atol=1e-7)
+    assert default_activation.num_calls == 6
+    assert shared_activation.num_calls == 5 # one forward pass per unique (plane, neuron) pair
+    # lazy datasets are keyed by proj_matrix, and each unique plane is injected once
+    proj_matrices = [data_utils.get_proj_matrix(rng.normal(size=16), rng.normal(size=16)) for plane_index in range(3)]
+    lazy_dataset = CountingContourDatapoints([[proj_matrices[0], proj_matrices[1]], [proj_matrices[0], proj_matrices[1]],
+        [proj_matrices[2], proj_matrices[0]]], proj_datapoints, 1.0, [1, 4, 4], reuse_buffer=True)
+    lazy_activations = model_utils.get_contour_dataset_activations(model, lazy_dataset, target_model_ids,
+        CountingActivation(), shared_planes=True)
+    assert lazy_dataset.num_injections == 3
+    eager_dataset = [[lazy_dataset.get(target_index, comparison_index).copy() for comparison_index in range(2)]
+        for target_index in range(3)]
+    np.testing.assert_allclose(lazy_activations, model_utils.get_contour_dataset_activations(model, eager_dataset,
+        target_model_ids, CountingActivation()), rtol=1e-6, atol=1e-7)
+
+
+@pytest.mark.parametrize('batch_size', [7, 25, 1000])
+def test_batched_response_images(batch_size):
+    model = get_model()
+    rng = np.random.default_rng(1)
+    num_targets, num_comparisons = 3, 2
+    target_vectors = [rng.normal(size=16) for _ in range(num_targets)]
+    comparison_vectors = [[rng.normal(size=16) for _ in range(num_comparisons)] for _ in range(num_targets)]
+    target_model_ids = [2, 0, 1]
+    contour_dataset = data_utils.get_contour_dataset(target_vectors, comparison_vectors, ((-2, 2), (-2, 2)), 25,
+        image_scale=1.5)
+    loop_activations = model_utils.get_contour_dataset_activations(model, contour_dataset['all_datapoints'],
+        target_model_ids, CountingActivation())
+    batched_activation = CountingActivation()
+    response_images = model_utils.get_batched_response_images(model, contour_dataset['proj_matrix'],
+        contour_dataset['proj_datapoints'], target_model_ids, batched_activation, image_scale=1.5, batch_size=batch_size)
+    assert response_images.shape == (num_targets, num_comparisons, 5, 5)
+    np.testing.assert_allclose(response_images, loop_activations[0], rtol=1e-5, atol=1e-5) # float32 forward passes
+    # one call per neuron in each fixed-size batch
+    point_neuron_ids = np.repeat(target_model_ids, num_comparisons * 25)
+    assert batched_activation.num_calls == sum(len(np.unique(point_neuron_ids[batch_start:batch_start+batch_size]))
+        for batch_start in range(0, len(point_neuron_ids), batch_size))
+
+
+def test_plane_point_activations_unsorted_planes():
+    model = get_model()
+    rng = np.random.default_rng(2)
+    proj_matrices = np.stack([data_utils.get_proj_matrix(rng.normal(size=16), rng.normal(size=16))
+        for plane_index in range(3)], axis=0)
+    neuron_indices = [1, 0, 1]
+    plane_ids = rng.integers(0, 3, size=23) # points from different planes are interleaved
+    proj_points = rng.uniform(-2, 2, size=(23, 2))
+    activations = model_utils.get_plane_point_activations(model, proj_matrices, neuron_indices, plane_ids, proj_points,
+        CountingActivation(), image_scale=2.0, batch_size=5)
+    for point_index, plane_id in enumerate(plane_ids):
+        datapoint = data_utils.inject_data(proj_matrices[plane_id], proj_points[point_index:point_index+1], 2.0)
+        expected_activation = CountingActivation()(model, datapoint, neuron_indices[plane_id])
+        np.testing.assert_allclose(activations[point_index], expected_activation[0], rtol=1e-5, atol=1e-6)
+    gradient_activations, plane_gradients = model_utils.get_plane_point_activations_and_gradients(model, proj_matrices,
+        neuron_indices, plane_ids, proj_points, image_scale=2.0, batch_size=5)
+    np.testing.assert_allclose(gradient_activations, activations, rtol=1e-5, atol=1e-6)
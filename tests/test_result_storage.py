@@ -0,0 +1,67 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+
+import response_contour_analysis.utils.result_storage as result_utils
+
+import pytest
+
+
+def test_save_load_results(tmp_path):
+    rng = np.random.default_rng(0)
+    result_directory = str(tmp_path / 'results')
+    results = {
+        'response_images': rng.normal(size=(3, 2, 5, 5)),
+        'completed': np.array([[True, False], [False, True], [True, True]]),
+        'comparison_vector_ids': [[1, 2], [0, 2], [0, 1]],
+        'proj_matrix': None,
+        'comparison_vectors': [np.zeros(3), np.zeros(4)], # ragged
+    }
+    params = {
+        'num_images': 25,
+        'x_range': (-2.0, 2.0),
+        'target_neuron_ids': [0, 4, 7],
+        'save_prefix': 'test_',
+        'mei': [np.ones((2, 2)), np.ones((2, 2))],
+        'iso_window_bounds': np.array([1, 2]),
+    }
+    metadata = result_utils.get_json_metadata(params)
+    assert set(metadata.keys()) == {'num_images', 'x_range', 'target_neuron_ids', 'save_prefix'}
+    skipped_fields = result_utils.save_results(result_directory, results, metadata=metadata, chunk_size=2)
+    assert set(skipped_fields) == {'proj_matrix', 'comparison_vectors'}
+    loaded_results, loaded_metadata = result_utils.load_results(result_directory, mmap_mode='r')
+    assert set(loaded_results.keys()) == {'response_images', 'completed', 'comparison_vector_ids'}
+    for field, value in loaded_results.items():
+        assert isinstance(value, np.memmap)
+        np.testing.assert_array_equal(value, np.asarray(results[field]))
+    assert loaded_results['completed'].dtype == bool
+    assert loaded_metadata == {'num_images': 25, 'x_range': [-2.0, 2.0], 'target_neuron_ids': [0, 4, 7],
+        'save_prefix': 'test_'}
+    with pytest.raises(TypeError):
+        result_utils.save_results(result_directory, {}, metadata={'mei': params['mei']})
+
+
+def test_open_result_array_resume(tmp_path):
+    result_directory = str(tmp_path / 'results')
+    result_array = result_utils.open_result_array(result_directory, 'iso_curvatures', (2, 3), fill_value=np.nan)
+    assert np.all(np.isnan(result_array))
+    result_array[1, 2] = 0.5
+    result_array.flush()
+    del result_array
+    resumed_array = result_utils.open_result_array(result_directory, 'iso_curvatures', (2, 3), fill_value=np.nan,
+        resume=True)
+    assert resumed_array[1, 2] == 0.5
+    assert np.count_nonzero(np.isnan(resumed_array)) == 5
+    del resumed_array
+    new_array = result_utils.open_result_array(result_directory, 'iso_curvatures', (2, 3), fill_value=np.nan)
+    assert np.all(np.isnan(new_array)) # resume=False always starts over
+    del new_array
+    reshaped_array = result_utils.open_result_array(result_directory, 'iso_curvatures', (3, 2, 3), fill_value=np.nan,
+        resume=True)
+    assert reshaped_array.shape == (3, 2, 3)
+    assert np.all(np.isnan(reshaped_array))
+    assert result_utils.load_index(result_directory)['fields']['iso_curvatures']['shape'] == [3, 2, 3]
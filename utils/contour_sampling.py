@@ -0,0 +1,438 @@
+"""
+Utility funcions for sampling iso-response contours without computing dense activation maps
+
+A plane response function is called as plane_response_function(plane_ids, proj_points) and returns the
+activation for each 2D point on its plane, see get_plane_response_function()
+
+As in utils/histogram_analysis.compute_curvature_poly_fits(), the target level for each plane is
+min + target * (max - min) of the activity within the bounds window. The min & max are taken over a coarse
+num_coarse x num_coarse grid of the window instead of the dense activation map, so the level differs slightly
+from the dense level when an extremum lies between coarse grid points.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+
+import response_contour_analysis.utils.model_handling as model_utils
+import response_contour_analysis.utils.histogram_analysis as hist_utils
+
+
+def get_plane_response_function(model, proj_matrices, neuron_indices, get_activation_function, image_scale=1.0,
+        data_shape=None, batch_size=100, activation_function_kwargs={}):
+    """
+    Parameters:
+        model [pytorch model] model to compute activations from
+        proj_matrices [np.ndarray] of shape [num_planes, 2, datapoint_length] for injecting points into the input space
+        neuron_indices [list of ints] of shape [num_planes] indicating which neuron index to record for each plane
+        all other parameters are passed to utils/model_handling.get_plane_point_activations()
+    Outputs:
+        plane_response_function [python function] that is called as plane_response_function(plane_ids, proj_points)
+            plane_ids [np.ndarray] of ints with shape [num_points] indicating which plane each point belongs to
+            proj_points [np.ndarray] of shape [num_points, 2] with the (x, y) location of each point on its plane
+            and returns the activations with shape [num_points]
+    """
+    proj_matrices = np.asarray(proj_matrices)
+    def plane_response_function(plane_ids, proj_points):
+        return model_utils.get_plane_point_activations(model, proj_matrices, neuron_indices, plane_ids, proj_points,
+            get_activation_function, image_scale, data_shape, batch_size, activation_function_kwargs)
+    return plane_response_function
+
+
+def get_plane_response_and_gradient_function(model, proj_matrices, neuron_indices,
+        get_activation_function=model_utils.unit_activation, image_scale=1.0, data_shape=None, batch_size=100,
+        activation_function_kwargs={}):
+    """
+    Parameters:
+        model [pytorch model] model to compute activations from
+        proj_matrices [np.ndarray] of shape [num_planes, 2, datapoint_length] for injecting points into the input space
+        neuron_indices [list of ints] of shape [num_planes] indicating which neuron index to record for each plane
+        get_activation_function [python function] see utils/model_handling.get_plane_point_activations_and_gradients()
+            with compute_grad=False it is called the same way as in utils/model_handling.get_plane_point_activations()
+        all other parameters are passed to utils/model_handling.get_plane_point_activations_and_gradients()
+    Outputs:
+        plane_response_and_gradient_function [python function] that is called as
+            plane_response_and_gradient_function(plane_ids, proj_points, compute_grad=True), with the same plane_ids and
+            proj_points as a plane response function, and returns (activations [num_points], plane_gradients [num_points, 2]),
+            where the gradients are with respect to the (x, y) plane coordinates.
+            if compute_grad is False, only the activations are returned, from forward passes without gradients
+    """
+    proj_matrices = np.asarray(proj_matrices)
+    def plane_response_and_gradient_function(plane_ids, proj_points, compute_grad=True):
+        if not compute_grad:
+            return model_utils.get_plane_point_activations(model, proj_matrices, neuron_indices, plane_ids, proj_points,
+                get_activation_function, image_scale, data_shape, batch_size,
+                dict(activation_function_kwargs, compute_grad=False))
+        return model_utils.get_plane_point_activations_and_gradients(model, proj_matrices, neuron_indices, plane_ids,
+            proj_points, get_activation_function, image_scale, data_shape, batch_size, activation_function_kwargs)
+    return plane_response_and_gradient_function
+
+
+def _contour_point_curvatures(contour_pts, offsets):
+    """ iso-response curvature for each plane from (y, x) contour points, see hist_utils.iso_response_curvature_point_fits() """
+    num_planes = len(offsets) - 1
+    plane_ids = hist_utils._offsets_to_ids(offsets)
+    coeffs, fit_mask, x_fit_pts = hist_utils.iso_response_curvature_point_fits(contour_pts[:, 1], contour_pts[:, 0],
+        plane_ids, num_planes)
+    return coeffs[:, -1]
+
+
+def _lattice_to_plane(lattice_y, lattice_x, yx_range, yx_spacing):
+    """ (x, y) plane locations for integer lattice coordinates with the given spacing """
+    return np.stack((yx_range[1][0] + lattice_x * yx_spacing[1], yx_range[0][0] + lattice_y * yx_spacing[0]), axis=1)
+
+
+def _bracketing_cells(cell_values, cell_levels):
+    """ cells that have corners on both sides of their level, cell_values is [num_cells, 4] """
+    above = cell_values > cell_levels[:, None]
+    return np.any(above, axis=1) & ~np.all(above, axis=1)
+
+
+def get_adaptive_contour_points(plane_response_function, num_planes, yx_range, target, num_coarse=9, tolerance=0.01,
+        max_depth=8, bounds=None):
+    """
+    Find iso-response contour points by refining a coarse grid only where the contour passes through
+        Each plane is first evaluated on a num_coarse x num_coarse grid over the bounds window. The target level for each
+        plane is set from the normalized coarse grid activity, see the module docstring. Cells that have corners on both sides of the level are split into 4
+        children, which requires 5 new model queries per cell (shared points are queried once), and only children that
+        still bracket the level are kept. Refinement stops when the cell edges are shorter than tolerance.
+        The contour points are the linearly interpolated level crossings along the edges of the final cells.
+    Parameters:
+        plane_response_function [python function] see get_plane_response_function()
+        num_planes [int] number of planes to sample
+        yx_range [list of tuple] indicating [(y_axis_min, y_axis_max), (x_axis_min, x_axis_max)]
+        target [float] target activity between 0 (minimum coarse grid activity) and 1 (maximum coarse grid activity)
+        num_coarse [int] number of points along each axis of the coarse grid
+        tolerance [float] maximum cell edge length, in plane units, of the final cells
+        max_depth [int] maximum number of times that a cell can be split
+        bounds [nested tuple or None] containing ((y_min, y_max), (x_min, x_max)) for the window within which the contour is
+            sampled and the activity is normalized, the same as in utils/histogram_analysis.compute_curvature_poly_fits();
+            if None, the whole yx_range is used
+    Outputs:
+        contour_pts [np.ndarray] of shape [num_crossings, 2] with the (y, x) plane location of each contour point
+        offsets [np.ndarray] of shape [num_planes+1], the points for plane p are contour_pts[offsets[p]:offsets[p+1]]
+        num_evaluations [int] total number of points that were passed to plane_response_function
+    """
+    assert (0 <= target <= 1), (f'utils/contour_sampling: ERROR: target={target} must in the inclusive range [0, 1]')
+    if bounds is not None:
+        yx_range = bounds
+    yx_spacing = np.array([(yx_range[0][1] - yx_range[0][0]), (yx_range[1][1] - yx_range[1][0])]) / (num_coarse - 1)
+    # coarse grid
+    lattice_y, lattice_x = [coords.reshape(-1) for coords in np.meshgrid(np.arange(num_coarse), np.arange(num_coarse),
+        indexing='ij')]
+    plane_ids = np.repeat(np.arange(num_planes), num_coarse**2)
+    coarse_points = np.tile(_lattice_to_plane(lattice_y, lattice_x, yx_range, yx_spacing), (num_planes, 1))
+    coarse_values = plane_response_function(plane_ids, coarse_points).reshape(num_planes, num_coarse, num_coarse)
+    num_evaluations = coarse_points.shape[0]
+    coarse_min = coarse_values.min(axis=(1, 2))
+    coarse_max = coarse_values.max(axis=(1, 2))
+    levels = coarse_min + target * (coarse_max - coarse_min)
+    for plane_id in np.flatnonzero(coarse_max <= coarse_min):
+        print('WARNING: get_adaptive_contour_points: activations are constant on the coarse grid for '
+            +f'plane_index={plane_id}')
+    # cells are indexed by their lower-left lattice coordinate, corner values are ordered [y0x0, y0x1, y1x0, y1x1]
+    cell_planes, cell_y, cell_x = [coords.reshape(-1) for coords in np.meshgrid(np.arange(num_planes),
+        np.arange(num_coarse-1), np.arange(num_coarse-1), indexing='ij')]
+    cell_values = np.stack((
+        coarse_values[:, :-1, :-1], coarse_values[:, :-1, 1:],
+        coarse_values[:, 1:, :-1], coarse_values[:, 1:, 1:]), axis=-1).reshape(-1, 4)
+    keep = _bracketing_cells(cell_values, levels[cell_planes])
+    cell_planes = cell_planes[keep]; cell_y = cell_y[keep]; cell_x = cell_x[keep]; cell_values = cell_values[keep]
+    depth = 0
+    while np.max(yx_spacing) > tolerance and depth < max_depth and len(cell_planes) > 0:
+        yx_spacing = yx_spacing / 2
+        depth += 1
+        # each cell becomes a 3x3 lattice at the new spacing; the 4 corners are known and the other 5 points are new
+        new_offsets = np.array([(0, 1), (1, 0), (1, 1), (1, 2), (2, 1)])
+        new_planes = np.repeat(cell_planes, len(new_offsets))
+        new_y = (2 * cell_y[:, None] + new_offsets[None, :, 0]).reshape(-1)
+        new_x = (2 * cell_x[:, None] + new_offsets[None, :, 1]).reshape(-1)
+        unique_points, inverse = np.unique(np.stack((new_planes, new_y, new_x), axis=1), axis=0, return_inverse=True)
+        unique_values = plane_response_function(unique_points[:, 0],
+            _lattice_to_plane(unique_points[:, 1], unique_points[:, 2], yx_range, yx_spacing))
+        num_evaluations += unique_points.shape[0]
+        sub_values = np.zeros((len(cell_planes), 3, 3))
+        sub_values[:, 0, 0] = cell_values[:, 0]; sub_values[:, 0, 2] = cell_values[:, 1]
+        sub_values[:, 2, 0] = cell_values[:, 2]; sub_values[:, 2, 2] = cell_values[:, 3]
+        sub_values[:, new_offsets[:, 0], new_offsets[:, 1]] = unique_values[inverse.reshape(-1)].reshape(-1, len(new_offsets))
+        child_planes = []; child_y = []; child_x = []; child_values = []
+        for (dy, dx) in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            child_planes.append(cell_planes)
+            child_y.append(2 * cell_y + dy)
+            child_x.append(2 * cell_x + dx)
+            child_values.append(sub_values[:, dy:dy+2, dx:dx+2].reshape(-1, 4))
+        cell_planes = np.concatenate(child_planes); cell_y = np.concatenate(child_y); cell_x = np.concatenate(child_x)
+        cell_values = np.concatenate(child_values)
+        keep = _bracketing_cells(cell_values, levels[cell_planes])
+        cell_planes = cell_planes[keep]; cell_y = cell_y[keep]; cell_x = cell_x[keep]; cell_values = cell_values[keep]
+    # level crossings along the cell edges, each edge is indexed by (plane, start_y, start_x, is_vertical)
+    edge_keys = np.concatenate((
+        np.stack((cell_planes, cell_y, cell_x, np.zeros_like(cell_y)), axis=1), # bottom
+        np.stack((cell_planes, cell_y+1, cell_x, np.zeros_like(cell_y)), axis=1), # top
+        np.stack((cell_planes, cell_y, cell_x, np.ones_like(cell_y)), axis=1), # left
+        np.stack((cell_planes, cell_y, cell_x+1, np.ones_like(cell_y)), axis=1))) # right
+    edge_from = np.concatenate((cell_values[:, 0], cell_values[:, 2], cell_values[:, 0], cell_values[:, 1]))
+    edge_to = np.concatenate((cell_values[:, 1], cell_values[:, 3], cell_values[:, 2], cell_values[:, 3]))
+    edge_keys, unique_indices = np.unique(edge_keys.reshape(-1, 4), axis=0, return_index=True) # sorted by plane
+    edge_from = edge_from[unique_indices]; edge_to = edge_to[unique_indices]
+    edge_levels = levels[edge_keys[:, 0]]
+    crossed = (edge_from > edge_levels) != (edge_to > edge_levels)
+    edge_keys = edge_keys[crossed]
+    fraction = (edge_levels[crossed] - edge_from[crossed]) / (edge_to[crossed] - edge_from[crossed])
+    is_vertical = edge_keys[:, 3] == 1
+    crossing_y = edge_keys[:, 1] + np.where(is_vertical, fraction, 0)
+    crossing_x = edge_keys[:, 2] + np.where(is_vertical, 0, fraction)
+    contour_pts = np.stack((yx_range[0][0] + crossing_y * yx_spacing[0], yx_range[1][0] + crossing_x * yx_spacing[1]),
+        axis=1)
+    offsets = hist_utils._counts_to_offsets(np.bincount(edge_keys[:, 0], minlength=num_planes))
+    return contour_pts, offsets, num_evaluations
+
+
+def adaptive_iso_response_curvatures(plane_response_function, num_planes, yx_range, target, num_coarse=9,
+        tolerance=0.01, max_depth=8, bounds=None):
+    """
+    Estimate iso-response curvature from adaptively sampled contour points, see get_adaptive_contour_points()
+    Parameters:
+        see get_adaptive_contour_points()
+    Outputs:
+        curvatures [np.ndarray] of shape [num_planes] with the estimated iso-response curvature coefficient for each plane
+        contour_pts [np.ndarray] of shape [num_crossings, 2] with the (y, x) plane location of each contour point
+        offsets [np.ndarray] of shape [num_planes+1] indicating the contour points for each plane
+        num_evaluations [int] total number of points that were passed to plane_response_function
+    """
+    contour_pts, offsets, num_evaluations = get_adaptive_contour_points(plane_response_function, num_planes, yx_range,
+        target, num_coarse, tolerance, max_depth, bounds)
+    return _contour_point_curvatures(contour_pts, offsets), contour_pts, offsets, num_evaluations
+
+
+def get_ray_contour_points(plane_response_function, num_planes, yx_range, target, num_rays=15, num_coarse=9,
+        tolerance=1e-4, max_iterations=50, bounds=None):
+    """
+    Find iso-response contour points by root finding along horizontal rays in each plane
+        Each plane is scanned at num_coarse points along num_rays rays of constant y within the bounds window, the target
+        level for each plane is set from the normalized scan activity (see the module docstring), and every scan interval that brackets the level is refined with the
+        Illinois variant of regula falsi. All of the brackets from all planes are updated with one batch of model
+        queries per iteration, and converged brackets are dropped from the batch.
+    Parameters:
+        plane_response_function [python function] see get_plane_response_function()
+        num_planes [int] number of planes to sample
+        yx_range [list of tuple] indicating [(y_axis_min, y_axis_max), (x_axis_min, x_axis_max)]
+        target [float] target activity between 0 (minimum scan activity) and 1 (maximum scan activity)
+        num_rays [int] number of evenly spaced y values at which a ray is cast along the x axis
+        num_coarse [int] number of points along each ray for the initial scan
+        tolerance [float] a root is accepted when consecutive estimates move less than tolerance along x
+        max_iterations [int] maximum number of regula falsi iterations
+        bounds [nested tuple or None] containing ((y_min, y_max), (x_min, x_max)) for the window within which the contour is
+            sampled and the activity is normalized, the same as in utils/histogram_analysis.compute_curvature_poly_fits();
+            if None, the whole yx_range is used
+    Outputs:
+        contour_pts [np.ndarray] of shape [num_crossings, 2] with the (y, x) plane location of each contour point
+        offsets [np.ndarray] of shape [num_planes+1], the points for plane p are contour_pts[offsets[p]:offsets[p+1]]
+        num_evaluations [int] total number of points that were passed to plane_response_function
+    """
+    assert (0 <= target <= 1), (f'utils/contour_sampling: ERROR: target={target} must in the inclusive range [0, 1]')
+    if bounds is not None:
+        yx_range = bounds
+    ray_y = np.linspace(yx_range[0][0], yx_range[0][1], num_rays)
+    scan_x = np.linspace(yx_range[1][0], yx_range[1][1], num_coarse)
+    scan_planes, scan_rays, scan_points = [coords.reshape(-1) for coords in np.meshgrid(np.arange(num_planes),
+        np.arange(num_rays), np.arange(num_coarse), indexing='ij')]
+    scan_values = plane_response_function(scan_planes,
+        np.stack((scan_x[scan_points], ray_y[scan_rays]), axis=1)).reshape(num_planes, num_rays, num_coarse)
+    num_evaluations = scan_planes.size
+    scan_min = scan_values.min(axis=(1, 2))
+    scan_max = scan_values.max(axis=(1, 2))
+    levels = scan_min + target * (scan_max - scan_min)
+    for plane_id in np.flatnonzero(scan_max <= scan_min):
+        print('WARNING: get_ray_contour_points: activations are constant along the rays for '
+            +f'plane_index={plane_id}')
+    above = scan_values > levels[:, None, None]
+    bracket_planes, bracket_rays, bracket_index = np.nonzero(above[..., :-1] != above[..., 1:]) # sorted by plane
+    bracket_levels = levels[bracket_planes]
+    left_x = scan_x[bracket_index]
+    right_x = scan_x[bracket_index+1]
+    left_g = scan_values[bracket_planes, bracket_rays, bracket_index] - bracket_levels
+    right_g = scan_values[bracket_planes, bracket_rays, bracket_index+1] - bracket_levels
+    root_x = left_x - left_g * (right_x - left_x) / (right_g - left_g) # linear interpolation of the scan
+    last_side = np.zeros(len(root_x), dtype=int) # -1 if the right end was replaced last, +1 for the left end
+    active = np.flatnonzero(np.isfinite(root_x))
+    for iteration in range(max_iterations):
+        if len(active) == 0:
+            break
+        root_g = plane_response_function(bracket_planes[active],
+            np.stack((root_x[active], ray_y[bracket_rays[active]]), axis=1)) - bracket_levels[active]
+        num_evaluations += len(active)
+        replace_right = np.sign(root_g) == np.sign(right_g[active])
+        replace_left = ~replace_right & (np.sign(root_g) == np.sign(left_g[active]))
+        right_ids = active[replace_right]
+        right_x[right_ids] = root_x[right_ids]; right_g[right_ids] = root_g[replace_right]
+        left_g[right_ids[last_side[right_ids] == -1]] /= 2 # Illinois step keeps the stale end from stalling
+        last_side[right_ids] = -1
+        left_ids = active[replace_left]
+        left_x[left_ids] = root_x[left_ids]; left_g[left_ids] = root_g[replace_left]
+        right_g[left_ids[last_side[left_ids] == 1]] /= 2
+        last_side[left_ids] = 1
+        new_root_x = root_x[active].copy()
+        update = replace_right | replace_left # otherwise the level was hit exactly
+        new_root_x[update] = (left_x[active] - left_g[active] * (right_x[active] - left_x[active])
+            / (right_g[active] - left_g[active]))[update]
+        converged = ~update | (np.abs(new_root_x - root_x[active]) < tolerance)
+        root_x[active] = new_root_x
+        active = active[~converged]
+    contour_pts = np.stack((ray_y[bracket_rays], root_x), axis=1)
+    offsets = hist_utils._counts_to_offsets(np.bincount(bracket_planes, minlength=num_planes))
+    return contour_pts, offsets, num_evaluations
+
+
+def ray_iso_response_curvatures(plane_response_function, num_planes, yx_range, target, num_rays=15, num_coarse=9,
+        tolerance=1e-4, max_iterations=50, bounds=None):
+    """
+    Estimate iso-response curvature from contour points that are found along rays, see get_ray_contour_points()
+    Parameters:
+        see get_ray_contour_points()
+    Outputs:
+        curvatures [np.ndarray] of shape [num_planes] with the estimated iso-response curvature coefficient for each plane
+        contour_pts [np.ndarray] of shape [num_crossings, 2] with the (y, x) plane location of each contour point
+        offsets [np.ndarray] of shape [num_planes+1] indicating the contour points for each plane
+        num_evaluations [int] total number of points that were passed to plane_response_function
+    """
+    contour_pts, offsets, num_evaluations = get_ray_contour_points(plane_response_function, num_planes, yx_range,
+        target, num_rays, num_coarse, tolerance, max_iterations, bounds)
+    return _contour_point_curvatures(contour_pts, offsets), contour_pts, offsets, num_evaluations
+
+
+def _newton_correct(plane_response_and_gradient_function, plane_ids, proj_points, levels, num_newton_steps):
+    """ move (x, y) points toward their level along the gradient, returns the corrected points and the number of queries """
+    for newton_step in range(num_newton_steps):
+        values, gradients = plane_response_and_gradient_function(plane_ids, proj_points)
+        squared_norms = np.sum(gradients**2, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            proj_points = proj_points - ((values - levels) / squared_norms)[:, None] * gradients
+    return proj_points, num_newton_steps * len(plane_ids)
+
+
+def get_walker_contour_points(plane_response_and_gradient_function, num_planes, yx_range, target, step_size=0.05,
+        num_coarse=9, num_newton_steps=2, max_steps=None, bounds=None):
+    """
+    Find iso-response contour points by walking along the level set with a predictor-corrector method
+        Each plane is evaluated on a num_coarse x num_coarse grid over the bounds window, without gradients, to set the
+        target level from the normalized activity (see the module docstring) and to find a seed crossing near the center
+        of the window. Two walkers leave each seed in opposite directions.
+        Every step predicts along the tangent of the level set, which is perpendicular to the plane gradient, and then
+        corrects with Newton steps along the gradient. The walkers from all planes are evaluated together, so each
+        predictor or corrector step is one batch of forward & backward passes. A walker stops when it leaves the window,
+        when it meets its partner (closed contours), or after max_steps, so the cost is proportional to contour length.
+    Parameters:
+        plane_response_and_gradient_function [python function] see get_plane_response_and_gradient_function()
+        num_planes [int] number of planes to sample
+        yx_range [list of tuple] indicating [(y_axis_min, y_axis_max), (x_axis_min, x_axis_max)]
+        target [float] target activity between 0 (minimum coarse grid activity) and 1 (maximum coarse grid activity)
+        step_size [float] arc length between consecutive contour points, in plane units
+        num_coarse [int] number of points along each axis of the coarse grid
+        num_newton_steps [int] number of corrector steps for each contour point
+        max_steps [int or None] maximum number of steps for each walker; if None, it is the perimeter of the window divided by step_size
+        bounds [nested tuple or None] containing ((y_min, y_max), (x_min, x_max)) for the window within which the contour is
+            sampled and the activity is normalized, the same as in utils/histogram_analysis.compute_curvature_poly_fits();
+            if None, the whole yx_range is used
+    Outputs:
+        contour_pts [np.ndarray] of shape [num_crossings, 2] with the (y, x) plane location of each contour point, in
+            order along the contour for each plane
+        offsets [np.ndarray] of shape [num_planes+1], the points for plane p are contour_pts[offsets[p]:offsets[p+1]]
+        num_evaluations [int] total number of points that were passed to plane_response_and_gradient_function
+    """
+    assert (0 <= target <= 1), (f'utils/contour_sampling: ERROR: target={target} must in the inclusive range [0, 1]')
+    if bounds is not None:
+        yx_range = bounds
+    (y_min, y_max), (x_min, x_max) = yx_range
+    if max_steps is None:
+        max_steps = int(np.ceil(2 * ((y_max - y_min) + (x_max - x_min)) / step_size))
+    # coarse grid for the levels & seeds
+    x_pts = np.linspace(x_min, x_max, num_coarse)
+    y_pts = np.linspace(y_min, y_max, num_coarse)
+    X_mesh, Y_mesh = np.meshgrid(x_pts, y_pts)
+    coarse_points = np.tile(np.stack((X_mesh.reshape(-1), Y_mesh.reshape(-1)), axis=1), (num_planes, 1))
+    coarse_values = plane_response_and_gradient_function(np.repeat(np.arange(num_planes), num_coarse**2), coarse_points,
+        compute_grad=False)
+    coarse_values = coarse_values.reshape(num_planes, num_coarse, num_coarse)
+    num_evaluations = coarse_points.shape[0]
+    coarse_min = coarse_values.min(axis=(1, 2))
+    coarse_max = coarse_values.max(axis=(1, 2))
+    levels = coarse_min + target * (coarse_max - coarse_min)
+    above = coarse_values > levels[:, None, None]
+    edge_planes, edge_y, edge_x = np.nonzero(above[:, :, :-1] != above[:, :, 1:])
+    # seed each plane at the crossed horizontal edge that is closest to the center of the grid
+    center_distance = np.abs(edge_y - (num_coarse - 1) / 2) * num_coarse + np.abs(edge_x + 0.5 - (num_coarse - 1) / 2)
+    edge_order = np.lexsort((center_distance, edge_planes))
+    seed_edges = edge_order[np.unique(edge_planes[edge_order], return_index=True)[1]]
+    seed_planes = edge_planes[seed_edges]
+    for plane_id in np.setdiff1d(np.arange(num_planes), seed_planes):
+        print('WARNING: get_walker_contour_points: no contour was found on the coarse grid for '
+            +f'plane_index={plane_id}')
+    from_values = coarse_values[seed_planes, edge_y[seed_edges], edge_x[seed_edges]]
+    to_values = coarse_values[seed_planes, edge_y[seed_edges], edge_x[seed_edges]+1]
+    fraction = (levels[seed_planes] - from_values) / (to_values - from_values)
+    seed_points = np.stack((x_pts[edge_x[seed_edges]] + fraction * (x_pts[1] - x_pts[0]), y_pts[edge_y[seed_edges]]), axis=1)
+    seed_points, num_queries = _newton_correct(plane_response_and_gradient_function, seed_planes, seed_points,
+        levels[seed_planes], num_newton_steps)
+    num_evaluations += num_queries
+    # walkers 2i and 2i+1 leave seed i in opposite directions
+    walker_planes = np.repeat(seed_planes, 2)
+    walker_directions = np.tile([1.0, -1.0], len(seed_planes))
+    walker_points = np.repeat(seed_points, 2, axis=0)
+    walker_active = np.all(np.isfinite(walker_points), axis=1)
+    recorded_planes = [seed_planes]; recorded_order = [np.zeros(len(seed_planes))]; recorded_points = [seed_points]
+    for step in range(1, max_steps+1):
+        active = np.flatnonzero(walker_active)
+        if len(active) == 0:
+            break
+        values, gradients = plane_response_and_gradient_function(walker_planes[active], walker_points[active])
+        num_evaluations += len(active)
+        gradient_norms = np.linalg.norm(gradients, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tangents = walker_directions[active, None] * np.stack((-gradients[:, 1], gradients[:, 0]), axis=1) / gradient_norms[:, None]
+        new_points, num_queries = _newton_correct(plane_response_and_gradient_function, walker_planes[active],
+            walker_points[active] + step_size * tangents, levels[walker_planes[active]], num_newton_steps)
+        num_evaluations += num_queries
+        in_range = (np.all(np.isfinite(new_points), axis=1)
+            & (new_points[:, 0] >= x_min) & (new_points[:, 0] <= x_max)
+            & (new_points[:, 1] >= y_min) & (new_points[:, 1] <= y_max))
+        walker_points[active] = new_points
+        walker_active[active[~in_range]] = False
+        # a closed contour is complete when both walkers from a seed meet
+        partners = active ^ 1
+        met = walker_active[active] & walker_active[partners] & (
+            np.linalg.norm(walker_points[active] - walker_points[partners], axis=1) < step_size)
+        active = active[in_range]
+        recorded_planes.append(walker_planes[active])
+        recorded_order.append(step * walker_directions[active])
+        recorded_points.append(walker_points[active])
+        walker_active[active[met[in_range]]] = False
+        walker_active[partners[met]] = False
+    recorded_planes = np.concatenate(recorded_planes)
+    recorded_order = np.concatenate(recorded_order)
+    recorded_points = np.concatenate(recorded_points)
+    sort_indices = np.lexsort((recorded_order, recorded_planes))
+    contour_pts = recorded_points[sort_indices][:, ::-1] # (x, y) -> (y, x)
+    offsets = hist_utils._counts_to_offsets(np.bincount(recorded_planes, minlength=num_planes))
+    return contour_pts, offsets, num_evaluations
+
+
+def walker_iso_response_curvatures(plane_response_and_gradient_function, num_planes, yx_range, target, step_size=0.05,
+        num_coarse=9, num_newton_steps=2, max_steps=None, bounds=None):
+    """
+    Estimate iso-response curvature from contour points that are found by walking the level set, see get_walker_contour_points()
+    Parameters:
+        see get_walker_contour_points()
+    Outputs:
+        curvatures [np.ndarray] of shape [num_planes] with the estimated iso-response curvature coefficient for each plane
+        contour_pts [np.ndarray] of shape [num_crossings, 2] with the (y, x) plane location of each contour point
+        offsets [np.ndarray] of shape [num_planes+1] indicating the contour points for each plane
+        num_evaluations [int] total number of points that were passed to plane_response_and_gradient_function
+    """
+    contour_pts, offsets, num_evaluations = get_walker_contour_points(plane_response_and_gradient_function, num_planes,
+        yx_range, target, step_size, num_coarse, num_newton_steps, max_steps, bounds)
+    return _contour_point_curvatures(contour_pts, offsets), contour_pts, offsets, num_evaluations
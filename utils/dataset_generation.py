@@ -186,6 +186,45 @@ def numpy_gram_schmidt(target_normed, comp_normed):
     return orth_normed
 
 
+def batched_gram_schmidt(target_normed, comp_normed):
+    """
+    Perform a single step of the Gram-Schmidt process for a batch of vectors, see gram_schmidt()
+    Parameters:
+        target_normed [np.ndarray] l2 normalized vectors with shape [num_targets, vector_length]
+        comp_normed [np.ndarray] l2 normalized vectors with shape [num_targets, num_comparisons, vector_length]
+    Outputs:
+        orth_normed [np.ndarray] l2 normalized vectors with shape [num_targets, num_comparisons, vector_length],
+            where orth_normed[i, j, :] is orthogonal to target_normed[i, :]
+    """
+    inner_products = np.matmul(comp_normed, target_normed[:, :, None]) # [num_targets, num_comparisons, 1]
+    orth_vectors = comp_normed - inner_products * target_normed[:, None, :]
+    orth_norms = np.linalg.norm(orth_vectors, axis=-1, keepdims=True)
+    if np.any(orth_norms == 0):
+        print('WARNING: From dataset_generation/batched_gram_schmidt: norm of orthogonal vector is 0 for '
+            +f'(target, comparison) indices {np.argwhere(orth_norms[..., 0] == 0).tolist()}.')
+    return orth_vectors / orth_norms
+
+
+def get_batched_proj_matrix(target_vectors, comparison_vectors):
+    """
+    Computes the projection matrices for all target & comparison vector pairs at once, see get_proj_matrix()
+    Parameters:
+        target_vectors [np.ndarray] of shape [num_targets, vector_length]
+        comparison_vectors [np.ndarray] of shape [num_targets, num_comparisons, vector_length]
+    Outputs:
+        proj_matrix [np.ndarray] of shape [num_targets, num_comparisons, 2, vector_length],
+            where proj_matrix[i, j, ...] is the orthonormal matrix for the plane defined by target i & comparison j
+    """
+    num_targets, num_comparisons, vector_length = comparison_vectors.shape
+    target_normed = target_vectors / np.linalg.norm(target_vectors, axis=-1, keepdims=True)
+    comp_normed = comparison_vectors / np.linalg.norm(comparison_vectors, axis=-1, keepdims=True)
+    orth_normed = batched_gram_schmidt(target_normed, comp_normed)
+    proj_matrix = np.empty((num_targets, num_comparisons, 2, vector_length), dtype=orth_normed.dtype)
+    proj_matrix[:, :, 0, :] = target_normed[:, None, :]
+    proj_matrix[:, :, 1, :] = orth_normed
+    return proj_matrix
+
+
 def get_proj_matrix(target_vector, comp_vector):
     """
     Computes an orthonormal matrix composed of the target_vector and an orthogonal vector
@@ -223,7 +262,7 @@ def project_data(proj_matrix, datapoints, image_scale=1.0):
     return proj_datapoints
 
 
-def inject_data(proj_matrix, proj_datapoints, image_scale=1.0, data_shape=None):
+def inject_data(proj_matrix, proj_datapoints, image_scale=1.0, data_shape=None, out=None):
     """
     Inject 2D datapoints into ND
     Parameters:
@@ -235,12 +274,19 @@ def inject_data(proj_matrix, proj_datapoints, image_scale=1.0, data_shape=None):
         data_shape [list]
             if provided, then the output will be shaped [num_datapoints]+data_shape
             if None, then the output will be shaped [num_datapoints, int(sqrt(N)), int(sqrt(N))]
+        out [np.ndarray or None] optional contiguous float32 buffer with num_datapoints * N entries
+            if provided, the datapoints are written into it instead of allocating a new array
     Outputs:
         datapoints [np.ndarray] of shape [num_datapoints, N] injected data
     """
     input_dim, data_length = proj_matrix.shape
     num_datapoints = proj_datapoints.shape[0]
-    datapoints = np.dot(proj_datapoints, proj_matrix).astype(np.float32)
+    if out is None:
+        datapoints = np.dot(proj_datapoints, proj_matrix).astype(np.float32)
+    else:
+        assert out.dtype == np.float32 and out.flags['C_CONTIGUOUS'], (
+            'ERROR: dataset_generation/inject_data: out must be a contiguous float32 array')
+        datapoints = np.matmul(proj_datapoints, proj_matrix, out=out.reshape(num_datapoints, data_length))
     if data_shape is None:
         data_edge = int(np.sqrt(data_length))
         datapoints = datapoints.reshape((num_datapoints, 1, data_edge, data_edge))
@@ -250,6 +296,75 @@ def inject_data(proj_matrix, proj_datapoints, image_scale=1.0, data_shape=None):
     return datapoints
 
 
+class ContourDatapoints:
+    """
+    Indexable set of datapoints for every plane in a contour dataset, where each plane is only injected on request
+        Indexing with [target_index][comparison_index] or [target_index, comparison_index] returns the same
+        [num_datapoints]+data_shape array that get_contour_dataset() would have stored for that plane
+    Parameters:
+        proj_matrix [nested list or np.ndarray] indexed by [target_index][comparison_index], each with shape [2, N]
+        proj_datapoints [np.ndarray] of shape [num_datapoints, 2] 2D points to be injected
+        image_scale [float] final norm of datapoints, see inject_data()
+        data_shape [list] shape of each datapoint, see inject_data()
+        reuse_buffer [bool] if True, every request writes into the same preallocated output array,
+            so a returned plane is only valid until the next plane is requested
+    """
+    def __init__(self, proj_matrix, proj_datapoints, image_scale=1.0, data_shape=None, reuse_buffer=False):
+        self.proj_matrix = proj_matrix
+        self.proj_datapoints = proj_datapoints
+        self.image_scale = image_scale
+        self.data_shape = data_shape
+        self.buffer = None
+        if reuse_buffer:
+            data_length = np.asarray(proj_matrix[0][0]).shape[-1]
+            self.buffer = np.empty((proj_datapoints.shape[0], data_length), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.proj_matrix)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self.get(*index)
+        return _ContourDatapointsRow(self, index)
+
+    def __iter__(self):
+        for target_index in range(len(self)):
+            yield self[target_index]
+
+    def get(self, target_index, comparison_index, out=None):
+        """
+        Inject the datapoints for a single plane
+        Parameters:
+            target_index [int] first index into proj_matrix
+            comparison_index [int] second index into proj_matrix
+            out [np.ndarray or None] contiguous float32 output buffer, see inject_data()
+                if None, the shared buffer is used when reuse_buffer is True
+        Outputs:
+            datapoints [np.ndarray] injected data for the plane
+        """
+        if out is None:
+            out = self.buffer
+        return inject_data(self.proj_matrix[target_index][comparison_index], self.proj_datapoints,
+            self.image_scale, self.data_shape, out=out)
+
+
+class _ContourDatapointsRow:
+    """ see ContourDatapoints """
+    def __init__(self, contour_datapoints, target_index):
+        self.contour_datapoints = contour_datapoints
+        self.target_index = target_index
+
+    def __len__(self):
+        return len(self.contour_datapoints.proj_matrix[self.target_index])
+
+    def __getitem__(self, comparison_index):
+        return self.contour_datapoints.get(self.target_index, comparison_index)
+
+    def __iter__(self):
+        for comparison_index in range(len(self)):
+            yield self[comparison_index]
+
+
 def get_datamesh(yx_range, num_images):
     """
     Returns a meshgrid of points within the specified range
@@ -283,28 +398,34 @@ def one_to_many_angles(vec_a, vec_list_b):
     return angles
 
 
-def all_to_all_angles(list_of_vectors):
+def all_to_all_angles(list_of_vectors, chunk_size=1024, normalize=True):
     """
     Compute the angle in degrees between all pairs of vectors
     Parameters:
         list_of_vectors [list] list of vectors (e.g. images) to compute the angle bewteen
+        chunk_size [int] number of rows of the angle matrix to compute per matrix product, to bound memory for large inputs
+        normalize [bool] if False, the vectors are assumed to already have unit l2 norm and are not normalized again
     Outputs:
         vect_angles [np.ndarray] lower triangle of plot matrix only, as a vector in raster order
         angle_matrix [np.ndarray] of shape [num_vectors, num_vectors] with all angles between
             basis functions in the lower triangle and upper triangle is set to -1
     """
     num_vectors = len(list_of_vectors)
-    vector_length = list_of_vectors[0].size
+    normed_vectors = np.stack([np.asarray(vector, dtype=np.float64).reshape(-1) for vector in list_of_vectors], axis=0)
+    if normalize:
+        normed_vectors /= np.linalg.norm(normed_vectors, axis=1, keepdims=True)
     indices = np.tril_indices(num_vectors, 1)
-    vect_size = len(indices[0])
-    vect_angles = np.zeros(vect_size)
     angle_matrix = np.zeros((num_vectors, num_vectors))
-    for angleid, (nid0, nid1) in enumerate(zip(*indices)):
-        vec0 = list_of_vectors[nid0].reshape((vector_length, 1))
-        vec1 = list_of_vectors[nid1].reshape((vector_length, 1))
-        angle = angle_between_vectors(vec0, vec1) * (180 / np.pi) # degrees
-        vect_angles[angleid] = angle
-        angle_matrix[nid0, nid1] = angle
+    for row_start in range(0, num_vectors, chunk_size):
+        row_stop = min(row_start + chunk_size, num_vectors)
+        num_cols = min(row_stop + 1, num_vectors) # tril_indices(num_vectors, 1) includes one column above the diagonal
+        inner_products = np.dot(normed_vectors[row_start:row_stop, :], normed_vectors[:num_cols, :].T)
+        angles = np.arccos(np.clip(inner_products, -1.0, 1.0)) * (180 / np.pi) # degrees
+        row_ids = np.arange(row_start, row_stop)[:, None]
+        col_ids = np.arange(num_cols)[None, :]
+        angle_matrix[row_start:row_stop, :num_cols] = np.where(col_ids <= row_ids + 1, angles, 0)
+    np.fill_diagonal(angle_matrix, 0) # remove rounding errors from self inner products
+    vect_angles = angle_matrix[indices]
     angle_matrix[angle_matrix==0] = -1
     return vect_angles, angle_matrix
 
@@ -327,21 +448,48 @@ def find_orth_vect(matrix):
     return orth_vect
 
 
-def get_rand_orth_vectors(target_vector, num_orth_directions):
+def get_rand_orth_vectors(target_vector, num_orth_directions, rng=None):
     """
     Given an input vector, construct a matrix of normalized column vectors that are orthogonal to the input
     Parameters:
         target_vector [np.ndarray] initial vector of shape [vector_length,]
         num_orth_directions [int] number of orthogonal vectors to construct
+        rng [None, int, or np.random.Generator] source of random numbers, see get_batched_rand_orth_vectors()
     Outputs:
         rand_vectors [np.ndarray] output matrix of shape [num_orth_directions, vector_length] containing vectors
         that are all orthogonal to target_vector
     """
-    rand_vectors = target_vector[None, :] # matrix of alternate vectors
-    for orth_idx in range(num_orth_directions):
-        tmp_vect = find_orth_vect(rand_vectors)
-        rand_vectors = np.append(rand_vectors, tmp_vect[None,:], axis=0)
-    return rand_vectors[1:, :]
+    target_vector = np.asarray(target_vector).reshape(1, -1)
+    return get_batched_rand_orth_vectors(target_vector, num_orth_directions, rng)[0, ...]
+
+
+def get_batched_rand_orth_vectors(target_vectors, num_orth_directions, rng=None):
+    """
+    Construct random orthonormal directions that are orthogonal to each target vector with a single QR decomposition per target
+        This gives the same vectors as applying the Gram-Schmidt process to uniform random vectors, as find_orth_vect() does
+    Parameters:
+        target_vectors [np.ndarray] of shape [num_targets, vector_length]
+        num_orth_directions [int] number of orthogonal vectors to construct for each target, must be less than vector_length
+        rng [None, int, or np.random.Generator] if None, then the global np.random state is used,
+            otherwise it is passed to np.random.default_rng() to seed a new generator
+    Outputs:
+        rand_vectors [np.ndarray] of shape [num_targets, num_orth_directions, vector_length] containing unit vectors
+            that are orthogonal to each other and to the corresponding target vector
+    """
+    num_targets, vector_length = target_vectors.shape
+    assert num_orth_directions < vector_length, (
+        f'num_orth_directions={num_orth_directions} must be less than vector_length={vector_length}')
+    if rng is None:
+        rand_vectors = np.random.random_sample((num_targets, num_orth_directions, vector_length))
+    else:
+        rand_vectors = np.random.default_rng(rng).random((num_targets, num_orth_directions, vector_length))
+    basis = np.concatenate((target_vectors[:, :, None], np.swapaxes(rand_vectors, 1, 2)), axis=2)
+    q_matrix, r_matrix = np.linalg.qr(basis) # batched over targets
+    # flip signs so that each direction matches the Gram-Schmidt orientation
+    signs = np.sign(np.diagonal(r_matrix, axis1=1, axis2=2))
+    signs[signs == 0] = 1
+    q_matrix = q_matrix * signs[:, None, :]
+    return np.swapaxes(q_matrix[:, :, 1:], 1, 2)
 
 
 def get_rand_target_neuron_ids(num_target_ids, num_neurons):
@@ -358,25 +506,24 @@ def get_rand_target_neuron_ids(num_target_ids, num_neurons):
     return list(np.random.choice(range(num_neurons), num_target_ids, replace=False))
 
 
-def compute_rand_vectors(target_vectors, num_comparisons=1):
+def compute_rand_vectors(target_vectors, num_comparisons=1, rng=None):
     """
     Calculate all random orthogonal vectors for a selection of target vectors
     Parameters:
         target_vectors [list] list of target_vector candidates
             (e.g. maximally activating images for neurons)
         num_comparisons [int] number of comparison planes to use for each target neuron
+        rng [None, int, or np.random.Generator] source of random numbers, see get_batched_rand_orth_vectors()
     Outputs:
         norm_target_vectors [list] of normalized vectors of shape [vector_length,] to be used for data generation
         rand_orth_vectors [list of np.ndarrays] each element in the list (one for each target vector) contains
             a matrix of random orthogonal (to each other & to the target vector) & normalized vectors
             with shape [num_comparisons, vector_length]
     """
-    norm_target_vectors = []
-    rand_orth_vectors = []
-    for target_vector in target_vectors:
-        norm_target_vectors.append(l2_normalize(target_vector.reshape(target_vector.size))) # shape is [vector_length,]
-        rand_orth_vectors.append(get_rand_orth_vectors(target_vector, num_comparisons))
-    return (norm_target_vectors, rand_orth_vectors)
+    norm_target_vectors = [l2_normalize(target_vector.reshape(target_vector.size)) # shape is [vector_length,]
+        for target_vector in target_vectors]
+    rand_orth_vectors = get_batched_rand_orth_vectors(np.stack(norm_target_vectors, axis=0), num_comparisons, rng)
+    return (norm_target_vectors, list(rand_orth_vectors))
 
 
 def compute_comp_vectors(all_vectors, target_vector_ids, min_angle=5, num_comparisons=1, comp_method='closest'):
@@ -395,6 +542,9 @@ def compute_comp_vectors(all_vectors, target_vector_ids, min_angle=5, num_compar
             closest in angle to the target vector or random, respectively
     Outputs:
         comparison_vector_ids [list of list] [num_targets][num_comparisons_per_target]
+            vectors with angles of at least min_angle come first, in ascending order of angle; vectors with equal angles
+            are kept in increasing index order (stable sort). They are followed by the remaining (low angle) vectors
+            in increasing index order if there are not enough high angle vectors.
         normed_target_vectors [list] of normalized vectors to be used for data generation
         comparison_vectors [list of np.ndarrays] each element in the list (one for each target vector) contains
             a matrix of non-random orthogonal (to each other & to the target vector) & normalized vectors
@@ -403,55 +553,45 @@ def compute_comp_vectors(all_vectors, target_vector_ids, min_angle=5, num_compar
     TODO: Should extra_indices be 1) random orth vectors, 2) random vectors selected from all_vectors, 3) left as-is, or 4) parameterized to select 1-3
     """
     total_num_vectors = len(all_vectors)
-    vector_length = all_vectors[0].size
+    normed_vectors = np.stack([np.asarray(vector).reshape(-1) for vector in all_vectors], axis=0)
+    normed_vectors = normed_vectors / np.linalg.norm(normed_vectors, axis=1, keepdims=True)
     # angle_matrix is a [total_num_vectors, total_num_vectors] ndarray that
     # gives the angle between all pairs of target vectors
-    angle_matrix = all_to_all_angles(all_vectors)[1]
-    num_below_min = np.count_nonzero(angle_matrix < min_angle) # many angles are -1 or 0
-    # sorted_angle_indices is an [N, 2] ndarray,
-    # where N = total_num_vectors**2 - num_below_min and '2' indexes each axis of angle_matrix
-    sorted_angle_indices = np.stack(np.unravel_index(np.argsort(angle_matrix.ravel()),
-        angle_matrix.shape), axis=1)[num_below_min:, :]
-    # Compute indices of comparison vectors for each target vector
+    angle_matrix = all_to_all_angles(normed_vectors, normalize=False)[1]
+    vector_ids = np.arange(total_num_vectors)
     comparison_vector_ids = [] # list of lists [num_targets][num_comparisons_per_target]
     normed_target_vectors = []
     comparison_vectors = []
     for target_neuron_id in target_vector_ids:
         target_vector = l2_normalize(all_vectors[target_neuron_id])
         normed_target_vectors.append(target_vector)
-        target_neuron_locs = np.argwhere(sorted_angle_indices[:, 0] == target_neuron_id)
+        target_angles = angle_matrix[target_neuron_id, :] # many angles are -1 or 0
         # high_angle_neuron_ids are indices for all neurons that have a high angle (above min_angle) with the target neuron
-        high_angle_neuron_ids = np.squeeze(sorted_angle_indices[target_neuron_locs, 1])
+        high_angle_neuron_ids = np.flatnonzero(target_angles >= min_angle)
         # If there are not enough high angle neurons to satisfy num_comparisons then fill out with other target vectors
-        extra_indices = []
-        for index in range(total_num_vectors):
-            if index not in high_angle_neuron_ids:
-                if index != target_neuron_id:
-                    extra_indices.append(index)
-        if len(extra_indices) > 0:
-            try:
-                sub_comparison_vector_ids = np.concatenate((np.atleast_1d(high_angle_neuron_ids),
-                    np.array(extra_indices)))
-            except:
-              print('ERROR:iso_response_analysis: concatenation failed - likely one of the arrays is size 0')
-              import IPython; IPython.embed(); raise SystemExit
-        else:
-            sub_comparison_vector_ids = high_angle_neuron_ids
+        extra_indices = np.flatnonzero((target_angles < min_angle) & (vector_ids != target_neuron_id))
         if comp_method == 'closest':
-            sub_comparison_vector_ids = sub_comparison_vector_ids[:num_comparisons] # down select the closest ones
+            # only the num_comparisons smallest angles need to be sorted
+            num_high_angle = min(num_comparisons, high_angle_neuron_ids.size)
+            if 0 < num_high_angle < high_angle_neuron_ids.size:
+                # keep every angle up to the num_high_angle-th smallest, in index order so that ties are broken by index
+                high_angles = target_angles[high_angle_neuron_ids]
+                max_angle = np.partition(high_angles, num_high_angle-1)[num_high_angle-1]
+                high_angle_neuron_ids = high_angle_neuron_ids[high_angles <= max_angle]
+            high_angle_neuron_ids = high_angle_neuron_ids[
+                np.argsort(target_angles[high_angle_neuron_ids], kind='stable')][:num_high_angle]
+            extra_indices = extra_indices[:num_comparisons - num_high_angle]
+            sub_comparison_vector_ids = np.concatenate((high_angle_neuron_ids, extra_indices))
         elif comp_method == 'rand':
+            high_angle_neuron_ids = high_angle_neuron_ids[np.argsort(target_angles[high_angle_neuron_ids], kind='stable')]
+            sub_comparison_vector_ids = np.concatenate((high_angle_neuron_ids, extra_indices))
             shuffled_indices = np.random.choice(range(len(sub_comparison_vector_ids)), num_comparisons, replace=False)
             sub_comparison_vector_ids = sub_comparison_vector_ids[shuffled_indices] # pick them at random
         else:
             assert False, (f'comp_method must be "closest" or "rand", not {comp_method}.')
         # Build out matrix of comparison vectors from the computed IDs
-        comparison_vector_matrix = target_vector.T[:, None] # matrix of alternate vectors
-        for comparison_vector_id in sub_comparison_vector_ids:
-            if(comparison_vector_id != target_neuron_id):
-                comparison_vector = np.squeeze(l2_normalize(all_vectors[comparison_vector_id]).T)
-                comparison_vector_matrix = np.append(comparison_vector_matrix, comparison_vector[:,None], axis=1)
         comparison_vector_ids.append(sub_comparison_vector_ids)
-        comparison_vectors.append(comparison_vector_matrix.T[1:,:])
+        comparison_vectors.append(normed_vectors[sub_comparison_vector_ids[sub_comparison_vector_ids != target_neuron_id], :])
     return (comparison_vector_ids, normed_target_vectors, comparison_vectors)
 
 
@@ -489,7 +629,7 @@ def compute_specified_vectors(all_vectors, target_vector_ids, comparison_vector_
     return (normed_target_vectors, comparison_vectors)
 
 
-def get_contour_dataset(target_vectors, comparison_vectors, yx_range, num_images, image_scale=1.0, data_shape=None, return_datapoints=True):
+def get_contour_dataset(target_vectors, comparison_vectors, yx_range, num_images, image_scale=1.0, data_shape=None, return_datapoints=True, lazy_datapoints=False):
     """
     Parameters:
         target_vectors [list] of normalized target vectors
@@ -501,6 +641,8 @@ def get_contour_dataset(target_vectors, comparison_vectors, yx_range, num_images
         image_scale [float] indicating desired length of the image vectors.
             Each normalized image vector will be multiplied by image_scale after being injected into image space.
         return_datapoints [bool] if True, return the datapoints injected into the input space
+        lazy_datapoints [bool] if True (and return_datapoints is True), then all_datapoints is a ContourDatapoints object
+            that only injects a plane's datapoints when it is indexed, instead of storing every plane in memory
     Returns:
         out_dict [dict] containing the following keys:
             proj_target_vect - target vector, projected onto the 2D plane
@@ -542,7 +684,7 @@ def get_contour_dataset(target_vectors, comparison_vectors, yx_range, num_images
             comparison_vect = np.squeeze(comparison_vect)
             proj_matrix = get_proj_matrix(target_vect, comparison_vect)
             orth_vect = np.squeeze(proj_matrix[1,:])
-            if return_datapoints:
+            if return_datapoints and not lazy_datapoints:
                 datapoints_sub_list.append(inject_data(proj_matrix, proj_datapoints, image_scale, data_shape))
             else:
                 datapoints_sub_list.append(None)
@@ -558,10 +700,89 @@ def get_contour_dataset(target_vectors, comparison_vectors, yx_range, num_images
         out_dict['proj_orth_vect'].append(proj_orth_vect_sub_list)
         out_dict['proj_matrix'].append(proj_matrix_sub_list)
     if return_datapoints:
+        if lazy_datapoints:
+            all_datapoints = ContourDatapoints(out_dict['proj_matrix'], proj_datapoints, image_scale, data_shape)
         out_dict['all_datapoints'] = all_datapoints
     return out_dict
 
 
+def get_batched_contour_dataset(target_vectors, comparison_vectors, yx_range, num_images, shared_comparisons=None):
+    """
+    Vectorized version of get_contour_dataset() that computes all projections with a few batched matrix products
+    Parameters:
+        target_vectors [np.ndarray or list] of target vectors, stacked to shape [num_targets, vector_length]
+        comparison_vectors [np.ndarray or list] of comparison vectors, stacked to shape [num_targets, num_comparisons, vector_length]
+            or to shape [num_comparisons, vector_length] if shared_comparisons is True
+        yx_range [list of tuple] indicating [(y_axis_min, y_axis_max), (x_axis_min, x_axis_max)]
+        num_images [int] indicating how many images to compute from each plane. This must have an even square root.
+        shared_comparisons [bool or None] if True, every comparison vector is combined with every target vector.
+            if False, comparison_vectors[t] holds the comparison vectors for target vector t.
+            if None, it is False when comparison_vectors is a 3D array, a list of lists,
+            or a list of [num_comparisons, vector_length] arrays (as returned by compute_comp_vectors()), and True otherwise
+    Returns:
+        out_dict [dict] containing the same keys as get_contour_dataset(), except that the values are contiguous arrays:
+            orth_vect - [num_targets, num_comparisons, vector_length] orthogonal vector in image space
+            proj_target_vect - [num_targets, num_comparisons, 2] target vector, projected onto the 2D plane
+            proj_comparison_vect - [num_targets, num_comparisons, 2] comparison vector, projected onto the 2D plane
+            proj_orth_vect - [num_targets, num_comparisons, 2] orthogonal vector, projected onto the 2D plane
+            proj_matrix - [num_targets, num_comparisons, 2, vector_length] projection matrix for each plane
+            proj_datapoints - datapoint locations in 2D plane
+            x_pts - linear interpolation between x_range[0] and x_range[1]
+            y_pts - linear interpolation between y_range[0] and y_range[1]
+    """
+    num_targets = len(target_vectors)
+    target_vectors = np.stack([np.asarray(target_vect).reshape(-1) for target_vect in target_vectors], axis=0)
+    vector_length = target_vectors.shape[-1]
+    if shared_comparisons is None:
+        if isinstance(comparison_vectors, np.ndarray):
+            shared_comparisons = comparison_vectors.ndim < 3
+        else:
+            first_entry = comparison_vectors[0]
+            shared_comparisons = not (isinstance(first_entry, list)
+                or (np.ndim(first_entry) >= 2 and np.shape(first_entry)[-1] == vector_length))
+    if shared_comparisons: # combine each comparison vector with each target vector
+        comparison_vectors = np.stack([np.asarray(comp_vect).reshape(-1) for comp_vect in comparison_vectors], axis=0)
+        comparison_vectors = np.broadcast_to(comparison_vectors[None, ...], (num_targets,)+comparison_vectors.shape)
+    else: # each target vector has pre-defined comparison vectors
+        comparison_vectors = np.stack([np.asarray(target_comp_vects).reshape(-1, vector_length)
+            for target_comp_vects in comparison_vectors], axis=0)
+    proj_datapoints, x_pts, y_pts = get_datamesh(yx_range, num_images)
+    proj_matrix = get_batched_proj_matrix(target_vectors, comparison_vectors)
+    orth_vect = proj_matrix[:, :, 1, :]
+    out_dict = {
+        'orth_vect': orth_vect,
+        'proj_target_vect': np.matmul(proj_matrix, target_vectors[:, None, :, None])[..., 0],
+        'proj_comparison_vect': np.matmul(proj_matrix, comparison_vectors[..., None])[..., 0],
+        'proj_orth_vect': np.matmul(proj_matrix, orth_vect[..., None])[..., 0],
+        'proj_matrix': proj_matrix,
+        'proj_datapoints': proj_datapoints,
+        'x_pts': x_pts,
+        'y_pts': y_pts
+    }
+    return out_dict
+
+
+def iterate_proj_matrices(target_vectors, comparison_vectors, plane_mask=None):
+    """
+    Generator that computes projection matrices one plane at a time, so that they never have to be stored together
+    Parameters:
+        target_vectors [list] of normalized target vectors
+        comparison_vectors [list of list] of normalized comparison vectors with shape [num_targets][num_comparisons_per_target]
+        plane_mask [np.ndarray or None] boolean array of shape [num_targets, num_comparisons_per_target]
+            if provided, only planes where plane_mask is True are computed
+    Outputs:
+        yields a tuple of ((target_index, comparison_index), proj_matrix)
+            where proj_matrix [np.ndarray] of shape [2, vector_length] is computed with get_proj_matrix()
+    """
+    for target_index, (target_vect, target_comp_vects) in enumerate(zip(target_vectors, comparison_vectors)):
+        target_vect = np.squeeze(target_vect)
+        for comparison_index, comparison_vect in enumerate(target_comp_vects):
+            if plane_mask is not None and not plane_mask[target_index, comparison_index]:
+                continue
+            comparison_vect = np.squeeze(comparison_vect)
+            yield (target_index, comparison_index), get_proj_matrix(target_vect, comparison_vect)
+
+
 def hilbert_amplitude(data, padding=None):
     """
     Compute Hilbert amplitude envelope of data matrix
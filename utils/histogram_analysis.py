@@ -6,10 +6,13 @@ Authors: Dylan Paiton, Santiago Cadena
 
 import os
 import sys
+import hashlib
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import numpy.polynomial.polynomial as poly
-from skimage import measure
+import scipy.stats
 
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
 if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
@@ -17,6 +20,11 @@ if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
 import response_contour_analysis.utils.dataset_generation as data_utils
 import response_contour_analysis.utils.model_handling as model_utils
 
+# distribution fit parameters from compute_curvature_fits(), keyed by get_curvature_fit_key()
+# the least recently used fits are dropped once the cache holds more than CURVATURE_FIT_CACHE_SIZE entries
+CURVATURE_FIT_CACHE_SIZE = 4096
+_curvature_fit_cache = OrderedDict()
+
 def remap_coordinate_to_target(num_vals, coordinate):
     """
     Map coordinate from [0, num_vals-1] to [-1, 1]
@@ -58,140 +66,269 @@ def remap_contrast_to_coordinate(contrast, coordinate_min, coordinate_max):
     return coordinate
 
 
+def normalize_activity_maps(activity_maps):
+    """
+    Renormalize each activity map to be between 0 and 1
+    Parameters:
+        activity_maps [np.ndarray] of shape [num_maps, num_y, num_x]
+    Outputs:
+        normalized_maps [np.ndarray] of shape [num_maps, num_y, num_x], maps that can not be normalized are set to nan
+        valid_maps [np.ndarray] boolean array of shape [num_maps] that is False if the maximum of the map is not
+            positive or the map has a constant value
+    """
+    map_max = activity_maps.max(axis=(1, 2))
+    map_min = activity_maps.min(axis=(1, 2))
+    valid_maps = (map_max > 1e-10) & (map_max > map_min)
+    map_range = np.where(valid_maps, map_max - map_min, 1.0)
+    normalized_maps = (activity_maps - map_min[:, None, None]) / map_range[:, None, None]
+    normalized_maps[~valid_maps, ...] = np.nan
+    return normalized_maps, valid_maps
+
+
+def get_level_crossings(activity_maps, levels):
+    """
+    Find the linearly interpolated locations where each activity map crosses its level along the grid rows & columns
+        These are the same sub-pixel points that skimage.measure.find_contours traces, without ordering them into paths
+    Parameters:
+        activity_maps [np.ndarray] of shape [num_maps, num_y, num_x]
+        levels [np.ndarray] of shape [num_maps] with the level to find for each map
+    Outputs:
+        points [np.ndarray] of shape [num_crossings, 2] with the fractional (row, column) index of each crossing
+        offsets [np.ndarray] of shape [num_maps+1], the crossings for map m are points[offsets[m]:offsets[m+1]]
+            row crossings are listed before column crossings for each map
+    """
+    num_maps = activity_maps.shape[0]
+    above = activity_maps > levels[:, None, None]
+    # crossings along rows, between [y, x] and [y, x+1]
+    row_maps, row_y, row_x = np.nonzero(above[:, :, :-1] != above[:, :, 1:])
+    row_from = activity_maps[row_maps, row_y, row_x]
+    row_to = activity_maps[row_maps, row_y, row_x+1]
+    row_fraction = (levels[row_maps] - row_from) / (row_to - row_from) # values differ on crossed edges
+    # crossings along columns, between [y, x] and [y+1, x]
+    col_maps, col_y, col_x = np.nonzero(above[:, :-1, :] != above[:, 1:, :])
+    col_from = activity_maps[col_maps, col_y, col_x]
+    col_to = activity_maps[col_maps, col_y+1, col_x]
+    col_fraction = (levels[col_maps] - col_from) / (col_to - col_from)
+    # nonzero returns the crossings sorted by map, so each one's position within its map follows from the counts
+    row_offsets = _counts_to_offsets(np.bincount(row_maps, minlength=num_maps))
+    col_offsets = _counts_to_offsets(np.bincount(col_maps, minlength=num_maps))
+    offsets = row_offsets + col_offsets
+    points = np.zeros((offsets[-1], 2))
+    row_index = offsets[row_maps] + np.arange(len(row_maps)) - row_offsets[row_maps]
+    points[row_index, 0] = row_y
+    points[row_index, 1] = row_x + row_fraction
+    col_index = offsets[col_maps] + np.diff(row_offsets)[col_maps] + np.arange(len(col_maps)) - col_offsets[col_maps]
+    points[col_index, 0] = col_y + col_fraction
+    points[col_index, 1] = col_x
+    return points, offsets
+
+
+def _counts_to_offsets(counts):
+    """ offsets [len(counts)+1] into a flat array that holds counts[i] entries for each group i """
+    return np.concatenate(([0], np.cumsum(counts)))
+
+
+def _offsets_to_ids(offsets):
+    """ group index for each entry in a flat array that is described by offsets """
+    return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+
+def _pad_points(values, offsets):
+    """ arrange the flat values for each group into rows of an array that is padded with nan """
+    counts = np.diff(offsets)
+    group_ids = _offsets_to_ids(offsets)
+    padded = np.full((len(counts), counts.max(initial=0)), np.nan)
+    padded[group_ids, np.arange(len(values)) - offsets[group_ids]] = values
+    return padded
+
+
+def quadratic_poly_fits(x_vals, y_vals, group_ids=None, num_groups=None, mask=None):
+    """
+    Least squares fit of y = c0 + c1x + c2x^2 for many independent point sets at once
+        The normal equations for every set are built from the sums of x^k (k<=4) and x^k*y (k<=2),
+        with x centered & scaled within each set, and all of the 3x3 systems are solved together
+    Parameters:
+        x_vals [np.ndarray] of shape [num_groups, num_points] or, if group_ids is given, of shape [num_points]
+        y_vals [np.ndarray] same shape as x_vals
+        group_ids [np.ndarray or None] of shape [num_points] index of the set that each point belongs to, for ragged point sets
+        num_groups [int or None] number of sets when group_ids is given; defaults to group_ids.max()+1
+        mask [np.ndarray or None] of bools, same shape as x_vals, indicating which points to use
+            if None, all points with finite x & y values are used
+    Outputs:
+        coeffs [np.ndarray] of shape [num_groups, 3] containing [c0, c1, c2] for each set, same ordering as numpy polyfit
+            sets with fewer than 3 distinct x values are nan
+        fit_vals [np.ndarray] same shape as x_vals containing the polyval of the fit at each x value, nan for masked points
+    """
+    x_vals = np.asarray(x_vals, dtype=np.float64)
+    y_vals = np.asarray(y_vals, dtype=np.float64)
+    if mask is None:
+        mask = np.isfinite(x_vals) & np.isfinite(y_vals)
+    if group_ids is None:
+        num_groups = x_vals.shape[0]
+        group_ids = np.broadcast_to(np.arange(num_groups)[:, None], x_vals.shape)
+    elif num_groups is None:
+        num_groups = group_ids.max(initial=-1) + 1
+    fit_ids = group_ids[mask]
+    fit_x = x_vals[mask]
+    fit_y = y_vals[mask]
+    # center & scale x within each set, so that the normal equations do not depend on the location or spread of the points
+    num_fit_points = np.bincount(fit_ids, minlength=num_groups)
+    x_center = np.bincount(fit_ids, weights=fit_x, minlength=num_groups) / np.maximum(num_fit_points, 1)
+    x_scale = np.sqrt(np.bincount(fit_ids, weights=(fit_x - x_center[fit_ids])**2, minlength=num_groups)
+        / np.maximum(num_fit_points, 1))
+    x_scale[x_scale == 0] = 1
+    fit_x = (fit_x - x_center[fit_ids]) / x_scale[fit_ids]
+    x_moments = np.stack([np.bincount(fit_ids, weights=fit_x**power, minlength=num_groups)
+        for power in range(5)], axis=1)
+    xy_moments = np.stack([np.bincount(fit_ids, weights=fit_y * fit_x**power, minlength=num_groups)
+        for power in range(3)], axis=1)
+    normal_matrix = np.stack([x_moments[:, row:row+3] for row in range(3)], axis=1)
+    singular_values = np.linalg.svd(normal_matrix, compute_uv=False) # descending
+    solvable = singular_values[:, -1] > 1e-10 * singular_values[:, 0] # relative test, since x is standardized
+    scaled_coeffs = np.full((num_groups, 3), np.nan)
+    if np.any(solvable):
+        scaled_coeffs[solvable, :] = np.linalg.solve(normal_matrix[solvable, ...], xy_moments[solvable, :, None])[..., 0]
+    # undo the standardization, y = a + b(x-m)/s + c((x-m)/s)^2
+    a_coeffs = scaled_coeffs[:, 0]
+    b_coeffs = scaled_coeffs[:, 1] / x_scale
+    c_coeffs = scaled_coeffs[:, 2] / x_scale**2
+    coeffs = np.stack([
+        a_coeffs - b_coeffs * x_center + c_coeffs * x_center**2,
+        b_coeffs - 2 * c_coeffs * x_center,
+        c_coeffs], axis=1)
+    # evaluate in the standardized coordinates, which avoids cancellation for sets that are far from the origin
+    point_coeffs = scaled_coeffs[group_ids, :]
+    point_x = (x_vals - x_center[group_ids]) / x_scale[group_ids]
+    fit_vals = point_coeffs[..., 0] + point_coeffs[..., 1] * point_x + point_coeffs[..., 2] * point_x**2
+    fit_vals[~mask] = np.nan
+    return coeffs, fit_vals
+
+
+def iso_response_curvature_point_fits(x_contour_pts, y_contour_pts, group_ids, num_groups):
+    """
+    Fit iso-response curvature to scattered contour points from many contours at once
+    Parameters:
+        x_contour_pts [np.ndarray] of shape [num_points] x location of each contour point
+        y_contour_pts [np.ndarray] of shape [num_points] y location of each contour point
+        group_ids [np.ndarray] of ints with shape [num_points] indicating which contour each point belongs to
+        num_groups [int] number of contours
+    Outputs:
+        coeffs [np.ndarray] of shape [num_groups, 3] with [c0, c1, c2] for x = c0 + c1y + c2y^2, where c2 is the curvature
+        fit_mask [np.ndarray] of bools with shape [num_points] indicating which points were used for the fit
+        x_fit_pts [np.ndarray] of shape [num_points] fit x value at each y value, nan for points that were not used
+    """
+    # Don't use points that lie along the y axis, to fix edge artifacts
+    x_pos = x_contour_pts > 0
+    use_x_pos = np.bincount(group_ids[x_pos], minlength=num_groups) > 3
+    fit_mask = x_pos | ~use_x_pos[group_ids]
+    # polyfit assumes the convexity is up/down, while we will have left/right
+    # To get around this, we swap the x and y axis for the fit and then swap back
+    # coeffs are [c0, c1, c2], where p = c0 + c1x + c2x^2
+    coeffs, x_fit_pts = quadratic_poly_fits(y_contour_pts, x_contour_pts, group_ids=group_ids, num_groups=num_groups,
+        mask=fit_mask)
+    return coeffs, fit_mask, x_fit_pts
+
+
 def iso_response_curvature_poly_fits(activations, target, target_is_act=True, yx_scale=[1, 1]):
     """
     Parameters:
         activations [np.ndarray] first index is the target neuron, second index is the data plane
-        target [float] target activity for finding iso-response contours OR target position along x axis for finding the target activity
+        target [float or sequence of floats] target activity for finding iso-response contours OR target position along x axis for finding the target activity
             if target_is_act is true, then target refers to normalized activity for the given feature map, i.e. it should be between 0 (minimum activity) and 1 (maximum activity)
             if target_is_act is false, then target refers to a position on the x axis from -1 (left most point) to 1 (right most point)
+            if a sequence is given, then contours are fit for every target level and the outputs have a leading [num_levels] axis
         target_is_act [bool] if True, then the 'target' parameter is an activation value, else the 'target' parameter is the x axis position
         yx_scale [list of ints] y and x (respectively) scale factors for remapping activations to the data domain
     Outputs:
-        curvatures [list of lists] of lengths [num_neurons][num_planes] which contain the estimated iso-response curvature coefficient for the given neuron and plane
-        fits [list of lists] of lengths [num_neurons][num_planes] which contain the polyval line fits for the given computed coefficients
+        curvatures [np.ndarray] of shape [num_neurons, num_planes] which contain the estimated iso-response curvature coefficient for the given neuron and plane
+        fits [np.ndarray] of shape [num_neurons, num_planes, 2, num_points] which contain the (x, y) polyval line fits for the given computed coefficients
+        contours [np.ndarray] of shape [num_neurons, num_planes, 2, num_points] which contain the (x, y) contour points used for the fits
+            fits and contours are padded with nan, and num_points is the maximum number of contour points for any map
     Notes:
-        this function uses scikit.measure.find_contours, documented here:
-        https://scikit-image.org/docs/0.16.x/api/skimage.measure.html#skimage.measure.find_contours
-    """
-    contours_list = []; curvatures = []; fits = []
-    for neuron_id in range(activations.shape[0]):
-        sub_contours = []; sub_curvatures = []; sub_fits = []
-        for plane_id in range(activations.shape[1]):
-            activity = activations[neuron_id, plane_id, ...]
-            if activity.max() > 0.0:
-                num_y, num_x = activity.shape
-                #activity[:, :(num_x//2-1)] = 0 # remove data for x<0
-                if np.abs(activity.max()) <= 1e-10:
-                    print(
-                        f'WARNING: iso_response_curvature_poly_fits: '
-                        +'maximum value of activations for '
-                        +f'neuron_index={neuron_id}, comparison_index={plane_id}, is {activity.max()}'
-                    )
-                    sub_contours.append(np.nan)
-                    sub_curvatures.append(np.nan)
-                    sub_fits.append(np.nan)
-                    continue
-                activity = activity - activity.min() # renormalize to be between 0 and 1
-                activity = activity / activity.max()
-                if target_is_act:
-                    assert (0 <= target <= 1), (f'utils/histogram_analysis: ERROR: target={target} must in the inclusive range [0, 1]')
-                    target_act = target
-                else: # target is x axis position
-                    target_pos = remap_target_to_coordinate(num_x, target)
-                    target_act = activity[(num_y//2)-1, target_pos]
-                try: # compute curvature
-                    contours = measure.find_contours(activity, target_act)
-                    contours = np.concatenate(contours, axis=0) # Grab all of them together
-                except:
-                    print('ERROR: iso_response_curvature_poly_fits: Unable to find iso-response contours...')
-                    import IPython; IPython.embed(); raise SystemExit
-                    
-                # Rescale contour location to actual data range
-                y_contour_pts = contours[:,0] * yx_scale[0] - (num_y * yx_scale[0] / 2)
-                x_contour_pts = contours[:,1] * yx_scale[1] - (num_x * yx_scale[1] / 2)
-                
-                # Don't use points that lie along the y axis, to fix edge artifacts
-                x_pos = np.argwhere(x_contour_pts>0) 
-                if x_pos.size > 3:
-                    y_contour_pts_proc = np.squeeze(y_contour_pts[x_pos])
-                    x_contour_pts_proc = np.squeeze(x_contour_pts[x_pos])
-                else:
-                    y_contour_pts_proc = y_contour_pts
-                    x_contour_pts_proc = x_contour_pts
-                
-                # polyfit assumes the convexity is up/down, while we will have left/right
-                # To get around this, we swap the x and y axis for the polyfit and then swap back
-                # polyfit returns [c0, c1, c2], where p = c0 + c1x + c2x^2
-                try:
-                    coeffs = poly.polyfit(x=y_contour_pts_proc, y=x_contour_pts_proc, deg=2) 
-                except:
-                    print('ERROR: iso_response_curvature-poly_fits: polyfit failed.')
-                    import IPython; IPython.embed(); raise SystemExit
-                sub_contours.append((x_contour_pts_proc, y_contour_pts_proc))
-                sub_curvatures.append(coeffs[-1])
-                sub_fits.append((poly.polyval(y_contour_pts_proc, coeffs), y_contour_pts_proc))
-            else:
-                print('WARNING: iso_response_curvature_poly_fits: Maximum value of activations for '
-                    +f'neuron_index={neuron_id}, comparison_index={plane_id}, is {activity.max}')
-                sub_contours.append(np.nan)
-                sub_curvatures.append(np.nan)
-                sub_fits.append(np.nan)
-        contours_list.append(sub_contours)
-        curvatures.append(sub_curvatures)
-        fits.append(sub_fits)
-    return (curvatures, fits, contours_list)
+        All maps are processed together: the contour points are the linearly interpolated level crossings along the grid
+        rows & columns (see get_level_crossings) and the quadratic fits are solved together with quadratic_poly_fits()
+        The maps are normalized once and reused for every target level
+    """
+    levels = np.asarray(target, dtype=np.float64).ravel()
+    if target_is_act:
+        assert np.all((0 <= levels) & (levels <= 1)), (
+            f'utils/histogram_analysis: ERROR: target={target} must in the inclusive range [0, 1]')
+    num_neurons, num_planes, num_y, num_x = activations.shape
+    num_maps = num_neurons * num_planes
+    num_levels = len(levels)
+    activity, valid_maps = normalize_activity_maps(activations.reshape(num_maps, num_y, num_x))
+    for map_index in np.flatnonzero(~valid_maps):
+        neuron_id, plane_id = np.unravel_index(map_index, (num_neurons, num_planes))
+        print('WARNING: iso_response_curvature_poly_fits: Maximum value of activations for '
+            +f'neuron_index={neuron_id}, comparison_index={plane_id}, is {activations[neuron_id, plane_id, ...].max()}')
+    if target_is_act:
+        target_acts = np.broadcast_to(levels[:, None], (num_levels, num_maps))
+    else: # target is x axis position
+        target_pos = [remap_target_to_coordinate(num_x, level) for level in levels]
+        target_acts = activity[:, (num_y//2)-1, target_pos].T # [num_levels, num_maps]
+    # the fits for every level & map are solved together, with map m at level l in group l * num_maps + m
+    group_ids = []; y_contour_pts = []; x_contour_pts = []
+    for level_index, target_act in enumerate(target_acts):
+        contour_pts, offsets = get_level_crossings(activity, target_act) # invalid maps are nan and never cross
+        group_ids.append(level_index * num_maps + _offsets_to_ids(offsets))
+        # Rescale contour location to actual data range
+        y_contour_pts.append(contour_pts[:, 0] * yx_scale[0] - (num_y * yx_scale[0] / 2))
+        x_contour_pts.append(contour_pts[:, 1] * yx_scale[1] - (num_x * yx_scale[1] / 2))
+    group_ids = np.concatenate(group_ids)
+    y_contour_pts = np.concatenate(y_contour_pts)
+    x_contour_pts = np.concatenate(x_contour_pts)
+    num_groups = num_levels * num_maps
+    coeffs, fit_mask, x_fit_pts = iso_response_curvature_point_fits(x_contour_pts, y_contour_pts, group_ids, num_groups)
+    group_ids = group_ids[fit_mask]; y_contour_pts = y_contour_pts[fit_mask]
+    x_contour_pts = x_contour_pts[fit_mask]; x_fit_pts = x_fit_pts[fit_mask]
+    offsets = _counts_to_offsets(np.bincount(group_ids, minlength=num_groups))
+    y_contour_pts = _pad_points(y_contour_pts, offsets)
+    fits = np.stack((_pad_points(x_fit_pts, offsets), y_contour_pts), axis=1)
+    contours = np.stack((_pad_points(x_contour_pts, offsets), y_contour_pts), axis=1)
+    output_shape = np.shape(target) + (num_neurons, num_planes)
+    curvatures = coeffs[:, -1].reshape(output_shape)
+    fits = fits.reshape(output_shape + fits.shape[1:])
+    contours = contours.reshape(output_shape + contours.shape[1:])
+    return (curvatures, fits, contours)
 
 
 def response_attenuation_curvature_poly_fits(activations, target, target_is_act, x_pts, y_pts):
     """
     Parameters:
         activations [tuple] first element is the comp activations returned from utils/model_handling.get_contour_dataset_activations() and the secdond element is rand activations
-        x_pts [np.ndarray] of size (num_images,) that were the x points used for the contour dataset
-        y_pts [np.ndarray] of size (num_images,) that were the y points used for the contour dataset
-        target [float] target activity for finding iso-response contours OR target position along x axis for finding the target activity
+        x_pts [np.ndarray] of size (num_x,) that were the x points used for the contour dataset
+        y_pts [np.ndarray] of size (num_y,) that were the y points used for the contour dataset
+        target [float or sequence of floats] target activity for finding iso-response contours OR target position along x axis for finding the target activity
             if target_is_act is false, then target refers to a position on the x axis from -1 (left most point) to 1 (right most point)
+            if a sequence is given, then a slice is fit for every target level and the outputs have a leading [num_levels] axis
         target_is_act [bool] if True, then the 'target' parameter is an activation value, else the 'target' parameter is the x axis position
     Outputs:
-        curvatures [list of lists] of lengths [num_neurons, num_planes] which contain the estimated response attenuation curvature coefficient for the given neuron and plane
-        fits [list of lists] of lengths [num_neurons, num_planes] which contain the polyval line fits for the given computed coefficients
-        sliced_activity [list of lists] of lengths [num_neurons, num_planes] which contain a vector of activity values for the chosen x value
-    """
-    curvatures = []; fits = []; sliced_activity = []
-    for neuron_index in range(activations.shape[0]):
-        sub_curvatures = []; sub_fits = []; sub_sliced_activity = []
-        for orth_index in range(activations.shape[1]):
-            activity = activations[neuron_index, orth_index, ...] # [y, x]
-            num_y, num_x = activity.shape
-            # TODO: Verify this fix was correct. first index was originally 0, which would be along the top
-            x_act = np.squeeze(activity[num_y//2, :])
-            if target_is_act:
-                closest_target_act = x_act[np.abs(x_act - target).argmin()] # find a location to take a slice
-            else:
-                target_pos = int(num_x * ((target + 1) / 2)) # map [-1, 1] to [0, num_x]
-                closest_target_act = x_act[target_pos]
-            try:
-                x_target_index = np.argwhere(x_act == closest_target_act)[0].item() # find the index along x axis
-            except:
-                print('Warning: slicing activity matrix failed.')
-                import IPython; IPython.embed(); raise SystemExit
-            x_target = x_pts[x_target_index] # find the x value at this index
-            num_images = num_y * num_x
-            X_mesh, Y_mesh = np.meshgrid(x_pts, y_pts)
-            proj_datapoints = np.stack([X_mesh.reshape(num_images), Y_mesh.reshape(num_images)], axis=1)
-            slice_indices = np.where(proj_datapoints[:, 0] == x_target)[0]
-            slice_datapoints = proj_datapoints[slice_indices, :][:, :] # slice grid
-            slice_activity = activity.reshape([-1])[slice_indices][:]
-            sub_sliced_activity.append(slice_activity)
-            x_vals = slice_datapoints[:, 1]
-            y_vals = slice_activity * -1 # flip so that response attenuation gives positive curvature
-            # polyfit returns [c0, c1, c2], where p = c0 + c1x + c2x^2
-            coeffs = poly.polyfit(x_vals, y_vals, deg=2)
-            sub_curvatures.append(coeffs[-1])
-            sub_fits.append((x_vals, poly.polyval(x_vals, coeffs)))
-        curvatures.append(sub_curvatures)
-        fits.append(sub_fits)
-        sliced_activity.append(sub_sliced_activity)
+        curvatures [np.ndarray] of shape [num_neurons, num_planes] which contain the estimated response attenuation curvature coefficient for the given neuron and plane
+        fits [np.ndarray] of shape [num_neurons, num_planes, 2, num_y] which contain the (x, polyval) line fits for the given computed coefficients
+        sliced_activity [np.ndarray] of shape [num_neurons, num_planes, num_y] which contain a vector of activity values for the chosen x value
+    """
+    num_neurons, num_planes, num_y, num_x = activations.shape
+    num_maps = num_neurons * num_planes
+    activity = activations.reshape(num_maps, num_y, num_x)
+    levels = np.asarray(target, dtype=np.float64).ravel()
+    # TODO: Verify this fix was correct. first index was originally 0, which would be along the top
+    x_act = activity[:, num_y//2, :]
+    if target_is_act:
+        x_target_index = np.abs(x_act[None, ...] - levels[:, None, None]).argmin(axis=-1) # find a location to take a slice
+    else:
+        target_pos = (num_x * ((levels + 1) / 2)).astype(int) # map [-1, 1] to [0, num_x]
+        target_act = x_act[:, target_pos].T # [num_levels, num_maps]
+        x_target_index = (x_act[None, ...] == target_act[..., None]).argmax(axis=-1) # first index along x axis with the target activity
+    # all maps share the same grid, so the slice at x_pts[x_target_index] is the column of activity at that index
+    output_shape = np.shape(target) + (num_neurons, num_planes)
+    sliced_activity = activity[np.arange(num_maps)[None, :], :, x_target_index].reshape(output_shape + (num_y,))
+    slice_x_vals = np.broadcast_to(np.asarray(y_pts, dtype=np.float64), sliced_activity.shape)
+    x_vals = slice_x_vals.reshape(-1, num_y)
+    y_vals = sliced_activity.reshape(-1, num_y) * -1 # flip so that response attenuation gives positive curvature
+    # coeffs are [c0, c1, c2], where p = c0 + c1x + c2x^2
+    coeffs, fit_vals = quadratic_poly_fits(x_vals, y_vals)
+    curvatures = coeffs[:, -1].reshape(output_shape)
+    fits = np.stack((slice_x_vals, fit_vals.reshape(sliced_activity.shape)), axis=-2)
     return (curvatures, fits, sliced_activity)
 
 
@@ -249,16 +386,19 @@ def compute_curvature_poly_fits(activations, contour_dataset, target, target_is_
         contour_dataset [dict] that must contain keys "x_pts" and "y_pts" from utils/dataset_generation.get_contour_dataset()
           x_pts [np.ndarray] of size (num_images,) that were the points used for the contour dataset
           proj_datapoints [np.ndarray] of stacked vectorized datapoint locations (from a mesh grid) for the 2D contour dataset
-        target [float] target activity for finding iso-response contours OR target position along x axis for finding the target activity
+        target [float or sequence of floats] target activity for finding iso-response contours OR target position along x axis for finding the target activity
             if target_is_act is false, then target refers to a position on the x axis from -1 (left most point) to 1 (right most point)
+            if a sequence of levels is given, then all levels are measured from the same activations
         target_is_act [bool] if True, then the 'target' parameter is an activation value, else the 'target' parameter is the x axis position
         bounds [nested tuple] containing ((y_min, y_max), (x_min, x_max)) for the window within which curvature should be measured
     outputs:
-        iso_curvatures [list of lists] of lengths [num_neurons, num_planes] which contain the estimated iso-response curvature coefficient for the given neuron and plane
-        attn_curvatures [list of lists] of lengths [num_neurons, num_planes] which contain the estimated response attenuation curvature coefficient for the given neuron and plane
+        iso_curvatures [np.ndarray] of shape [num_neurons, num_planes] which contain the estimated iso-response curvature coefficient for the given neuron and plane
+        attn_curvatures [np.ndarray] of shape [num_neurons, num_planes] which contain the estimated response attenuation curvature coefficient for the given neuron and plane
+            if target is a sequence, then both outputs have shape [num_levels, num_neurons, num_planes]
     """
     yx_pts = (contour_dataset['y_pts'].copy(), contour_dataset['x_pts'].copy())
-    yx_scale_factors, yx_lims = get_scale_factors(yx_pts, activations.shape, bounds)
+    num_y, num_x = activations.shape[-2:]
+    yx_scale_factors, yx_lims = get_scale_factors(yx_pts, num_y, num_x, bounds)
     ((start_y, end_y), (start_x, end_x)) = yx_lims
     iso_curvatures, iso_fits, iso_contours = iso_response_curvature_poly_fits(
         activations[:, :, start_y:end_y, start_x:end_x],
@@ -269,11 +409,85 @@ def compute_curvature_poly_fits(activations, contour_dataset, target, target_is_
         activations[:, :, start_y:end_y, start_x:end_x],
         target,
         target_is_act,
-        yx_pts[1],
-        yx_pts[0])
+        yx_pts[1][start_x:end_x],
+        yx_pts[0][start_y:end_y])
     return (iso_curvatures, attn_curvatures)
 
 
+def _curvature_poly_fits_worker(response_images, yx_pts, target, target_is_act, bounds):
+    """ compute_curvature_poly_fits() for a stack of response images [num_images, y, x] in a worker process """
+    contour_dataset = {'y_pts': yx_pts[0], 'x_pts': yx_pts[1]}
+    iso_curvatures, attn_curvatures = compute_curvature_poly_fits(
+        response_images[:, None, ...], contour_dataset, target, target_is_act, bounds)
+    # [(num_levels,) num_images, 1] -> [num_images, (num_levels)]
+    return (np.moveaxis(iso_curvatures[..., 0], -1, 0), np.moveaxis(attn_curvatures[..., 0], -1, 0))
+
+
+def iterate_curvature_poly_fits(response_images, contour_dataset, target, target_is_act=True, bounds=None,
+        num_workers=4, chunk_size=64, max_pending_chunks=None, mp_context=None):
+    """
+    Compute iso-response & response attenuation curvatures for a stream of response images with a pool of worker processes
+        The response images are grouped into chunks that are fit in the background while the caller keeps producing
+        images, e.g. with utils/model_handling.iterate_response_images(). At most max_pending_chunks are in flight;
+        when that many are pending the oldest chunk is waited on before more images are pulled from response_images,
+        so a fast producer is paused instead of queueing an unbounded number of maps in memory.
+    Parameters:
+        response_images [iterable] yielding (key, response_image) tuples, where response_image is an np.ndarray of shape [y, x]
+        contour_dataset [dict] that must contain keys 'x_pts' and 'y_pts', see compute_curvature_poly_fits()
+        target [float] see compute_curvature_poly_fits()
+        target_is_act [bool] see compute_curvature_poly_fits()
+        bounds [nested tuple] see compute_curvature_poly_fits()
+        num_workers [int] number of worker processes; if 0, then the fits are computed in the calling process
+        chunk_size [int] number of response images that are sent to a worker at a time
+        max_pending_chunks [int or None] maximum number of chunks that have been submitted but not yet yielded
+            if None, it is set to 2 * num_workers
+        mp_context [multiprocessing context or None] start method for the worker processes; if None, 'spawn' is used,
+            because the caller is usually running torch models and forking a process that holds torch threads can hang
+    Outputs:
+        generator that yields (key, iso_curvature, attn_curvature) tuples in the same order as response_images
+            the curvatures are floats, or arrays of shape [num_levels] if target is a sequence
+    """
+    yx_pts = (contour_dataset['y_pts'].copy(), contour_dataset['x_pts'].copy())
+    if num_workers == 0:
+        executor = None
+        max_pending_chunks = 1
+    else:
+        if mp_context is None:
+            mp_context = multiprocessing.get_context('spawn')
+        executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context)
+        if max_pending_chunks is None:
+            max_pending_chunks = 2 * num_workers
+    pending_chunks = deque() # FIFO of (keys, future or result)
+    def collect_oldest_chunk():
+        keys, fit_results = pending_chunks.popleft()
+        iso_curvatures, attn_curvatures = fit_results.result() if executor is not None else fit_results
+        return zip(keys, iso_curvatures, attn_curvatures)
+    def submit_chunk(keys, images):
+        images = np.stack(images, axis=0)
+        if executor is None:
+            fit_results = _curvature_poly_fits_worker(images, yx_pts, target, target_is_act, bounds)
+        else:
+            fit_results = executor.submit(_curvature_poly_fits_worker, images, yx_pts, target, target_is_act, bounds)
+        pending_chunks.append((keys, fit_results))
+    try:
+        chunk_keys = []; chunk_images = []
+        for key, response_image in response_images:
+            chunk_keys.append(key)
+            chunk_images.append(response_image)
+            if len(chunk_keys) == chunk_size:
+                submit_chunk(chunk_keys, chunk_images)
+                chunk_keys = []; chunk_images = []
+                while len(pending_chunks) >= max_pending_chunks:
+                    yield from collect_oldest_chunk()
+        if len(chunk_keys) > 0:
+            submit_chunk(chunk_keys, chunk_images)
+        while len(pending_chunks) > 0:
+            yield from collect_oldest_chunk()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
 def get_relative_hist(curvatures, bins):
     """
     Compute relative histogram for curvature values,
@@ -385,7 +599,29 @@ def compute_curvature_hists(curvatures, num_bins):
     return [all_hists, all_bin_edges]
 
 
-def compute_curvature_fits(curvatures, dist_name='gennorm'):
+def get_curvature_fit_key(curvatures, dist_name):
+    """
+    Parameters:
+        curvatures [list of floats] curvature values for a single target neuron
+        dist_name [str] name of the scipy.stats distribution
+    Outputs:
+        key [tuple] of (dist_name, hex digest of the curvature values), identical curvature values give identical keys
+    """
+    curvature_bytes = np.ascontiguousarray(curvatures, dtype=np.float64).tobytes()
+    return (dist_name, hashlib.sha1(curvature_bytes).hexdigest())
+
+
+def clear_curvature_fit_cache():
+    """ remove all cached fits from compute_curvature_fits() """
+    _curvature_fit_cache.clear()
+
+
+def _fit_distribution(dist_name, curvatures):
+    """ scipy.stats fit for one set of curvatures, defined at module level so that it can be run in a worker process """
+    return getattr(scipy.stats, dist_name).fit(curvatures)
+
+
+def compute_curvature_fits(curvatures, dist_name='gennorm', num_workers=0, use_cache=True, mp_context=None):
     """
     Compute fits for all curvatures with shared support across curvature types
     Parameters:
@@ -397,23 +633,52 @@ def compute_curvature_fits(curvatures, dist_name='gennorm'):
         dist_name [str] name of the distribution for fitting.
             Must be one of the continuous distributions listed on:
             https://docs.scipy.org/doc/scipy/reference/stats.html
+        num_workers [int] number of worker processes for fitting; if 0, then the fits are computed in the calling process
+        use_cache [bool] if True, fits are looked up in & added to a module-level cache that is keyed by the
+            distribution name and a hash of the curvature values (see get_curvature_fit_key()), so repeated calls
+            with the same curvatures do not refit them. The cache keeps the CURVATURE_FIT_CACHE_SIZE most recently
+            used fits and can be emptied with clear_curvature_fit_cache()
+        mp_context [multiprocessing context or None] see iterate_curvature_poly_fits()
     Outputs:
         all_fits [nested list of (param) tuples] that is indexed by
             [curvature type]
             [dataset type]
             [target neuron id]
+        dist [scipy.stats.rv_continuous] the distribution that was fit
     """
     dist = getattr(scipy.stats, dist_name)
-    all_fits = []
-    for type_curvatures in curvatures:
-        type_sub_fits = []
-        for dataset_curvatures in type_curvatures:
-            dataset_sub_fits = []
-            for neuron_curvatures in dataset_curvatures:
-                params = dist.fit(neuron_curvatures)
-                dataset_sub_fits.append(params)
-            type_sub_fits.append(dataset_sub_fits)
-        all_fits.append(type_sub_fits)
+    all_keys = [[[get_curvature_fit_key(neuron_curvatures, dist_name) for neuron_curvatures in dataset_curvatures]
+        for dataset_curvatures in type_curvatures]
+        for type_curvatures in curvatures]
+    fits = {} # fits for every unique key in this call
+    fit_curvatures = {} # unique curvature vectors that have not been fit yet
+    for type_curvatures, type_keys in zip(curvatures, all_keys):
+        for dataset_curvatures, dataset_keys in zip(type_curvatures, type_keys):
+            for neuron_curvatures, key in zip(dataset_curvatures, dataset_keys):
+                if key in fits or key in fit_curvatures:
+                    continue
+                if use_cache and key in _curvature_fit_cache:
+                    _curvature_fit_cache.move_to_end(key)
+                    fits[key] = _curvature_fit_cache[key]
+                else:
+                    fit_curvatures[key] = neuron_curvatures
+    if num_workers > 0 and len(fit_curvatures) > 1:
+        if mp_context is None:
+            mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context) as executor:
+            params = executor.map(_fit_distribution, [dist_name]*len(fit_curvatures), fit_curvatures.values())
+            new_fits = dict(zip(fit_curvatures.keys(), params))
+    else:
+        new_fits = {key: _fit_distribution(dist_name, neuron_curvatures)
+            for key, neuron_curvatures in fit_curvatures.items()}
+    fits.update(new_fits)
+    if use_cache:
+        _curvature_fit_cache.update(new_fits)
+        while len(_curvature_fit_cache) > CURVATURE_FIT_CACHE_SIZE:
+            _curvature_fit_cache.popitem(last=False)
+    all_fits = [[[fits[key] for key in dataset_keys]
+        for dataset_keys in type_keys]
+        for type_keys in all_keys]
     return all_fits, dist
 
 
@@ -470,9 +735,16 @@ def polynomial_iso_response_curvature(model, plane_abscissae, plane_ordinates, e
         num_images=experiment_params['num_images'],
         image_scale=experiment_params['image_scale'],
         data_shape=experiment_params['data_shape'],
-        return_datapoints=True
+        return_datapoints=False
+    )
+    # planes are injected one at a time into a single reused buffer
+    all_datapoints = data_utils.ContourDatapoints(
+        contour_dataset['proj_matrix'],
+        contour_dataset['proj_datapoints'],
+        experiment_params['image_scale'],
+        experiment_params['data_shape'],
+        reuse_buffer=True
     )
-    all_datapoints = contour_dataset.pop('all_datapoints')
     num_neurons_per_plane = 1
     num_edge_images = int(np.sqrt(experiment_params['num_images']))
     num_target_planes = len(contour_dataset['proj_matrix'])
@@ -4,9 +4,18 @@ Utility funcions for managing pytorch models
 Authors: Dylan Paiton, Santiago Cadena
 """
 
+import os
+import sys
+import hashlib
+
 import torch
 import numpy as np
 
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..'))
+if ROOT_DIR not in sys.path: sys.path.append(ROOT_DIR)
+
+import response_contour_analysis.utils.dataset_generation as data_utils
+
 def unit_activation(model, images, target_neuron, compute_grad=True):
     model.zero_grad()
     if type(images) is np.ndarray:
@@ -67,16 +76,77 @@ def normalize_ensemble_activations(activations):
     return normalized_activations
     
 
-def get_contour_dataset_activations(model, contour_dataset, target_model_ids, get_activation_function, normalize=True, activation_function_kwargs={}):
+def _get_plane_key(contour_dataset, target_index, comparison_index):
+    """
+    Hashable key that is identical for planes with identical datapoints
+        For a utils/dataset_generation.ContourDatapoints the key is computed from the plane's [2, datapoint_length]
+        proj_matrix, so the plane does not need to be injected; otherwise it is computed from the datapoints
+    """
+    if isinstance(contour_dataset, data_utils.ContourDatapoints):
+        plane_array = np.asarray(contour_dataset.proj_matrix[target_index][comparison_index])
+    else:
+        plane_array = contour_dataset[target_index][comparison_index]
+    return (plane_array.shape, hashlib.sha1(np.ascontiguousarray(plane_array).tobytes()).hexdigest())
+
+
+def get_shared_plane_activations(model, contour_dataset, target_model_ids, get_activation_function, normalize=True, activation_function_kwargs={}):
+    """
+    Evaluate each unique plane once for every neuron that is recorded on it
+        Planes with identical datapoints (e.g. when several targets share a plane) are only injected once,
+        and get_activation_function is called once per unique (plane, neuron) pair with a single int neuron index,
+        the same contract as get_contour_dataset_activations()
+    Parameters:
+        see get_contour_dataset_activations(); contour_dataset can also be a utils/dataset_generation.ContourDatapoints,
+        in which case planes are compared by their proj_matrix
+    Returns:
+        ndarray with shape [1, num_target_planes, num_comparison_planes, num_datapoints_y, num_datapoints_x],
+            where plane (t, c) holds the activations of neuron target_model_ids[t], the same as get_contour_dataset_activations()
+    """
+    num_target_planes = len(contour_dataset)
+    num_comparison_planes = len(contour_dataset[0])
+    plane_indices = {} # maps a plane key to the (target_index, comparison_index) of every occurrence of the plane
+    for target_index in range(num_target_planes):
+        for comparison_index in range(num_comparison_planes):
+            plane_key = _get_plane_key(contour_dataset, target_index, comparison_index)
+            plane_indices.setdefault(plane_key, []).append((target_index, comparison_index))
+    all_activations = None
+    for plane_key, plane_occurrences in plane_indices.items():
+        target_index, comparison_index = plane_occurrences[0]
+        datapoints = contour_dataset[target_index][comparison_index]
+        num_images = datapoints.shape[0]
+        num_edge_images = int(np.sqrt(num_images))
+        if np.any(np.isnan(datapoints)):
+            print('WARNING:From model_handling/get_shared_plane_activations: nan in contour_dataset matrix for '
+                +f'target_index={target_index}')
+        if all_activations is None:
+            all_activations = np.zeros((1, num_target_planes, num_comparison_planes, num_edge_images, num_edge_images))
+        neuron_activations = {} # maps a neuron id to its activation map on this plane
+        for target_index, comparison_index in plane_occurrences:
+            neuron_id = int(target_model_ids[target_index])
+            if neuron_id not in neuron_activations:
+                activations = get_activation_function(model, datapoints, neuron_id, **activation_function_kwargs)
+                if normalize:
+                    activations = normalize_single_neuron_activations(activations)
+                neuron_activations[neuron_id] = np.asarray(activations).reshape(num_edge_images, num_edge_images)
+            all_activations[0, target_index, comparison_index, ...] = neuron_activations[neuron_id]
+    return all_activations
+
+
+def get_contour_dataset_activations(model, contour_dataset, target_model_ids, get_activation_function, normalize=True, activation_function_kwargs={}, shared_planes=False):
     """
     Parameters:
         target_model_ids [list of ints] with shape [num_target_neurons] indicating which neuron index for activations
         contour_dataset [list of list of ndarray] with shapes [num_target_neurons][num_comparisons_per_target][num_datapoints, datapoint_length]
         get_activation_function [python function] which can be called to get the [np.ndarray] activations from a model for a given input image
         activation_function_kwargs [dict] other keyword arguments to be passed to get_activation_function()
+        shared_planes [bool] if True (and target_model_ids is not None), then each unique plane is evaluated once for all
+            target_model_ids, see get_shared_plane_activations()
     Returns:
         ndarray with shape [num_target_neurons, num_target_planes, num_comparison_planes, num_datapoints_y, num_datapoints_x]
     """
+    if shared_planes and target_model_ids is not None:
+        return get_shared_plane_activations(model, contour_dataset, target_model_ids, get_activation_function,
+            normalize, activation_function_kwargs)
     activations_list = []
     for target_index, target_dataset in enumerate(contour_dataset):
         activations_sub_list = []
@@ -100,4 +170,261 @@ def get_contour_dataset_activations(model, contour_dataset, target_model_ids, ge
             activations_sub_list.append(activations)
         activations_list.append(np.stack(activations_sub_list, axis=1))
     all_activations = np.stack(activations_list, axis=1)
-    return all_activations
\ No newline at end of file
+    return all_activations
+
+
+def _get_point_neuron_activations(model, datapoints, neuron_ids, get_activation_function, activation_function_kwargs):
+    """
+    Evaluate every datapoint for its own neuron with one get_activation_function() call per unique neuron
+        get_activation_function keeps the contract of get_contour_dataset_activations(): it is called with a single int
+        neuron index and returns the activations of that neuron with shape [num_datapoints]
+    Parameters:
+        model [pytorch model] model to compute activations from
+        datapoints [np.ndarray] of shape [num_datapoints]+data_shape
+        neuron_ids [np.ndarray] of ints with shape [num_datapoints] indicating which neuron index to record for each datapoint
+        get_activation_function [python function] see iterate_response_images()
+        activation_function_kwargs [dict] other keyword arguments to be passed to get_activation_function()
+    Outputs:
+        activations [np.ndarray] of shape [num_datapoints]
+    """
+    activations = np.zeros(datapoints.shape[0])
+    for neuron_id in np.unique(neuron_ids):
+        neuron_rows = np.flatnonzero(neuron_ids == neuron_id)
+        neuron_datapoints = datapoints if neuron_rows.size == datapoints.shape[0] else datapoints[neuron_rows]
+        neuron_activations = get_activation_function(model, neuron_datapoints, int(neuron_id), **activation_function_kwargs)
+        activations[neuron_rows] = np.asarray(neuron_activations).reshape(-1)
+    return activations
+
+
+def _evaluate_plane_segments(model, batch_segments, proj_datapoints, get_activation_function, image_scale, data_shape,
+        normalize, activation_function_kwargs):
+    """
+    Run a single forward pass over a batch that is made of segments from one or more planes
+        see iterate_response_images() for parameter descriptions
+    Outputs:
+        yields (plane_key, response_image) for every plane that was completed by this batch
+    """
+    num_images = proj_datapoints.shape[0]
+    num_edge_images = int(np.sqrt(num_images))
+    batch_datapoints = [data_utils.inject_data(plane['proj_matrix'], proj_datapoints[start_index:stop_index, :],
+        image_scale, data_shape) for (plane, start_index, stop_index) in batch_segments]
+    batch_datapoints = np.concatenate(batch_datapoints, axis=0)
+    segment_neuron_ids = [plane['neuron_index'] for (plane, start_index, stop_index) in batch_segments]
+    segment_lengths = [stop_index - start_index for (plane, start_index, stop_index) in batch_segments]
+    activations = _get_point_neuron_activations(model, batch_datapoints, np.repeat(segment_neuron_ids, segment_lengths),
+        get_activation_function, activation_function_kwargs)
+    batch_start = 0
+    for (plane, start_index, stop_index) in batch_segments:
+        batch_stop = batch_start + stop_index - start_index
+        plane['responses'][start_index:stop_index] = activations[batch_start:batch_stop]
+        batch_start = batch_stop
+        if stop_index == num_images: # plane is complete
+            responses = plane['responses']
+            if normalize:
+                responses = normalize_single_neuron_activations(responses)
+            yield plane['key'], responses.reshape(num_edge_images, num_edge_images)
+
+
+def iterate_response_images(model, planes, proj_datapoints, get_activation_function, image_scale=1.0, data_shape=None,
+        batch_size=100, normalize=True, activation_function_kwargs={}):
+    """
+    Generator that computes activation maps one plane at a time by packing datapoints from consecutive planes into fixed-size model batches
+        Only the current batch and the planes that it touches are held in memory
+    Parameters:
+        model [pytorch model] model to compute activations from
+        planes [iterable] that yields tuples of (plane_key, neuron_index, proj_matrix)
+            plane_key [hashable] identifier that is returned with the plane's response image, e.g. (target_index, plane_index)
+            neuron_index [int] which neuron index to record for the plane
+            proj_matrix [np.ndarray] of shape [2, datapoint_length] for injecting proj_datapoints into the input space
+        proj_datapoints [np.ndarray] of shape [num_datapoints, 2] 2D datapoint locations that are shared by all planes
+        get_activation_function [python function] which is called as
+            get_activation_function(model, datapoints, neuron_index, **activation_function_kwargs)
+            with a single int neuron_index, the same as get_contour_dataset_activations(), and returns activations
+            with shape [num_datapoints]. A batch that contains planes for several neurons is evaluated with one
+            call per neuron.
+        image_scale [float] final norm of datapoints, passed to utils/dataset_generation.inject_data()
+        data_shape [list] shape of each datapoint, passed to utils/dataset_generation.inject_data()
+        batch_size [int] number of datapoints per forward pass; a single batch can contain datapoints from multiple planes
+        normalize [bool] if True, each activation map is renormalized to be between 0 & 1
+        activation_function_kwargs [dict] other keyword arguments to be passed to get_activation_function()
+    Outputs:
+        yields (plane_key, response_image) in plane order as soon as all of the plane's datapoints have been evaluated
+            response_image [np.ndarray] has shape [num_datapoints_y, num_datapoints_x]
+    """
+    num_images = proj_datapoints.shape[0]
+    evaluate = lambda segments: _evaluate_plane_segments(model, segments, proj_datapoints, get_activation_function,
+        image_scale, data_shape, normalize, activation_function_kwargs)
+    batch_segments = [] # list of (plane, start_index, stop_index)
+    num_batch_images = 0
+    for plane_key, neuron_index, proj_matrix in planes:
+        plane = {
+            'key': plane_key,
+            'neuron_index': neuron_index,
+            'proj_matrix': proj_matrix,
+            'responses': np.zeros(num_images)
+        }
+        start_index = 0
+        while start_index < num_images:
+            stop_index = min(num_images, start_index + batch_size - num_batch_images)
+            batch_segments.append((plane, start_index, stop_index))
+            num_batch_images += stop_index - start_index
+            start_index = stop_index
+            if num_batch_images == batch_size:
+                yield from evaluate(batch_segments)
+                batch_segments = []
+                num_batch_images = 0
+    if len(batch_segments) > 0:
+        yield from evaluate(batch_segments)
+
+
+def _inject_plane_points(proj_matrices, plane_ids, proj_points, image_scale, data_shape, out):
+    """
+    Inject scattered 2D points that can each lie on a different plane with utils/dataset_generation.inject_data()
+        Points are grouped by plane, so the datapoints are ordered by plane rather than in the input order
+    Parameters:
+        see get_plane_point_activations(), with out [np.ndarray] a contiguous float32 buffer with at least
+        len(plane_ids) * datapoint_length entries
+    Outputs:
+        datapoints [np.ndarray] of shape [num_points]+data_shape, a view into out
+        point_order [np.ndarray] of shape [num_points], datapoints[i] is the injected point proj_points[point_order[i]]
+    """
+    num_points = len(plane_ids)
+    data_length = proj_matrices.shape[-1]
+    point_order = np.argsort(plane_ids, kind='stable')
+    sorted_plane_ids = plane_ids[point_order]
+    segment_planes, segment_starts = np.unique(sorted_plane_ids, return_index=True)
+    segment_stops = np.append(segment_starts[1:], num_points)
+    datapoints = out.reshape(-1)[:num_points * data_length].reshape(num_points, data_length)
+    for plane_id, start_index, stop_index in zip(segment_planes, segment_starts, segment_stops):
+        segment_datapoints = data_utils.inject_data(proj_matrices[plane_id], proj_points[point_order[start_index:stop_index], :],
+            image_scale, data_shape, out=datapoints[start_index:stop_index])
+    return datapoints.reshape((num_points,) + segment_datapoints.shape[1:]), point_order
+
+
+def get_plane_point_activations(model, proj_matrices, neuron_indices, plane_ids, proj_points, get_activation_function,
+        image_scale=1.0, data_shape=None, batch_size=100, activation_function_kwargs={}):
+    """
+    Compute activations for scattered 2D points that can each lie on a different plane
+        Points from any number of planes are packed into fixed-size model batches
+    Parameters:
+        model [pytorch model] model to compute activations from
+        proj_matrices [np.ndarray] of shape [num_planes, 2, datapoint_length] for injecting points into the input space
+        neuron_indices [list of ints] of shape [num_planes] indicating which neuron index to record for each plane
+        plane_ids [np.ndarray] of ints with shape [num_points] indicating which plane each point belongs to
+        proj_points [np.ndarray] of shape [num_points, 2] with the (x, y) location of each point on its plane,
+            the same ordering as proj_datapoints from utils/dataset_generation.get_datamesh()
+        get_activation_function [python function] see iterate_response_images()
+        image_scale [float] final norm of datapoints, see utils/dataset_generation.inject_data()
+        data_shape [list] shape of each datapoint, see utils/dataset_generation.inject_data()
+        batch_size [int] number of datapoints per forward pass
+        activation_function_kwargs [dict] other keyword arguments to be passed to get_activation_function()
+    Returns:
+        activations [np.ndarray] of shape [num_points] with the raw (unnormalized) activation of each point's neuron
+    """
+    proj_matrices = np.asarray(proj_matrices)
+    neuron_indices = np.asarray(neuron_indices)
+    plane_ids = np.asarray(plane_ids)
+    num_points = proj_points.shape[0]
+    buffer = np.empty((min(batch_size, num_points), proj_matrices.shape[-1]), dtype=np.float32)
+    activations = np.zeros(num_points)
+    for batch_start in range(0, num_points, batch_size):
+        batch_stop = min(num_points, batch_start + batch_size)
+        batch_datapoints, point_order = _inject_plane_points(proj_matrices, plane_ids[batch_start:batch_stop],
+            proj_points[batch_start:batch_stop, :], image_scale, data_shape, buffer)
+        batch_planes = plane_ids[batch_start:batch_stop][point_order]
+        activations[batch_start + point_order] = _get_point_neuron_activations(model, batch_datapoints,
+            neuron_indices[batch_planes], get_activation_function, activation_function_kwargs)
+    return activations
+
+
+def get_plane_point_activations_and_gradients(model, proj_matrices, neuron_indices, plane_ids, proj_points,
+        get_activation_function=unit_activation, image_scale=1.0, data_shape=None, batch_size=100,
+        activation_function_kwargs={}):
+    """
+    Compute activations and their gradients with respect to the 2D plane coordinates for scattered points
+        The gradients for a whole batch are computed with one backward pass, which assumes that
+        the model output for each datapoint does not depend on the other datapoints in the batch
+    Parameters:
+        model [pytorch model] model to compute activations from
+        proj_matrices [np.ndarray] of shape [num_planes, 2, datapoint_length] for injecting points into the input space
+        neuron_indices [list of ints] of shape [num_planes] indicating which neuron index to record for each plane
+        plane_ids [np.ndarray] of ints with shape [num_points] indicating which plane each point belongs to
+        proj_points [np.ndarray] of shape [num_points, 2] with the (x, y) location of each point on its plane
+        get_activation_function [python function] which is called as
+            get_activation_function(model, datapoints, neuron_index, compute_grad=True, **activation_function_kwargs)
+            with a torch.Tensor of datapoints and a single int neuron_index, see iterate_response_images(), and returns
+            a torch.Tensor of shape [num_datapoints] that can be differentiated with respect to the datapoints,
+            e.g. unit_activation()
+        image_scale [float] final norm of datapoints, see utils/dataset_generation.inject_data()
+        data_shape [list] shape of each datapoint, see utils/dataset_generation.inject_data()
+        batch_size [int] number of datapoints per forward pass
+        activation_function_kwargs [dict] other keyword arguments to be passed to get_activation_function()
+    Returns:
+        activations [np.ndarray] of shape [num_points] with the raw (unnormalized) activation of each point's neuron
+        plane_gradients [np.ndarray] of shape [num_points, 2] with the (d/dx, d/dy) derivative of each activation,
+            which is image_scale * proj_matrix @ (gradient with respect to the datapoint)
+    """
+    proj_matrices = np.asarray(proj_matrices)
+    neuron_indices = np.asarray(neuron_indices)
+    plane_ids = np.asarray(plane_ids)
+    num_points = proj_points.shape[0]
+    data_length = proj_matrices.shape[-1]
+    device = next(model.parameters()).device
+    buffer = np.empty((min(batch_size, num_points), data_length), dtype=np.float32)
+    activations = np.zeros(num_points)
+    plane_gradients = np.zeros((num_points, 2))
+    for batch_start in range(0, num_points, batch_size):
+        batch_stop = min(num_points, batch_start + batch_size)
+        batch_datapoints, point_order = _inject_plane_points(proj_matrices, plane_ids[batch_start:batch_stop],
+            proj_points[batch_start:batch_stop, :], image_scale, data_shape, buffer)
+        batch_planes = plane_ids[batch_start:batch_stop][point_order]
+        batch_proj_matrices = proj_matrices[batch_planes, ...] # [batch, 2, datapoint_length]
+        batch_datapoints = torch.from_numpy(batch_datapoints.copy()).to(device)
+        batch_datapoints.requires_grad = True
+        batch_neuron_ids = neuron_indices[batch_planes]
+        batch_activations = torch.zeros(batch_stop - batch_start, dtype=batch_datapoints.dtype, device=device)
+        for neuron_id in np.unique(batch_neuron_ids): # one call per neuron, see _get_point_neuron_activations()
+            neuron_rows = torch.from_numpy(np.flatnonzero(batch_neuron_ids == neuron_id)).to(device)
+            neuron_activations = get_activation_function(model, batch_datapoints[neuron_rows], int(neuron_id),
+                compute_grad=True, **activation_function_kwargs)
+            batch_activations = batch_activations.index_put((neuron_rows,), neuron_activations.reshape(-1).type(
+                batch_activations.dtype))
+        batch_grads = torch.autograd.grad(batch_activations.sum(), batch_datapoints)[0]
+        batch_grads = batch_grads.detach().cpu().numpy().reshape(batch_stop - batch_start, data_length)
+        activations[batch_start + point_order] = batch_activations.detach().cpu().numpy()
+        plane_gradients[batch_start + point_order, :] = image_scale * np.einsum('bin,bn->bi', batch_proj_matrices, batch_grads)
+    return activations, plane_gradients
+
+
+def get_batched_response_images(model, proj_matrices, proj_datapoints, target_model_ids, get_activation_function,
+        image_scale=1.0, data_shape=None, batch_size=100, normalize=True, activation_function_kwargs={}):
+    """
+    Compute activation maps for many planes at once by packing datapoints from consecutive planes into fixed-size model batches
+    Parameters:
+        model [pytorch model] model to compute activations from
+        proj_matrices [list of list of np.ndarray] with shapes [num_targets][num_planes][2, datapoint_length]
+            for example contour_dataset['proj_matrix'] from utils/dataset_generation.get_contour_dataset()
+        proj_datapoints [np.ndarray] of shape [num_datapoints, 2] 2D datapoint locations that are shared by all planes
+        target_model_ids [list of ints] with shape [num_targets] indicating which neuron index to record for each target
+        get_activation_function [python function] see iterate_response_images()
+        image_scale [float] final norm of datapoints, passed to utils/dataset_generation.inject_data()
+        data_shape [list] shape of each datapoint, passed to utils/dataset_generation.inject_data()
+        batch_size [int] number of datapoints per forward pass; a single batch can contain datapoints from multiple planes
+        normalize [bool] if True, each activation map is renormalized to be between 0 & 1
+        activation_function_kwargs [dict] other keyword arguments to be passed to get_activation_function()
+    Returns:
+        response_images [np.ndarray] with shape [num_targets, num_planes, num_datapoints_y, num_datapoints_x]
+    """
+    num_targets = len(proj_matrices)
+    num_planes = len(proj_matrices[0])
+    num_edge_images = int(np.sqrt(proj_datapoints.shape[0]))
+    planes = (
+        ((target_index, plane_index), target_model_ids[target_index], proj_matrix)
+        for target_index, target_proj_matrices in enumerate(proj_matrices)
+        for plane_index, proj_matrix in enumerate(target_proj_matrices)
+    )
+    response_images = np.zeros((num_targets, num_planes, num_edge_images, num_edge_images))
+    for (target_index, plane_index), response_image in iterate_response_images(model, planes, proj_datapoints,
+            get_activation_function, image_scale, data_shape, batch_size, normalize, activation_function_kwargs):
+        response_images[target_index, plane_index, ...] = response_image
+    return response_images
@@ -6,7 +6,7 @@ Authors: Dylan Paiton, Matthias Kümmerer
 import os, sys
 
 import numpy as np
-from scipy.linalg import orth, null_space
+from scipy.linalg import eigh, orth, null_space
 import torch
 import torch.nn as nn
 from tqdm import tqdm
@@ -87,29 +87,42 @@ def autodiff_pt_grad_hess(x_pt, y_pt, a, c, dtype, device='cpu'):
     return x_1grad, x_2grad
 
 
-def autodiff_grad_hess(x_vals, y_vals, a, c, dtype, device):
-    grad = torch.zeros(x_vals.shape + (2,)).to(device)
-    hess = torch.zeros(x_vals.shape + (4,)).to(device)
-    for x_idx in tqdm(range(len(x_vals[0, :])), leave=True):
-        for y_idx in range(len(y_vals[0, :])):
-            x_1grad, x_2grad = autodiff_pt_grad_hess(x_vals[x_idx, y_idx], y_vals[x_idx, y_idx], a, c, dtype, device)
-            grad[x_idx, y_idx, :] = x_1grad
-            hess[x_idx, y_idx, :] = x_2grad
+def autodiff_grad_hess_field(func, points):
+    """
+    Compute the gradient & Hessian of a scalar function at every point in a grid with batched autodiff
+        torch.func.vmap is applied over jacrev (gradient) and hessian, so the whole grid is evaluated in a few batched kernels
+    Parameters:
+        func [python function] that maps a single point tensor of shape [d] to a scalar tensor
+        points [torch.Tensor] of shape [..., d], for example an [H, W, 2] grid of (x, y) points
+    Outputs:
+        grad [torch.Tensor] of shape [..., d]
+        hess [torch.Tensor] of shape [..., d*d] with the flattened Hessian at each point
+    """
+    num_dims = points.shape[-1]
+    flat_points = points.reshape(-1, num_dims)
+    grad = torch.func.vmap(torch.func.jacrev(func))(flat_points)
+    hess = torch.func.vmap(torch.func.hessian(func))(flat_points)
+    grad = grad.reshape(points.shape[:-1] + (num_dims,))
+    hess = hess.reshape(points.shape[:-1] + (num_dims**2,))
     return grad, hess
 
 
+def autodiff_grad_hess(x_vals, y_vals, a, c, dtype, device):
+    points = torch.from_numpy(np.stack((x_vals, y_vals), axis=-1)).to(dtype).to(device)
+    hyperboloid_func = lambda pt: hyperboloid_graph(x_vals=pt[0], y_vals=pt[1], a=a, c=c)
+    return autodiff_grad_hess_field(hyperboloid_func, points)
+
+
 def hyperboloid_gauss_mean_curvature(grad, hess):
-    gauss_curvature = np.zeros([len(grad), len(grad)])
-    mean_curvature = np.zeros([len(grad), len(grad)])
-    np_grad = grad.detach().cpu().numpy()
-    for x_idx in range(len(grad)):
-        for y_idx in range(len(grad)):
-            if np.all(np.isfinite(np_grad[x_idx, y_idx, :])):
-                pt_grad = grad[x_idx, y_idx, :]
-                pt_hess = hess[x_idx, y_idx, :].reshape((2,2))
-                shape_operator, principal_curvatures, principal_directions = local_response_curvature_graph(pt_grad, pt_hess)
-                gauss_curvature[x_idx, y_idx] = np.prod(principal_curvatures.detach().cpu().numpy())
-                mean_curvature[x_idx, y_idx] = np.mean(principal_curvatures.detach().cpu().numpy())
+    num_dims = grad.shape[-1]
+    flat_grad = grad.reshape(-1, num_dims)
+    flat_hess = hess.reshape(-1, num_dims, num_dims)
+    gauss_curvature, mean_curvature = local_response_gauss_mean_curvature_graph(flat_grad, flat_hess)
+    valid = torch.all(torch.isfinite(flat_grad), dim=1) # invalid points have 0 curvature
+    gauss_curvature = torch.where(valid, gauss_curvature, torch.zeros_like(gauss_curvature))
+    mean_curvature = torch.where(valid, mean_curvature, torch.zeros_like(mean_curvature))
+    gauss_curvature = gauss_curvature.reshape(grad.shape[:-1]).detach().cpu().numpy()
+    mean_curvature = mean_curvature.reshape(grad.shape[:-1]).detach().cpu().numpy()
     return gauss_curvature, mean_curvature
 
 
@@ -273,9 +286,23 @@ def plane_hessian_error(model, hessian, image, abscissa, ordinate, experiment_pa
 
 
 def get_shape_operator_graph(pt_grad, pt_hess):
+    """
+    Parameters:
+        pt_grad [pytorch tensor] gradient vector with shape [M] or [M, 1] for a single point,
+            or [B, M] for a batch of points
+        pt_hess [pytorch tensor] hessian matrix with shape [M, M] for a single point, or [B, M, M] for a batch of points
+    Returns:
+        shape_operator - [M, M] or [B, M, M] dimensional array
+    """
     device = pt_grad.device
     dtype = pt_grad.dtype
     pt_hess = pt_hess.type(dtype)
+    if pt_hess.ndim == 3: # batch of points
+        pt_grad = pt_grad.reshape(pt_hess.shape[0], -1, 1)
+        normalization_factor = torch.sqrt(torch.sum(pt_grad**2, dim=(1, 2)) + 1)[:, None, None]
+        identity_matrix = torch.eye(pt_grad.shape[1], dtype=dtype, device=device)
+        metric_tensor = identity_matrix + torch.matmul(pt_grad, pt_grad.transpose(1, 2))
+        return - torch.linalg.solve(metric_tensor, pt_hess) / normalization_factor
     if pt_grad.ndim == 1:
         pt_grad = pt_grad[:, None] # row vector
     normalization_factor = torch.sqrt(torch.linalg.norm(pt_grad)**2 + 1)
@@ -290,10 +317,14 @@ def get_shape_operator_level_set(pt_grad, pt_hess, coordinate_transformation=Non
     compute grad of implicit function g: a=(x_0, ... x_{n-2}) \to b=x_{n-1} (zero-indexed)
     this will gives us a coordinate system of the iso response surface in the coordinates
     x_0, ... x_{n-2}
+    pt_grad can be [M] or [M, 1] with pt_hess [M, M], or a batch of points with pt_grad [B, M] and pt_hess [B, M, M],
+    see _get_batched_shape_operator_level_set()
     """
     device = pt_grad.device
     dtype = pt_grad.dtype
     pt_hess = pt_hess.type(dtype)
+    if pt_hess.ndim == 3: # batch of points
+        return _get_batched_shape_operator_level_set(pt_grad, pt_hess, coordinate_transformation)
     if pt_grad.ndim != 2:
         pt_grad = pt_grad.reshape(-1)[:, None] # col vector
     # transformation _to_ new coordinates
@@ -350,12 +381,96 @@ def get_shape_operator_level_set(pt_grad, pt_hess, coordinate_transformation=Non
     return shape_operator, embedding_differential, metric_tensor
 
 
+def _get_householder_transformation(pt_grad):
+    """
+    Batch of orthogonal [B, M, M] matrices whose last row is the normalized gradient, so that they map each gradient to
+    the last coordinate axis. This is a Householder reflection that is negated when needed for numerical stability.
+    """
+    num_dims = pt_grad.shape[-1]
+    normed_grad = pt_grad / torch.linalg.norm(pt_grad, dim=-1, keepdim=True)
+    last_axis = torch.zeros_like(normed_grad)
+    last_axis[:, -1] = 1
+    sign = torch.where(normed_grad[:, -1:] > 0, -1.0, 1.0).to(pt_grad.dtype) # keeps |v| >= sqrt(2)
+    reflection_vector = normed_grad - sign * last_axis
+    reflection = torch.eye(num_dims, dtype=pt_grad.dtype, device=pt_grad.device) - 2 * (
+        reflection_vector[:, :, None] * reflection_vector[:, None, :]) / torch.sum(reflection_vector**2, dim=-1)[:, None, None]
+    return sign[:, :, None] * reflection
+
+
+def _get_batched_shape_operator_level_set(pt_grad, pt_hess, coordinate_transformation=None):
+    """
+    Batched version of get_shape_operator_level_set()
+    Parameters:
+        pt_grad [pytorch tensor] of shape [B, M]
+        pt_hess [pytorch tensor] of shape [B, M, M]
+        coordinate_transformation [pytorch tensor] of shape [M, M] or [B, M, M]
+            if None, a Householder reflection that maps each gradient to the last coordinate is used instead of a
+            null space basis. The basis of the iso response surface differs from the single point version,
+            so the shape operators are equal up to an orthogonal change of basis and the principal curvatures are identical.
+    Outputs:
+        shape_operator [B, M-1, M-1], embedding_differential [B, M, M-1], metric_tensor [B, M-1, M-1]
+    """
+    device = pt_grad.device
+    dtype = pt_grad.dtype
+    batch_size = pt_hess.shape[0]
+    pt_grad = pt_grad.reshape(batch_size, -1)
+    num_dims = pt_grad.shape[-1]
+    if coordinate_transformation is None:
+        coordinate_transformation = _get_householder_transformation(pt_grad)
+    else:
+        coordinate_transformation = coordinate_transformation.type(dtype).expand(batch_size, num_dims, num_dims)
+    transformation_transpose = coordinate_transformation.transpose(1, 2)
+    pt_grad = torch.matmul(coordinate_transformation, pt_grad[:, :, None])
+    pt_hess = torch.matmul(coordinate_transformation, torch.matmul(pt_hess, transformation_transpose))
+    # convenience variables
+    pt_grad_a = pt_grad[:, :-1]
+    pt_grad_b = pt_grad[:, -1:]
+    pt_hess_aa = pt_hess[:, :-1, :-1]
+    pt_hess_ab = pt_hess[:, :-1, -1:]
+    pt_hess_bb = pt_hess[:, -1:, -1:]
+    # consistency tests
+    if torch.any(pt_grad_b == 0):
+        # this should never happen in DNN cases
+        raise ValueError('singular gradient, you need a different coordinate system')
+    if torch.any(torch.abs(pt_grad_b) < 1e-7):
+        # this should never happen in DNN cases
+        print('close to singular gradient, you might need a different coordinate system',
+            pt_grad_b[torch.abs(pt_grad_b) < 1e-7])
+    # g is the implicit function from x_1, x_{n-1} to x_n
+    grad_g = -pt_grad_a / pt_grad_b
+    grad_g_transpose = grad_g.transpose(1, 2)
+    identity_matrix = torch.eye(num_dims - 1, dtype=dtype, device=device)
+    embedding_differential = torch.cat((identity_matrix.expand(batch_size, -1, -1), grad_g_transpose), dim=1)
+    embedding_differential = torch.matmul(transformation_transpose, embedding_differential)
+    hess_g = (-1 / pt_grad_b) * (
+        pt_hess_ab.transpose(1, 2) * (grad_g + grad_g_transpose)
+        +
+        pt_hess_bb * grad_g * grad_g_transpose
+        +
+        pt_hess_aa
+    )
+    flip = torch.where(pt_grad_b > 0, -1.0, 1.0).to(dtype) # make sure the normal points in the right direction
+    grad_g = flip * grad_g
+    hess_g = flip * hess_g
+    normalization_factor = torch.sqrt(torch.sum(grad_g**2, dim=(1, 2)) + 1)[:, None, None]
+    metric_tensor = identity_matrix + torch.matmul(grad_g, grad_g.transpose(1, 2))
+    shape_operator = - torch.linalg.solve(metric_tensor, hess_g) / normalization_factor
+    return shape_operator, embedding_differential, metric_tensor
+
+
 def get_shape_operator_poole(pt_grad, pt_hess):
     """
     Adapted from descriptions given in:
     B Poole, S Lahiri, M Raghu, J Sohl-Dickstein, S Ganguli (2016) - Exponential Expressivity in Deep Neural Networks Through Transient Chaos
     code: https://github.com/ganguli-lab/deepchaos
     """
+    if pt_hess.ndim == 3: # batch of points
+        pt_grad = pt_grad.reshape(pt_hess.shape[0], -1)
+        grad_scale = torch.linalg.norm(pt_grad, dim=-1)
+        normed_grad = pt_grad / grad_scale[:, None]
+        normed_hess = pt_hess / grad_scale[:, None, None]
+        projected_hess = normed_hess - normed_grad[:, :, None] * torch.matmul(normed_grad[:, None, :], normed_hess)
+        return projected_hess - torch.matmul(projected_hess, normed_grad[:, :, None]) * normed_grad[:, None, :]
     pt_grad = pt_grad.squeeze(); pt_hess = pt_hess.squeeze()
     grad_scale = torch.linalg.norm(pt_grad)
     normed_grad = pt_grad / grad_scale
@@ -374,6 +489,12 @@ def get_shape_operator_moosavi(pt_grad, pt_hess):
     """
     device = pt_grad.device
     dtype = pt_grad.dtype
+    if pt_hess.ndim == 3: # batch of points, each gradient is treated as a [M, 1] column vector
+        pt_grad = pt_grad.reshape(pt_hess.shape[0], -1, 1)
+        identity_matrix = torch.eye(pt_grad.shape[1], dtype=dtype, device=device)
+        projection_operator = identity_matrix - torch.matmul(pt_grad, pt_grad.transpose(1, 2))
+        norm_constant = 1 / torch.sqrt(torch.sum(pt_grad**2, dim=(1, 2)))[:, None, None]
+        return norm_constant * torch.matmul(projection_operator, torch.matmul(pt_hess, projection_operator.transpose(1, 2)))
     identity_matrix = torch.eye(len(pt_grad), dtype=dtype).to(device)
     projection_operator = identity_matrix - torch.matmul(pt_grad, pt_grad.T)
     norm_constant = 1 / torch.linalg.norm(pt_grad)
@@ -390,11 +511,18 @@ def get_shape_operator_golden(pt_grad, pt_hess):
     code adapted to pytorch from
         https://github.com/jamesgolden1/bias_free_denoising/blob/manifold_metric/curvature/hyperboloid_single_sheet_curvature_compare.ipynb
     Parameters:
-        pt_grad [pytorch tensor] gradient vector for the input point
-        pt_hess [pytorch tensor] hessian matrix for the input point
+        pt_grad [pytorch tensor] gradient vector for the input point, or [B, M] gradients for a batch of points
+        pt_hess [pytorch tensor] hessian matrix for the input point, or [B, M, M] hessians for a batch of points
     """
     device = pt_grad.device
     dtype = pt_grad.dtype
+    if pt_hess.ndim == 3: # batch of points
+        pt_grad = pt_grad.reshape(pt_hess.shape[0], -1, 1)
+        identity_matrix = torch.eye(pt_grad.shape[1], dtype=dtype, device=device)
+        first_fundamental = identity_matrix + torch.matmul(pt_grad, pt_grad.transpose(1, 2))
+        unit_normal_last = -1 / torch.sqrt(torch.sum(pt_grad**2, dim=(1, 2)) + 1) # last element of the unit normal
+        second_fundamental = pt_hess.type(dtype) * unit_normal_last[:, None, None]
+        return torch.linalg.solve(first_fundamental, second_fundamental)
     # Append gradient vector as extra col to identity matrix
     identity_matrix = torch.eye(len(pt_grad), dtype=dtype).to(device)
     embedding_differential = torch.zeros([len(pt_grad), len(pt_grad)+1], dtype=dtype).to(device)
@@ -414,29 +542,120 @@ def get_shape_operator_golden(pt_grad, pt_hess):
     return shape_operator
 
 
-def get_principal_curvatures(shape_operator):
+def _get_graph_metric_tensor(pt_grad, batched=False):
+    """
+    Metric tensor I + g g^T of the graph of a function, with shape [M, M], or [B, M, M] if batched
+    """
+    if batched:
+        pt_grad = pt_grad.reshape(pt_grad.shape[0], -1, 1)
+        identity_matrix = torch.eye(pt_grad.shape[1], dtype=pt_grad.dtype, device=pt_grad.device)
+        return identity_matrix + torch.matmul(pt_grad, pt_grad.transpose(1, 2))
+    pt_grad = pt_grad.reshape(-1, 1)
+    identity_matrix = torch.eye(len(pt_grad), dtype=pt_grad.dtype, device=pt_grad.device)
+    return identity_matrix + torch.matmul(pt_grad, pt_grad.T)
+
+
+def _get_top_principal_curvatures(shape_operator, metric_tensor, top_k):
+    """
+    Partial symmetric eigen decomposition that only computes the top_k largest principal curvatures
+        scipy.linalg.eigh(subset_by_index) solves the generalized problem second_fundamental v = k metric_tensor v
+        directly, without computing the remaining eigen pairs. The computation is done on the CPU in numpy,
+        so gradients are not propagated to the inputs.
+    Parameters:
+        shape_operator - [M, M] or [B, M, M] array that is symmetric, or symmetric with respect to metric_tensor
+        metric_tensor - [M, M] or [B, M, M] positive definite array, or None for the identity
+        top_k - [int] number of largest curvatures to compute
+    Returns:
+        principal_curvatures - [top_k] or [B, top_k] curvatures in descending order
+        principal_directions - [M, top_k] or [B, M, top_k] directions with unit euclidean norm
+    """
+    dtype = shape_operator.dtype
+    device = shape_operator.device
+    batched = shape_operator.ndim == 3
+    shape_operators = shape_operator.detach().cpu().numpy().astype(np.float64)
+    if not batched:
+        shape_operators = shape_operators[None, ...]
+    num_dims = shape_operators.shape[-1]
+    assert 0 < top_k <= num_dims, (
+        f'utils/principal_curvature: ERROR: top_k must be between 1 and {num_dims}, not {top_k}')
+    if metric_tensor is not None:
+        metric_tensors = metric_tensor.detach().cpu().numpy().astype(np.float64).reshape(shape_operators.shape)
+        second_fundamentals = np.matmul(metric_tensors, shape_operators)
+    else:
+        metric_tensors = [None] * shape_operators.shape[0]
+        second_fundamentals = shape_operators
+    principal_curvatures = []; principal_directions = []
+    for second_fundamental, metric in zip(second_fundamentals, metric_tensors):
+        second_fundamental = (second_fundamental + second_fundamental.T) / 2
+        curvatures, directions = eigh(second_fundamental, metric, subset_by_index=[num_dims - top_k, num_dims - 1])
+        principal_curvatures.append(curvatures[::-1])
+        principal_directions.append(directions[:, ::-1] / np.linalg.norm(directions, axis=0)[::-1])
+    principal_curvatures = torch.tensor(np.stack(principal_curvatures, axis=0), dtype=dtype, device=device)
+    principal_directions = torch.tensor(np.stack(principal_directions, axis=0), dtype=dtype, device=device)
+    if not batched:
+        return principal_curvatures[0], principal_directions[0]
+    return principal_curvatures, principal_directions
+
+
+def get_principal_curvatures(shape_operator, metric_tensor=None, symmetric=False, top_k=None):
     """
     Performs an eigen decomposition of the shape operator
     Parameters:
-        shape_operator - [M, M] dimensional array
+        shape_operator - [M, M] dimensional array, or [B, M, M] for a batch of shape operators
+        metric_tensor - [M, M] or [B, M, M] positive definite array such that metric_tensor @ shape_operator is symmetric,
+            e.g. the metric tensor returned by get_shape_operator_level_set(). If given, the principal curvatures are
+            computed with a generalized symmetric eigen solve using the Cholesky factor of the metric tensor.
+        symmetric - [bool or str] if True, shape_operator is assumed to be symmetric and torch.linalg.eigh is used.
+            if 'auto', the symmetric solver is used if shape_operator is numerically symmetric.
+            if False and metric_tensor is None, the general (non-symmetric) torch.linalg.eig is used.
+        top_k - [int] if not None, only the top_k largest curvatures and their directions are computed, with a partial
+            solve from scipy.linalg.eigh (see _get_top_principal_curvatures()). This requires a symmetric solve,
+            i.e. a metric_tensor or symmetric shape_operator.
     Returns:
-        principal_curvatures - sorted eigenvalues of shape_operator
-        principal_directions - sorted eigenvectors of shape_operator
-            where principal_directions[:, i] is the vector corresponding to principal_curvatures[i]
+        principal_curvatures - sorted eigenvalues of shape_operator, with shape [M] or [B, M]
+        principal_directions - sorted eigenvectors of shape_operator, with shape [M, M] or [B, M, M]
+            where principal_directions[..., :, i] is the vector corresponding to principal_curvatures[..., i]
+            and each direction has unit euclidean norm
     """
     dtype = shape_operator.dtype
-    principal_curvatures, principal_directions = torch.linalg.eig(shape_operator)
-    principal_curvatures = torch.real(principal_curvatures).type(dtype)
-    principal_directions = torch.real(principal_directions).type(dtype)
-    sort_indices = torch.argsort(principal_curvatures, descending=True)
-    return principal_curvatures[sort_indices], principal_directions[:, sort_indices]
+    if symmetric == 'auto':
+        symmetric = bool(torch.allclose(shape_operator, shape_operator.transpose(-1, -2)))
+    if top_k is not None:
+        assert metric_tensor is not None or symmetric, (
+            'utils/principal_curvature: ERROR: top_k requires a metric_tensor or a symmetric shape_operator')
+        return _get_top_principal_curvatures(shape_operator, metric_tensor, top_k)
+    if metric_tensor is not None:
+        metric_tensor = metric_tensor.type(dtype)
+        second_fundamental = torch.matmul(metric_tensor, shape_operator)
+        second_fundamental = (second_fundamental + second_fundamental.transpose(-1, -2)) / 2
+        cholesky_factor = torch.linalg.cholesky(metric_tensor)
+        # L^{-1} B L^{-T} has the same eigenvalues as G^{-1} B
+        reduced_operator = torch.linalg.solve_triangular(cholesky_factor, second_fundamental, upper=False)
+        reduced_operator = torch.linalg.solve_triangular(cholesky_factor, reduced_operator.transpose(-1, -2), upper=False)
+        principal_curvatures, principal_directions = torch.linalg.eigh(reduced_operator)
+        principal_directions = torch.linalg.solve_triangular(
+            cholesky_factor.transpose(-1, -2), principal_directions, upper=True)
+        principal_directions = principal_directions / torch.linalg.norm(principal_directions, dim=-2, keepdim=True)
+    elif symmetric:
+        principal_curvatures, principal_directions = torch.linalg.eigh(
+            (shape_operator + shape_operator.transpose(-1, -2)) / 2)
+    else:
+        principal_curvatures, principal_directions = torch.linalg.eig(shape_operator)
+        principal_curvatures = torch.real(principal_curvatures).type(dtype)
+        principal_directions = torch.real(principal_directions).type(dtype)
+    sort_indices = torch.argsort(principal_curvatures, dim=-1, descending=True)
+    principal_curvatures = torch.take_along_dim(principal_curvatures, sort_indices, dim=-1)
+    principal_directions = torch.take_along_dim(principal_directions, sort_indices.unsqueeze(-2), dim=-1)
+    return principal_curvatures, principal_directions
 
 
-def local_response_curvature_graph(pt_grad, pt_hess):
+def local_response_curvature_graph(pt_grad, pt_hess, use_metric=False):
     """
     Parameters:
         pt_grad: defining function gradient
         pt_hess: defining function hessian
+        use_metric: if True, the curvatures are computed with the generalized symmetric solver using the metric tensor
+          of the graph (see get_principal_curvatures()), which is faster for large M; otherwise torch.linalg.eig is used
     Outputs:
         shape_operator - [M, M] dimensional array
         principal_curvatures - [M] dimensional array of curvatures in ascending order
@@ -444,11 +663,37 @@ def local_response_curvature_graph(pt_grad, pt_hess):
             where principal_directions[:, i] is the vector corresponding to principal_curvatures[i]
     """
     shape_operator = get_shape_operator_graph(pt_grad, pt_hess)
-    principal_curvatures, principal_directions = get_principal_curvatures(shape_operator)
+    metric_tensor = _get_graph_metric_tensor(pt_grad, batched=pt_hess.ndim == 3) if use_metric else None
+    principal_curvatures, principal_directions = get_principal_curvatures(shape_operator, metric_tensor=metric_tensor)
     return shape_operator, principal_curvatures, principal_directions
 
 
-def local_response_curvature_level_set(pt_grad, pt_hess, projection_subspace_of_interest=None, coordinate_transformation=None):
+def local_response_gauss_mean_curvature_graph(grad, hess, use_metric=False):
+    """
+    Gaussian & mean curvature of the graph of a function for a batch of points
+    Parameters:
+        grad: [B, M] defining function gradients
+        hess: [B, M, M] defining function hessians
+        use_metric: see local_response_curvature_graph()
+    Outputs:
+        gauss_curvature - [B] dimensional array with the product of the principal curvatures at each point
+        mean_curvature - [B] dimensional array with the mean of the principal curvatures at each point
+            points with non-finite gradients or hessians are nan
+    """
+    valid = torch.all(torch.isfinite(grad), dim=1) & torch.all(torch.isfinite(hess.reshape(hess.shape[0], -1)), dim=1)
+    gauss_curvature = torch.full(grad.shape[:1], float('nan'), dtype=grad.dtype, device=grad.device)
+    mean_curvature = torch.full(grad.shape[:1], float('nan'), dtype=grad.dtype, device=grad.device)
+    if torch.any(valid):
+        shape_operator = get_shape_operator_graph(grad[valid], hess[valid])
+        metric_tensor = _get_graph_metric_tensor(grad[valid], batched=True) if use_metric else None
+        principal_curvatures, principal_directions = get_principal_curvatures(shape_operator, metric_tensor=metric_tensor)
+        gauss_curvature[valid] = torch.prod(principal_curvatures, dim=-1)
+        mean_curvature[valid] = torch.mean(principal_curvatures, dim=-1)
+    return gauss_curvature, mean_curvature
+
+
+def local_response_curvature_level_set(pt_grad, pt_hess, projection_subspace_of_interest=None, coordinate_transformation=None,
+        use_metric=False):
     """
     Parameters:
         pt_grad: defining function gradient
@@ -458,6 +703,9 @@ def local_response_curvature_level_set(pt_grad, pt_hess, projection_subspace_of_
           into the isoresponse surface.
         coordinate_transformation: orthogonal [M, M] matrix from input space into a new coordinate system. The last coordinate will
           be used to parametrize the decision boundary
+        use_metric: if True and projection_subspace_of_interest is None, the curvatures are computed with the generalized
+          symmetric solver using the metric tensor of the level set (see get_principal_curvatures()), which is faster
+          for large M; otherwise torch.linalg.eig is used
     Outputs:
         shape_operator - [M-1, M-1] dimensional array
         principal_curvatures - [M-1] dimensional array of curvatures in ascending order
@@ -476,7 +724,10 @@ def local_response_curvature_level_set(pt_grad, pt_hess, projection_subspace_of_
         # restrict shape operator to subspace of interest. This is the correct endomorphism for the restriced second fundamental form,
         # since the first projection cancels with the transposed projection that is part of the restricted metric.
         shape_operator = torch.matmul(torch.matmul(projection_from_isosurface, shape_operator), projection_from_isosurface.T)
-    principal_curvatures, principal_directions = get_principal_curvatures(shape_operator)
+        principal_curvatures, principal_directions = get_principal_curvatures(shape_operator)
+    else:
+        principal_curvatures, principal_directions = get_principal_curvatures(
+            shape_operator, metric_tensor=metric_tensor if use_metric else None)
     # we need to norm the directions wrt to the metric, not the canonical scalar product
     if projection_subspace_of_interest is not None:
         _metric_tensor = torch.matmul(torch.matmul(projection_from_isosurface, metric_tensor), projection_from_isosurface.T)
@@ -492,7 +743,142 @@ def local_response_curvature_level_set(pt_grad, pt_hess, projection_subspace_of_
     return shape_operator, principal_curvatures, principal_directions
 
 
-def local_response_curvature_alternates(pt_grad, pt_hess, so_type='lee_level'):
+def _get_ritz_pairs(alphas, betas, num_steps):
+    """
+    Ritz values, tridiagonal eigenvectors & residual norms after num_steps Lanczos steps, in descending order of Ritz value
+        For the Lanczos relation S V = V T + beta v e^T, the residual of the Ritz pair (theta, V y) is
+        |S V y - theta V y| = |beta| |e^T y|, i.e. the last entry of the tridiagonal eigenvector scaled by the last beta
+    """
+    tridiagonal = torch.diag(alphas[:num_steps]) + torch.diag(betas[:num_steps-1], 1) + torch.diag(betas[:num_steps-1], -1)
+    ritz_values, eigenvectors = torch.linalg.eigh(tridiagonal)
+    ritz_values = torch.flip(ritz_values, dims=(0,))
+    eigenvectors = torch.flip(eigenvectors, dims=(1,))
+    residual_norms = torch.abs(betas[num_steps-1] * eigenvectors[-1, :])
+    return ritz_values, eigenvectors, residual_norms
+
+
+def lanczos_eigh(matvec, initial_vector, num_iterations, deflation_vectors=None, tolerance=1e-10, num_top=0, num_bottom=0,
+        residual_tolerance=None):
+    """
+    Lanczos iteration with full reorthogonalization for the extreme eigenvalues of a symmetric linear operator
+    Parameters:
+        matvec [function] computes the product of the symmetric [M, M] operator with a vector of shape [M]
+        initial_vector [pytorch tensor] of shape [M] used to start the Krylov subspace
+        num_iterations [int] maximum dimensionality of the Krylov subspace
+        deflation_vectors [pytorch tensor] of shape [M, R] with orthonormal columns that are projected out of the Krylov
+            subspace, for example the unit normal of an iso-response surface
+        tolerance [float] the iteration stops early if the norm of the next Lanczos vector, before normalization, is below
+            tolerance, i.e. the Krylov subspace is invariant and the Ritz pairs are exact
+        num_top [int] number of largest Ritz pairs that are checked for convergence
+        num_bottom [int] number of smallest Ritz pairs that are checked for convergence
+        residual_tolerance [float or None] if not None, the iteration stops early once the residual norms of the num_top
+            largest & num_bottom smallest Ritz pairs are all below residual_tolerance * max(abs(ritz_values))
+    Outputs:
+        ritz_values [pytorch tensor] of shape [K], K <= num_iterations, with the approximate eigenvalues in descending order
+        ritz_vectors [pytorch tensor] of shape [M, K], where ritz_vectors[:, i] is the unit vector corresponding to ritz_values[i]
+        residual_norms [pytorch tensor] of shape [K] with the residual norm |S v - theta v| of each Ritz pair, computed
+            from the Lanczos relation, see _get_ritz_pairs()
+    """
+    def orthogonalize(vector, basis):
+        for _ in range(2): # twice is enough
+            vector = vector - torch.matmul(basis, torch.matmul(basis.T, vector))
+        return vector
+    def is_converged(num_steps):
+        ritz_values, eigenvectors, residual_norms = _get_ritz_pairs(alphas, betas, num_steps)
+        checked_norms = torch.cat((residual_norms[:num_top], residual_norms[num_steps-num_bottom:]))
+        return bool(torch.all(checked_norms <= residual_tolerance * torch.max(torch.abs(ritz_values))))
+    dtype = initial_vector.dtype
+    device = initial_vector.device
+    num_dims = initial_vector.numel()
+    if deflation_vectors is None:
+        deflation_vectors = torch.zeros((num_dims, 0), dtype=dtype, device=device)
+    num_iterations = min(num_iterations, num_dims - deflation_vectors.shape[1])
+    lanczos_vectors = torch.zeros((num_dims, num_iterations), dtype=dtype, device=device)
+    alphas = torch.zeros(num_iterations, dtype=dtype, device=device)
+    betas = torch.zeros(num_iterations, dtype=dtype, device=device)
+    vector = orthogonalize(initial_vector.flatten(), deflation_vectors)
+    vector = vector / torch.linalg.norm(vector)
+    num_steps = num_iterations
+    for step in range(num_iterations):
+        lanczos_vectors[:, step] = vector
+        residual = matvec(vector).detach()
+        alphas[step] = torch.dot(vector, residual)
+        residual = orthogonalize(residual, torch.cat((deflation_vectors, lanczos_vectors[:, :step+1]), dim=1))
+        betas[step] = torch.linalg.norm(residual)
+        if betas[step] < tolerance:
+            num_steps = step + 1
+            break
+        if residual_tolerance is not None and step + 1 >= num_top + num_bottom and is_converged(step + 1):
+            num_steps = step + 1
+            break
+        vector = residual / betas[step]
+    ritz_values, eigenvectors, residual_norms = _get_ritz_pairs(alphas, betas, num_steps)
+    ritz_vectors = torch.matmul(lanczos_vectors[:, :num_steps], eigenvectors)
+    return ritz_values, ritz_vectors, residual_norms
+
+
+def local_response_curvature_level_set_lanczos(f, point, top_k=5, bottom_k=5, num_iterations=None, seed=None,
+        tolerance=1e-6):
+    """
+    Matrix-free principal curvatures of the iso-response surface through point
+        The level set shape operator is -P H P / |g|, where g & H are the gradient & hessian of f at point and
+        P = I - n n^T projects onto the tangent space of the surface with unit normal n = g / |g|.
+        The operator is applied with hessian vector products (double backward), so the [M, M] hessian is never formed
+        and memory is O(num_iterations * M). Lanczos iterations continue until the residual norm |S v - k v| of each
+        returned curvature k & direction v is below tolerance * max(|k|), or until num_iterations; the curvatures then
+        approximate those from local_response_curvature_level_set(). A warning is printed if they did not converge.
+    Parameters:
+        f [function] maps a tensor with the shape of point to a scalar activation, e.g. a single model neuron
+        point [pytorch tensor] single datapoint where the curvature will be computed
+        top_k [int] number of largest principal curvatures to return
+        bottom_k [int] number of smallest principal curvatures to return
+        num_iterations [int] maximum number of Lanczos iterations, defaults to max(10 * (top_k + bottom_k), 100)
+        seed [int] seed for the random initial Lanczos vector; if None, the global torch random number generator is used
+        tolerance [float] relative residual norm at which the curvatures are considered converged
+    Outputs:
+        principal_curvatures - [top_k + bottom_k] dimensional array with the top_k largest followed by the bottom_k
+            smallest curvatures, in descending order
+        principal_directions - [M, top_k + bottom_k] dimensional array of unit vectors in the flattened input space,
+            where principal_directions[:, i] is the vector corresponding to principal_curvatures[i]
+    """
+    dtype = point.dtype
+    device = point.device
+    num_dims = point.numel()
+    if num_iterations is None:
+        num_iterations = max(10 * (top_k + bottom_k), 100)
+    x = point.detach().clone().requires_grad_(True)
+    pt_grad, = torch.autograd.grad(f(x), x, create_graph=True)
+    pt_grad = pt_grad.flatten()
+    grad_norm = torch.linalg.norm(pt_grad.detach())
+    if grad_norm == 0:
+        raise ValueError('singular gradient, the iso response surface normal is not defined')
+    normal = (pt_grad.detach() / grad_norm)[:, None]
+    def shape_operator_matvec(vector):
+        vector = vector - normal[:, 0] * torch.dot(normal[:, 0], vector)
+        hess_vector, = torch.autograd.grad(pt_grad, x, grad_outputs=vector.reshape(pt_grad.shape), retain_graph=True)
+        hess_vector = hess_vector.flatten()
+        hess_vector = hess_vector - normal[:, 0] * torch.dot(normal[:, 0], hess_vector)
+        return -hess_vector / grad_norm
+    if seed is None:
+        initial_vector = torch.randn(num_dims, dtype=dtype, device=device)
+    else:
+        generator = torch.Generator(device=device).manual_seed(seed)
+        initial_vector = torch.randn(num_dims, dtype=dtype, device=device, generator=generator)
+    ritz_values, ritz_vectors, residual_norms = lanczos_eigh(shape_operator_matvec, initial_vector, num_iterations,
+        deflation_vectors=normal, num_top=top_k, num_bottom=bottom_k, residual_tolerance=tolerance)
+    if top_k + bottom_k < len(ritz_values):
+        keep_indices = torch.cat((torch.arange(top_k), torch.arange(len(ritz_values) - bottom_k, len(ritz_values)))).to(device)
+        ritz_values = ritz_values[keep_indices]
+        ritz_vectors = ritz_vectors[:, keep_indices]
+        residual_norms = residual_norms[keep_indices]
+    max_residual = torch.max(residual_norms / torch.max(torch.abs(ritz_values))).item()
+    if max_residual > tolerance:
+        print('WARNING: principal_curvature/local_response_curvature_level_set_lanczos: curvatures did not converge '
+            +f'after {num_iterations} iterations, the largest relative residual norm is {max_residual}')
+    return ritz_values, ritz_vectors
+
+
+def local_response_curvature_alternates(pt_grad, pt_hess, so_type='lee_level', use_metric=False, top_k=None):
     """
     Alternative published methods for computing local response curvature.
     if so_type == 'moosavi', then shape operator is computed using descriptions from:
@@ -508,18 +894,35 @@ def local_response_curvature_alternates(pt_grad, pt_hess, so_type='lee_level'):
     
     and if so_type == 'lee_level' or 'lee_graph', then operator is computed from:
         DM Paiton, D Schultheiss, M Kümmerer, Z Cranko, M Bethge (2021) - The Geometry of Adversarial Subspaces
+
+    For a batch of points, pt_grad is [B, M] and pt_hess is [B, M, M], and all points are computed together.
+    The outputs then have a leading batch dimension.
+    if use_metric is True, the curvatures are computed with a symmetric solver: moosavi & poole operators are symmetric,
+    and the others are symmetric with respect to their metric tensor (see get_principal_curvatures()).
+    Otherwise the general torch.linalg.eig is used.
+    if top_k is not None, only the top_k largest principal curvatures and their directions are computed, which
+    requires use_metric=True.
     """
+    batched = pt_hess.ndim == 3
+    symmetric = False; metric_tensor = None
     if so_type.lower() == 'moosavi':
         shape_operator = get_shape_operator_moosavi(pt_grad, pt_hess)
+        symmetric = True
     elif so_type.lower() == 'golden':
         shape_operator = get_shape_operator_golden(pt_grad, pt_hess)
+        metric_tensor = _get_graph_metric_tensor(pt_grad, batched)
     elif so_type.lower() == 'poole':
         shape_operator = get_shape_operator_poole(pt_grad, pt_hess)
+        symmetric = True
     elif so_type.lower() == 'lee_level':
-        shape_operator = get_shape_operator_level_set(pt_grad, pt_hess)[0]
+        shape_operator, embedding_differential, metric_tensor = get_shape_operator_level_set(pt_grad, pt_hess)
     elif so_type.lower() == 'lee_graph':
         shape_operator = get_shape_operator_graph(pt_grad, pt_hess)
+        metric_tensor = _get_graph_metric_tensor(pt_grad, batched)
     else:
         assert False
-    principal_curvatures, principal_directions = get_principal_curvatures(shape_operator)
+    if not use_metric:
+        symmetric = False; metric_tensor = None
+    principal_curvatures, principal_directions = get_principal_curvatures(
+        shape_operator, metric_tensor=metric_tensor, symmetric=symmetric, top_k=top_k)
     return shape_operator, principal_curvatures, principal_directions
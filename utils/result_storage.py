@@ -0,0 +1,240 @@
+"""
+Utility funcions for storing response analysis results as memory-mapped arrays
+
+Each result field is stored as its own .npy file in a result directory, alongside a small index.json
+that records the shape & dtype of every field plus any JSON serializable metadata.
+Fields are loaded with np.load(mmap_mode='r'), so a single target's maps can be sliced without reading the whole file.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+INDEX_FILENAME = 'index.json'
+
+
+def get_field_path(result_directory, field):
+    """
+    Parameters:
+        result_directory [str] directory that contains the result store
+        field [str] name of the result field, e.g. 'response_images'
+    Outputs:
+        field_path [str] location of the .npy file for the field
+    """
+    return os.path.join(result_directory, field+'.npy')
+
+
+def load_index(result_directory):
+    """
+    Parameters:
+        result_directory [str] directory that contains the result store
+    Outputs:
+        index [dict] with keys 'fields', which maps field names to {'shape', 'dtype'}, and 'metadata'
+    """
+    index_path = os.path.join(result_directory, INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return {'fields': {}, 'metadata': {}}
+    with open(index_path, 'r') as index_file:
+        return json.load(index_file)
+
+
+def save_index(result_directory, index):
+    """
+    Write the index to disk, replacing the old one atomically so that an interrupted write never corrupts the store
+    Parameters:
+        result_directory [str] directory that contains the result store
+        index [dict] returned from load_index()
+    """
+    index_path = os.path.join(result_directory, INDEX_FILENAME)
+    tmp_index_path = index_path+'.tmp'
+    with open(tmp_index_path, 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+    os.replace(tmp_index_path, index_path)
+
+
+def _is_json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_json_value(entry) for entry in value)
+    return False
+
+
+def get_json_metadata(params):
+    """
+    Parameters:
+        params [dict] e.g. experiment parameters, which can contain large arrays that do not belong in the index
+    Outputs:
+        metadata [dict] entries of params whose values are scalars, strings, or (nested) lists & tuples of them
+    """
+    return {key: value for key, value in params.items() if _is_json_value(value)}
+
+
+def create_result_array(result_directory, field, shape, dtype=np.float64, fill_value=None):
+    """
+    Preallocate a memory-mapped array on disk that can be filled one chunk at a time
+    Parameters:
+        result_directory [str] directory that contains the result store, it will be created if it does not exist
+        field [str] name of the result field
+        shape [tuple of ints] shape of the array
+        dtype [np.dtype] data type of the array
+        fill_value [scalar or None] if not None, the array is initialized to this value
+    Outputs:
+        result_array [np.memmap] writable array that is backed by the field's .npy file
+    """
+    if not os.path.exists(result_directory):
+        os.makedirs(result_directory)
+    result_array = np.lib.format.open_memmap(get_field_path(result_directory, field), mode='w+',
+        dtype=dtype, shape=tuple(shape))
+    if fill_value is not None:
+        result_array[...] = fill_value
+    index = load_index(result_directory)
+    index['fields'][field] = {'shape': list(result_array.shape), 'dtype': result_array.dtype.str}
+    save_index(result_directory, index)
+    return result_array
+
+
+def open_result_array(result_directory, field, shape, dtype=np.float64, fill_value=None, resume=False):
+    """
+    Open an existing result array for in-place updates, or preallocate a new one
+    Parameters:
+        result_directory [str] directory that contains the result store
+        field [str] name of the result field
+        shape [tuple of ints] shape of the array
+        dtype [np.dtype] data type of the array
+        fill_value [scalar or None] if not None, a newly created array is initialized to this value
+        resume [bool] if True and the field already exists with the same shape & dtype, then it is opened in 'r+' mode
+            otherwise a new array is created with create_result_array()
+    Outputs:
+        result_array [np.memmap] writable array that is backed by the field's .npy file
+    """
+    if resume and has_result_array(result_directory, field, shape, dtype):
+        return np.load(get_field_path(result_directory, field), mmap_mode='r+')
+    return create_result_array(result_directory, field, shape, dtype, fill_value)
+
+
+def has_result_array(result_directory, field, shape, dtype=np.float64):
+    """
+    Parameters:
+        result_directory [str] directory that contains the result store
+        field [str] name of the result field
+        shape [tuple of ints] expected shape of the array
+        dtype [np.dtype] expected data type of the array
+    Outputs:
+        exists [bool] True if the field is stored with the given shape & dtype
+    """
+    field_info = load_index(result_directory)['fields'].get(field)
+    return (field_info is not None and os.path.exists(get_field_path(result_directory, field))
+        and tuple(field_info['shape']) == tuple(shape) and np.dtype(field_info['dtype']) == np.dtype(dtype))
+
+
+def update_metadata(result_directory, metadata):
+    """
+    Parameters:
+        result_directory [str] directory that contains the result store, it will be created if it does not exist
+        metadata [dict] JSON serializable entries that are added to (or replace entries in) the index metadata
+    """
+    if not os.path.exists(result_directory):
+        os.makedirs(result_directory)
+    index = load_index(result_directory)
+    index['metadata'].update(metadata)
+    save_index(result_directory, index)
+
+
+def get_array_hash(arrays):
+    """
+    Parameters:
+        arrays [list of array-like] e.g. the target or comparison vectors of an experiment
+    Outputs:
+        array_hash [str] sha1 hex digest of the shape, dtype & values of every array
+    """
+    hasher = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        hasher.update(str((array.shape, array.dtype.str)).encode())
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+
+def write_result_array(result_directory, field, array, chunk_size=1):
+    """
+    Write an array to the result store in chunks along the first axis
+        array can itself be memory-mapped, in which case it is never fully loaded
+    Parameters:
+        result_directory [str] directory that contains the result store
+        field [str] name of the result field
+        array [array-like] data to be written; nested lists are converted with np.asarray
+            if array is already memory-mapped to the field's file then it is only flushed
+        chunk_size [int] number of entries along the first axis to copy at a time
+    """
+    if not isinstance(array, np.ndarray):
+        array = np.asarray(array)
+    field_path = get_field_path(result_directory, field)
+    if (isinstance(array, np.memmap) and array.filename is not None and os.path.exists(field_path)
+            and os.path.samefile(array.filename, field_path)):
+        array.flush() # the array was already written in place, e.g. with create_result_array()
+        return
+    result_array = create_result_array(result_directory, field, array.shape, array.dtype)
+    if array.ndim == 0:
+        result_array[...] = array
+    else:
+        for chunk_start in range(0, array.shape[0], chunk_size):
+            result_array[chunk_start:chunk_start+chunk_size, ...] = array[chunk_start:chunk_start+chunk_size, ...]
+    result_array.flush()
+    del result_array
+
+
+def save_results(result_directory, results, metadata=None, chunk_size=1):
+    """
+    Save a dictionary of results with one array file per field
+    Parameters:
+        result_directory [str] directory that contains the result store
+        results [dict] mapping field names to array-like values
+            entries that are None, or that can not be converted to a numeric array (e.g. ragged lists), are skipped
+        metadata [dict or None] JSON serializable information to store in the index, e.g. experiment parameters
+            that were filtered with get_json_metadata(); values that can not be serialized raise a TypeError
+        chunk_size [int] number of entries along the first axis to copy at a time
+    Outputs:
+        skipped_fields [list of str] names of fields that were not saved
+    """
+    skipped_fields = []
+    for field, value in results.items():
+        if value is None:
+            skipped_fields.append(field)
+            continue
+        try:
+            array = value if isinstance(value, np.ndarray) else np.asarray(value)
+        except ValueError: # ragged nested lists
+            skipped_fields.append(field)
+            continue
+        if array.dtype == object:
+            skipped_fields.append(field)
+            continue
+        write_result_array(result_directory, field, array, chunk_size)
+    if metadata is not None:
+        update_metadata(result_directory, metadata)
+    return skipped_fields
+
+
+def load_results(result_directory, fields=None, mmap_mode='r'):
+    """
+    Open a result store without reading the arrays into memory
+    Parameters:
+        result_directory [str] directory that contains the result store
+        fields [list of str or None] names of fields to open; if None, all fields in the index are opened
+        mmap_mode [str or None] passed to np.load; use None to load the arrays into memory
+    Outputs:
+        results [dict] mapping field names to (memory-mapped) arrays
+        metadata [dict] metadata stored in the index
+    """
+    index = load_index(result_directory)
+    if fields is None:
+        fields = list(index['fields'].keys())
+    results = {}
+    for field in fields:
+        assert field in index['fields'], (
+            f'utils/result_storage: ERROR: field {field} is not in the result store at {result_directory}')
+        results[field] = np.load(get_field_path(result_directory, field), mmap_mode=mmap_mode)
+    return results, index['metadata']